@@ -1,25 +1,84 @@
+import os
+import json
 from typing import Any, Literal
-from collections.abc import Callable
 
 from mariadb import Cursor
 
-sizes = ['N/A', 'XS', 'S', 'M', 'L', 'XL']
+import catalog_index
+import metrics
+import paging
+import session
+from addresses import address_key
+from cache import LRUCache
+from db import after_transaction, release_if_unused
 
+# Everything here that runs SQL (itself or through a helper) is marked
+# @metrics.timed_action, so /metrics shows its SQL under its own name.
+
+# customer_id -> get_cart_info's result, since the cart badge asks on every page.
+# Cart changes made here drop the customer's entry, but only in this process:
+# with several gunicorn workers, the next request can land on another one. So
+# the TTL is kept to a few seconds, which is about as long as a badge can be
+# wrong after /cart/add, and still saves most of the lookups from page loads.
+cart_info_cache = LRUCache(
+	max_size=int(os.environ.get('KSTORES_CART_CACHE_SIZE', 10000)),
+	ttl=float(os.environ.get('KSTORES_CART_CACHE_TTL', 3))
+)
+
+def forget_cart_info(cur: Cursor, customer_id: int):
+	""" Drops a customer's cached cart info, now and again once the transaction's over. """
+	cart_info_cache.pop(customer_id)
+	after_transaction(cur, lambda: cart_info_cache.pop(customer_id))
+
+# customer_id -> get_customer_info's result, for account pages and checkout.
+# Changes made here drop the customer's entry; the TTL covers changes made by
+# other processes.
+customer_info_cache = LRUCache(
+	max_size=int(os.environ.get('KSTORES_CUSTOMER_CACHE_SIZE', 10000)),
+	ttl=float(os.environ.get('KSTORES_CUSTOMER_CACHE_TTL', 300))
+)
+
+def forget_customer_info(cur: Cursor, customer_id: int):
+	""" Drops a customer's cached profile, now and again once the transaction's over. """
+	customer_info_cache.pop(customer_id)
+	after_transaction(cur, lambda: customer_info_cache.pop(customer_id))
+
+@metrics.timed_action
 def check_login(cur: Cursor, email: str, password: str) -> tuple[bool, int | None]:
-	""" Check if user's email/password pair is valid. """
+	"""
+	Check if user's email/password pair is valid.
+	Passwords still stored in plaintext (from before they were hashed) get hashed on the way.
+	"""
 	cur.execute("""
-		SELECT customer_id
+		SELECT customer_id, password
 		FROM customer
 		WHERE email = ?
-		AND password = ?
 		LIMIT 1;
-	""", (email, password))
+	""", (email,))
+	row = cur.fetchone()
+	# Checking the password takes a while on purpose; don't hold a connection meanwhile.
+	release_if_unused(cur)
+	
+	if row is None:
+		# Nobody by that email, but take as long as a wrong password would.
+		session.verify_password(session.dummy_hash(), password)
+		return (False, None)
 	
-	if cur.rowcount > 0:
-		return (True, cur.fetchone()[0])
-	else:
+	(customer_id, stored) = row
+	(valid, needs_rehash) = session.verify_password(stored, password)
+	if not valid:
 		return (False, None)
+	
+	if needs_rehash:
+		hashed = session.hash_password(password)
+		cur.execute("""
+			UPDATE customer
+			SET password = ?
+			WHERE customer_id = ?;
+		""", (hashed, customer_id))
+	return (True, customer_id)
 
+@metrics.timed_action
 def create_customer(
 	cur: Cursor,
 	first_name: str, middle_name: str, last_name: str,
@@ -28,8 +87,12 @@ def create_customer(
 	shipping_addr: int | None = None,
 	billing_addr: int | None = None
 ) -> int:
-	""" Create a new customer. By default, they won't have any addresses. """
+	"""
+	Create a new customer. By default, they won't have any addresses.
+	`password` can already be hashed (see `session.hash_password`).
+	"""
 	
+	password = str(session.hash_password(password))
 	cur.execute("""
 		INSERT INTO customer (
 			first_name, middle_name, last_name,
@@ -48,18 +111,28 @@ def create_customer(
 		email, password,
 		phone_number
 	))
-	return cur.lastrowid # type: ignore
+	customer_id: int = cur.lastrowid # type: ignore
+	forget_customer_info(cur, customer_id)
+	return customer_id
 
 # Get a customer's information.
+@metrics.timed_action
 def get_customer_info(cur: Cursor, customer_id: int):
-	""" Get a customer's information. Merges in the shipping and billing addresses too. """
+	"""
+	Get a customer's information. Merges in the shipping and billing addresses too.
+	Cached per customer, so this usually doesn't touch the database.
+	"""
+	
+	cached = customer_info_cache.get(customer_id)
+	if cached is not None:
+		return dict(cached)
 	
 	# TODO: hey!! this might be null! Jeez! This really is 3 am code...
 	
 	cur.execute("""
 			SELECT
 				first_name, middle_name, last_name,
-				email, password,
+				email,
 				shipping_address,
 				shipping.street, shipping.city, shipping.state, shipping.zip,
 				billing_address,
@@ -73,7 +146,7 @@ def get_customer_info(cur: Cursor, customer_id: int):
 	
 	(
 		first_name, middle_name, last_name,
-		email, password,
+		email,
 		shipping_address,
 		shipping_street,
 		shipping_city, shipping_state, shipping_zip,
@@ -83,14 +156,13 @@ def get_customer_info(cur: Cursor, customer_id: int):
 		phone_number
 	) = cur.fetchone()
 	
-	return {
+	info = {
 		'name': {
 			'first': first_name,
 			'middle': middle_name,
 			'last': last_name
 		},
 		'email': email,
-		'password': password,
 		'address': {
 			'shipping': {
 				'id': shipping_address,
@@ -109,11 +181,15 @@ def get_customer_info(cur: Cursor, customer_id: int):
 		},
 		'phone_number': phone_number
 	}
+	customer_info_cache.put(customer_id, info)
+	return dict(info)
 
+@metrics.timed_action
 def edit_customer(cur: Cursor, customer_id: int, **fields):
 	"""
 	Edit a customer. Only accepts fields from `valid_fields`.
 	Don't include fields you don't want to modify.
+	A new `password` can already be hashed (see `session.hash_password`).
 	"""
 	
 	valid_fields = [
@@ -141,6 +217,9 @@ def edit_customer(cur: Cursor, customer_id: int, **fields):
 		else:
 			annoying_comma = True
 		
+		if field == 'password':
+			value = str(session.hash_password(value))
+		
 		query += f"{field} = ?"
 		params.append(value)
 	
@@ -151,37 +230,72 @@ def edit_customer(cur: Cursor, customer_id: int, **fields):
 	params.append(customer_id)
 	
 	cur.execute(query, params)
+	forget_customer_info(cur, customer_id)
 
+@metrics.timed_action
 def create_address(
 	cur: Cursor,
 	street: str, city: str, state: str, zip: int
 ) -> int:
 	"""
 	Create a new address.
-	(May return existing address_ids if they match.)
+	(May return existing address_ids if they match, ignoring spacing and case;
+	see addresses.py.)
 	"""
 	
+	# One statement whether or not it's new: if the fingerprint's taken,
+	# LAST_INSERT_ID(address_id) makes lastrowid the existing row's id.
+	# The unique index also means two signups at once can't both add it.
 	cur.execute("""
-		SELECT MIN(address_id)
-		FROM address
-		WHERE street = ?
-		AND city = ? AND state = ?
-		AND zip = ?;
+		INSERT INTO address (
+			street, city, state, zip,
+			address_key
+		) VALUES (?, ?, ?, ?, ?)
+		ON DUPLICATE KEY UPDATE address_id = LAST_INSERT_ID(address_id);
 	""", (
-		street, city, state, zip
+		street, city, state, zip,
+		address_key(street, city, state, zip)
 	))
-	existing_address: int | None = cur.fetchone()[0]
+	return cur.lastrowid # type: ignore
+
+@metrics.timed_action
+def create_addresses(
+	cur: Cursor,
+	addresses: list[tuple[str, str, str, int]],
+	chunk: int = 1000
+) -> list[int]:
+	"""
+	`create_address` for lots of (street, city, state, zip) at once, for imports.
+	Returns their address_ids, in the same order (repeats get the same id).
+	"""
 	
-	if existing_address is None:
-		cur.execute("""
+	keys = [ address_key(*address) for address in addresses ]
+	# Only the first spelling of each address gets stored.
+	unique: dict[bytes, tuple] = {}
+	for (key, address) in zip(keys, addresses):
+		unique.setdefault(key, (*address, key))
+	rows = list(unique.values())
+	
+	ids: dict[bytes, int] = {}
+	for start in range(0, len(rows), chunk):
+		batch = rows[start:start + chunk]
+		cur.executemany("""
 			INSERT INTO address (
-				street, city, state, zip
-			) VALUES (?, ?, ?, ?);
-		""", ( street, city, state, zip ))
-		return cur.lastrowid # type: ignore
-	else:
-		return existing_address # type: ignore
+				street, city, state, zip,
+				address_key
+			) VALUES (?, ?, ?, ?, ?)
+			ON DUPLICATE KEY UPDATE address_id = address_id;
+		""", batch)
+		cur.execute(f"""
+			SELECT address_key, address_id
+			FROM address
+			WHERE address_key IN ({', '.join('?' * len(batch))});
+		""", [ row[-1] for row in batch ])
+		ids.update((bytes(key), address_id) for (key, address_id) in cur)
+	
+	return [ ids[key] for key in keys ]
 
+@metrics.timed_action
 def get_address_info(cur: Cursor, address_id: int):
 	""" Gets an address from an address ID number. """
 	
@@ -201,6 +315,7 @@ def get_address_info(cur: Cursor, address_id: int):
 		'zip': zip_code
 	}
 
+@metrics.timed_action
 def update_customer_address(
 	cur: Cursor,
 	customer_id: int, address_type: Literal['shipping'] | Literal['billing'],
@@ -208,8 +323,9 @@ def update_customer_address(
 ):
 	"""
 	Updates either the billing or shipping address associated with a specific customer.
-	Also, checks to see if the underlying ID is used anywhere else, and if so it'll
-	create a new address entry.
+	Addresses are never changed in place (orders and other customers may share
+	them): the customer is pointed at the edited address, found or created by
+	`create_address`, and the old one is deleted if nothing uses it anymore.
 	"""
 	
 	valid_fields = [ 'street', 'city', 'state', 'zip' ]
@@ -217,186 +333,45 @@ def update_customer_address(
 	if address_type not in ['shipping', 'billing']:
 		raise Exception("address_type must be either 'shipping' or 'billing'")
 	
-	# if we had a billion orders, this'd be problematic.
-	# (maybe it'd necessitate separate customer_address
-	#  and order_address tables!!) but this is fine.
-	
 	cur.execute(f"""
-		SELECT {address_type}_address
-		FROM customer
-		WHERE customer_id = ?;
+		SELECT c.{address_type}_address, a.street, a.city, a.state, a.zip
+		FROM customer c
+		LEFT JOIN address a ON a.address_id = c.{address_type}_address
+		WHERE c.customer_id = ?
+		FOR UPDATE;
 		""", (customer_id,))
-	(address_id,) = cur.fetchone()
-	
-	other_addr_type = 'shipping' if address_type == 'billing' else 'billing'
-	cur.execute(f"""
-		SELECT COUNT(*)
-		FROM customer
-		WHERE {other_addr_type}_address = ?
-		OR (customer_id <> ?
-		AND {address_type}_address = ?);
-		""", (address_id, customer_id, address_id))
-	(customer_usage,) = cur.fetchone()
-	
-	need_to_clone = customer_usage > 0
-	
-	if not need_to_clone:
-		cur.execute(f"""
-			SELECT COUNT(*)
-			FROM `order`
-			WHERE shipping_address = ?
-			OR billing_address = ?;
-			""", (address_id, address_id))
-		(order_usage,) = cur.fetchone()
-		
-		need_to_clone = order_usage > 0
-	
-	if need_to_clone:
-		query = """
-			INSERT INTO address (
-				street, city, state, zip
-			) SELECT 
-		"""
-		params = []
-		annoying_comma = False
-		
-		for field in valid_fields:
-			if annoying_comma:
-				query += ",\n"
-			else:
-				annoying_comma = True
-			
-			if field in fields \
-			and fields[field] is not None:
-				query += "?"
-				params.append(fields[field])
-			else:
-				query += field
-		
-		query += "\n" + """
-			FROM address
-			WHERE address_id = ?;
-		"""
-		params.append(address_id)
-		
-		cur.execute(query, params)
-		address_id = cur.lastrowid # type: ignore
-		
-		cur.execute(f"""
-			UPDATE customer
-			SET {address_type}_address = ?
-			WHERE customer_id = ? LIMIT 1;
-		""", (address_id, customer_id))
-	else:
-		query = """
-			UPDATE address
-			SET 
-		"""
-		params = []
-		annoying_comma = False
-		
-		for (field, value) in fields.items():
-			if field not in valid_fields \
-			or value is None:
-				continue # skip invalid fields
-			
-			if annoying_comma:
-				query += ",\n"
-			else:
-				annoying_comma = True
-			
-			query += f"{field} = ?"
-			params.append(value)
-		
-		query += "\nWHERE address_id = ? LIMIT 1;"
-		params.append(address_id)
-		
-		cur.execute(query, params)
-	
-	return { 'address': address_id }
-
-def search_catalog(cur: Cursor, **filters):
-	"""
-	Fancy search function.
-	Set keyword args to add different types of filters.
-	It'll construct a query using all of them.
+	(address_id, *current) = cur.fetchone()
 	
-	The `**filters` parameter is a keyword argument list.
-	It'll store a dict[str, Any] containing any other
-	keyword arguments you provide. Keyword arguments
-	are those things like `name="jim"` and such.
-	The great thing is that you aren't required to
-	include all of them, so you can skip the filters
-	you don't need.
-	"""
-	
-	query = """
-		SELECT
-			item_id, variant_id,
-			item_name, category,
-			size, color,
-			price, weight,
-			COALESCE(variant_image, item_image) AS image_id
-		FROM variant_catalog JOIN item_catalog USING (item_id)
-		WHERE 1=1""" # (dummy expression to require use of AND)
-	params = []
-	
-	# This is a list that maps a filter name to an SQL query,
-	# and provides a function to turn an argument given with
-	# the filter name into something that an SQL query can use.
-	filters_map: dict[str, tuple[str, Callable[[Any], Any]]] = {
-		'name':     ("item_name LIKE ?", lambda p: f"%{p}%"),
-		'category': ("category = ?",     lambda p: str(p)),
-		'size':     ("size = ?",         lambda p: p if p in sizes else None),
-		'color':    ("LOWER(color) = ?", lambda p: str(p).lower()),
-		'minprice': ("? <= price",       lambda p: float(p)),
-		'maxprice': ("price <= ?",       lambda p: float(p)),
-		'instock':  ("SIGN(stock) = ?",  lambda p: int(bool(p))),
-	}
+	address = dict(zip(valid_fields, current))
+	for field in valid_fields:
+		if fields.get(field) is not None:
+			address[field] = fields[field]
+	if any(value is None for value in address.values()):
+		raise Exception(f"no {address_type} address yet; need a street, city, state and zip")
 	
-	# Build query from keyword arguments.
-	for (f, p) in filters.items():
-		if not p:
-			continue
-		
-		query += "\nAND "
-		
-		(part, param_fn) = filters_map[f]
-		
-		# If it's a list and not just one value,
-		if isinstance(p, list):
-			# the SQL query should check if store items
-			# match any single value in the list.
-			query += '\nOR '.join([part]*len(p))
-			
-			# make a parameter out of each item in that list.
-			params += [param_fn(pi) for pi in p]
-		else:
-			# Otherwise, it's pretty simple!
-			query += part
-			params.append(param_fn(p))
-	query += ";"
+	new_address_id = create_address(cur, **address)
+	if new_address_id == address_id:
+		return { 'address': address_id }
 	
-	# Run query!
-	cur.execute(query, params)
+	cur.execute(f"""
+		UPDATE customer
+		SET {address_type}_address = ?
+		WHERE customer_id = ? LIMIT 1;
+	""", (new_address_id, customer_id))
+	forget_customer_info(cur, customer_id)
+	
+	# address.ref_count is how many customer and order columns point at the
+	# address (kept up to date by triggers; see migrations/0003), so this is
+	# one row, however many orders there are.
+	if address_id is not None:
+		cur.execute("""
+			DELETE FROM address
+			WHERE address_id = ? AND ref_count = 0;
+		""", (address_id,))
 	
-	return [{
-		'id': { 'item': item_id, 'variant': variant_id },
-		'name': item_name,
-		'category': category,
-		'size': size, # warning: nullable!
-		'color': color, # warning: nullable!
-		'price': price,
-		'weight': weight,
-		'image': image_id, # -> links to image endpoint?
-	} for (
-		item_id, variant_id,
-		item_name, category,
-		size, color,
-		price, weight,
-		image_id
-	) in cur]
+	return { 'address': new_address_id }
 
+@metrics.timed_action
 def create_image(cur: Cursor, mime_type: str, alt_text: str | None = None) -> int:
 	"""
 	Creates everything but the image's data.
@@ -410,6 +385,7 @@ def create_image(cur: Cursor, mime_type: str, alt_text: str | None = None) -> in
 		""", (mime_type, alt_text))
 	return cur.lastrowid # type: ignore
 
+@metrics.timed_action
 def get_image_info(cur: Cursor, image_id: int):
 	"""
 	Fetches image info. Returns a dict containing the image's MIME type and
@@ -424,13 +400,16 @@ def get_image_info(cur: Cursor, image_id: int):
 	(mime_type, alt_text) = cur.fetchone()
 	return { 'mime_type': mime_type, 'alt_text': alt_text }
 
+@metrics.timed_action
 def get_item_info(cur: Cursor, item_id: int):
 	"""
 	Returns all the metadata from an item, along with a list of
 	all the item's variants with metadata from those variants.
 	"""
 	cur.execute("""
-		SELECT item_name, description, category, item_image
+		SELECT
+			item_name, description, category, item_image,
+			price_min, price_max, stock_total, variant_count, sizes, colors
 		FROM item_catalog
 		WHERE item_id = ?;
 		""", (item_id,))
@@ -438,7 +417,7 @@ def get_item_info(cur: Cursor, item_id: int):
 	if cur.rowcount < 1:
 		raise Exception("item not found")
 	
-	(item_name, description, category, item_image) = cur.fetchone()
+	(item_name, description, category, item_image, *summary) = cur.fetchone()
 	
 	cur.execute("""
 		SELECT item_id, variant_id,
@@ -471,17 +450,104 @@ def get_item_info(cur: Cursor, item_id: int):
 		'description': description,
 		'category': category,
 		'image': item_image,
+		'summary': item_summary(*summary),
 		'variants': variants
 	}
 
-def get_cart_items(cur: Cursor, customer_id: int):
-	""" Returns the items in the cart, with details about each one. """
+def item_summary(
+	price_min, price_max,
+	stock_total: int, variant_count: int,
+	sizes: str, colors: str | None
+) -> dict:
+	""" The summary columns on item_catalog (see migrations/0005 and 0007), as they're returned. """
+	return {
+		'price': { 'min': price_min, 'max': price_max },
+		'stock': stock_total,
+		'variants': variant_count,
+		# A SET column, so the sizes themselves can't have commas in them.
+		'sizes': sizes.split(',') if sizes else [],
+		'colors': json.loads(colors) if colors else []
+	}
+
+@metrics.timed_action
+def get_item_summaries(
+	cur: Cursor,
+	category: list[str] | None = None,
+	minprice: int | None = None, maxprice: int | None = None,
+	instock: bool | None = None,
+	limit: int | None = None, after: tuple[int] | None = None
+):
+	"""
+	One row per item, with its summary instead of its variants: what listing
+	pages need, read straight off item_catalog.
+	Filters work like the catalog index's (`CatalogIndex.match`), but on whole
+	items: an item matches the price filter if its price range overlaps it, and
+	`instock` if any variant's in stock (or none are, with instock=False).
+	Sorted by item_id; pass `limit` to cap the number of items, and `after` to
+	start after a given (item_id,).
+	"""
 	
-	cur.execute("""
+	(keyset, keyset_params) = paging.keyset_condition(['item_id'], after)
+	(limit_sql, limit_params) = paging.limit_clause(limit)
+	
+	conditions = [ keyset ]
+	params: list[Any] = list(keyset_params)
+	if category:
+		conditions.append(f"category IN ({', '.join('?' * len(category))})")
+		params += category
+	if minprice is not None:
+		conditions.append("price_max >= ?")
+		params.append(minprice)
+	if maxprice is not None:
+		conditions.append("price_min <= ?")
+		params.append(maxprice)
+	if instock is not None:
+		conditions.append("(stock_total > 0) = ?")
+		params.append(instock)
+	
+	cur.execute(f"""
+		SELECT
+			item_id, item_name, category, item_image,
+			price_min, price_max, stock_total, variant_count, sizes, colors
+		FROM item_catalog
+		WHERE {' AND '.join(conditions)}
+		ORDER BY item_id
+		{limit_sql};
+	""", params + limit_params)
+	
+	return [{
+		'id': item_id,
+		'name': item_name,
+		'category': category,
+		'image': item_image,
+		'summary': item_summary(*summary)
+	} for (
+		item_id, item_name, category, item_image,
+		*summary
+	) in cur]
+
+@metrics.timed_action
+def get_cart_items(
+	cur: Cursor, customer_id: int,
+	limit: int | None = None, after: tuple[int, int] | None = None
+):
+	"""
+	Returns the items in the cart, with details about each one.
+	Sorted by (item_id, variant_id). Pass `limit` to cap the number of rows, and
+	`after` to start after a given (item_id, variant_id).
+	"""
+	
+	(keyset, keyset_params) = paging.keyset_condition(['item_id', 'variant_id'], after)
+	(limit_sql, limit_params) = paging.limit_clause(limit)
+	
+	cur.execute(f"""
 		WITH this_cart (item_id, variant_id, quantity) AS (
 			SELECT item_id, variant_id, quantity
 			FROM shopping_cart
-			WHERE customer_id = ? )
+			WHERE customer_id = ?
+			AND {keyset}
+			ORDER BY item_id, variant_id
+			{limit_sql} )
 		SELECT
 			item_id, variant_id,
 			item_name,
@@ -492,8 +558,9 @@ def get_cart_items(cur: Cursor, customer_id: int):
 			COALESCE(variant_image, item_image) AS image_id
 		FROM this_cart JOIN (
 			variant_catalog JOIN item_catalog USING (item_id)
-		) USING (item_id, variant_id);
-		""", (customer_id,))
+		) USING (item_id, variant_id)
+		ORDER BY item_id, variant_id;
+		""", [customer_id] + keyset_params + limit_params)
 	
 	return [{
 		'id': { 'customer': customer_id, 'item': item_id, 'variant': variant_id },
@@ -513,13 +580,19 @@ def get_cart_items(cur: Cursor, customer_id: int):
 		image_id
 	) in cur]
 
+@metrics.timed_action
 def get_cart_info(cur: Cursor, customer_id: int):
 	"""
 	Returns the number of items in, and the total price and weight,
 	(in a dict with fancy names!!) of the cart.
 	If cart is empty, all these are zero, thankfully.
+	Cached per customer, so this usually doesn't touch the database.
 	"""
 	
+	cached = cart_info_cache.get(customer_id)
+	if cached is not None:
+		return dict(cached)
+	
 	cur.execute("""
 		SELECT
 			COUNT(*),
@@ -533,8 +606,11 @@ def get_cart_info(cur: Cursor, customer_id: int):
 	
 	# If shopping cart empty, returns (0, 0, 0)
 	# otherwise, returns (count, price, weight)
-	return { 'count': count, 'price': price, 'weight': weight }
+	info = { 'count': count, 'price': price, 'weight': weight }
+	cart_info_cache.put(customer_id, info)
+	return dict(info)
 
+@metrics.timed_action
 def create_catalog_item(
 	cur: Cursor,
 	name: str, description: str, category: str,
@@ -546,6 +622,7 @@ def create_catalog_item(
 		INSERT INTO item_catalog (item_name, description, category, item_image)
 		VALUES (?, ?, ?, NULL);
 		""", (name, description, category))
+	after_transaction(cur, catalog_index.invalidate, committed_only=True)
 	
 	# Save auto-incrementing item_id
 	item_id = cur.lastrowid
@@ -573,6 +650,7 @@ def create_catalog_item(
 	# Return the auto-generated item_id
 	return item_id # type: ignore
 
+@metrics.timed_action
 def create_catalog_item_variant(
 	cur: Cursor,
 	item_id: int, variant_id: int | None,
@@ -585,6 +663,8 @@ def create_catalog_item_variant(
 	Don't use unless you really have to.
 	"""
 	
+	after_transaction(cur, catalog_index.invalidate, committed_only=True)
+	
 	params = (
 		item_id, variant_id,
 		size, color,
@@ -630,6 +710,85 @@ def create_catalog_item_variant(
 				?);
 			""", params)
 
+@metrics.timed_action
+def create_images(cur: Cursor, images: list[tuple[int, str | None, str | None]]):
+	"""
+	Creates (or overwrites) a batch of images with known image_ids, in one go.
+	Takes (image_id, mime_type, alt_text) tuples. Meant for bulk imports,
+	which can safely run the same batch twice.
+	"""
+	if not images:
+		return
+	cur.executemany("""
+		INSERT INTO catalog_images (
+			image_id, mime_type, alt_text
+		) VALUES (?, ?, ?)
+		ON DUPLICATE KEY UPDATE
+			mime_type = VALUES(mime_type),
+			alt_text = VALUES(alt_text);
+		""", images)
+
+@metrics.timed_action
+def create_catalog_items(
+	cur: Cursor,
+	items: list[tuple[int, str, str | None, str | None, int | None]]
+):
+	"""
+	Creates (or overwrites) a batch of catalog items with known item_ids.
+	Takes (item_id, name, description, category, image_id) tuples.
+	Like `create_images`, running the same batch twice is fine.
+	"""
+	if not items:
+		return
+	after_transaction(cur, catalog_index.invalidate, committed_only=True)
+	cur.executemany("""
+		INSERT INTO item_catalog (
+			item_id, item_name, description, category, item_image
+		) VALUES (?, ?, ?, ?, ?)
+		ON DUPLICATE KEY UPDATE
+			item_name = VALUES(item_name),
+			description = VALUES(description),
+			category = VALUES(category),
+			item_image = VALUES(item_image);
+		""", items)
+
+@metrics.timed_action
+def create_catalog_item_variants(
+	cur: Cursor,
+	variants: list[tuple[int, int, str | None, str | None, float, int, float, int | None]]
+):
+	"""
+	Creates (or overwrites) a batch of variants with known (item_id, variant_id)s.
+	Takes (item_id, variant_id, size, color, price, stock, weight, image_id) tuples.
+	Like `create_images`, running the same batch twice is fine.
+	"""
+	if not variants:
+		return
+	after_transaction(cur, catalog_index.invalidate, committed_only=True)
+	# Prices might've changed, and any cart could have these in it.
+	cart_info_cache.clear()
+	after_transaction(cur, cart_info_cache.clear)
+	cur.executemany("""
+		INSERT INTO variant_catalog (
+			item_id, variant_id,
+			size, color,
+			price, stock, weight,
+			variant_image
+		) VALUES (
+			?, ?,
+			?, ?,
+			?, ?, ?,
+			?)
+		ON DUPLICATE KEY UPDATE
+			size = VALUES(size),
+			color = VALUES(color),
+			price = VALUES(price),
+			stock = VALUES(stock),
+			weight = VALUES(weight),
+			variant_image = VALUES(variant_image);
+		""", variants)
+
+@metrics.timed_action
 def add_to_cart(
 	cur: Cursor,
 	customer_id: int,
@@ -641,6 +800,7 @@ def add_to_cart(
 	If the item is already present in the cart, this will reset its
 	quantity to the specified number blah blah.
 	"""
+	forget_cart_info(cur, customer_id)
 	if quantity > 0:
 		cur.execute("""
 			REPLACE INTO shopping_cart (
@@ -673,23 +833,62 @@ def add_to_cart(
 # 			AND variant_id = ?;
 # 			""", (customer_id, item_id, variant_id))
 
+class OutOfStock(Exception):
+	""" Raised by `place_order` when the cart wants more of a variant than is left. """
+
+@metrics.timed_action
 def place_order(cur: Cursor, customer_id: int) -> int:
 	"""
-	Places an order, clearing the items from the cart and creating
-	a new entry in the orders table. Returns the new order's ID.
+	Places an order, clearing the items from the cart, taking them out of
+	stock and creating a new entry in the orders table. Returns the new
+	order's ID.
 	
-	Uuugh. should probably decrement the stock.
+	Raises if the cart is empty, or `OutOfStock` if something in it doesn't
+	have enough stock left. In that case nothing should be kept, so the caller has to roll back
+	(the route decorators do).
 	"""
 	
+	# Lock the cart's rows, and the catalog rows of what's in it, until we
+	# commit. Anyone else checking out the same variants waits here instead
+	# of both of them buying the last one. Rows are locked in key order, so
+	# two carts that share variants can't each hold a lock the other wants.
+	cur.execute("""
+		SELECT
+			item_id, variant_id,
+			quantity, stock,
+			price, weight
+		FROM shopping_cart JOIN variant_catalog USING (item_id, variant_id)
+		WHERE customer_id = ?
+		ORDER BY item_id, variant_id
+		FOR UPDATE;
+		""", (customer_id,))
+	cart = cur.fetchall()
+	
+	if len(cart) < 1:
+		raise Exception("cart is empty")
+	
+	for (item_id, variant_id, quantity, stock, _, _) in cart:
+		if quantity > stock:
+			raise OutOfStock(f"not enough stock for item {item_id} variant {variant_id} ({stock} left)")
+	
 	# Calculate total price and weight of shopping cart items.
-	cart_info = get_cart_info(cur, customer_id)
-	( count, price, weight ) = (
-		cart_info['count'],
-		cart_info['price'],
-		cart_info['weight']
-	)
+	price = sum(price * quantity for (_, _, quantity, _, price, _) in cart)
+	weight = sum(weight * quantity for (_, _, quantity, _, _, weight) in cart)
 	
-	# Create a new order and fill it with info from the shopping cart.
+	# Take everything out of stock in one go. (Already checked there's enough,
+	# and nobody can've changed it since, thanks to the locks.)
+	cur.execute("""
+		UPDATE variant_catalog JOIN shopping_cart USING (item_id, variant_id)
+		SET stock = stock - quantity
+		WHERE customer_id = ?;
+		""", (customer_id,))
+	
+	if any(quantity == stock for (_, _, quantity, stock, _, _) in cart):
+		# something just sold out, so the in-stock search filter is out of date
+		after_transaction(cur, catalog_index.invalidate, committed_only=True)
+	
+	# Create a new order, already marked as 'ordered',
+	# with the customer's current addresses.
 	cur.execute("""
 		INSERT INTO `order` (
 			customer_id,
@@ -697,23 +896,16 @@ def place_order(cur: Cursor, customer_id: int) -> int:
 			shipping_address, billing_address,
 			total_price, total_weight,
 			status
-		) VALUES (
-			?,
+		)
+		SELECT
+			customer_id,
 			CURRENT_TIMESTAMP(),
-			(
-				SELECT shipping_address
-				FROM customer AS tmp
-				WHERE tmp.customer_id = ?
-			),
-			(
-				SELECT billing_address
-				FROM customer AS tmp
-				WHERE tmp.customer_id = ?
-			),
+			shipping_address, billing_address,
 			?, ?,
-			NULL
-		);
-		""", (customer_id, customer_id, customer_id, price, weight))
+			'ordered'
+		FROM customer
+		WHERE customer_id = ?;
+		""", (price, weight, customer_id))
 	# One of the default fields will be order_id,
 	# the primary key which is auto-incremented.
 	
@@ -730,39 +922,41 @@ def place_order(cur: Cursor, customer_id: int) -> int:
 		WHERE customer_id = ?;
 		""", (order_id, customer_id))
 	
-	# TODO: decrement stock for items in shopping cart
-	# (but what if we take too many items?)
-	# (and what if Alice buys out all the stock of some item
-	# Bob has in his cart before he checks out his cart?)
-	# TODO: lock / unlock variant table to set stock
-	
 	# Remove them from shopping cart now that they're copied over.
 	cur.execute("""
 		DELETE FROM shopping_cart
 		WHERE customer_id = ?;
 		""", (customer_id,))
-	
-	# Finally, set the status to 'ordered'.
-	cur.execute("""
-		UPDATE `order`
-		SET status = 'ordered'
-		WHERE order_id = ?;
-		""", (order_id,))
+	forget_cart_info(cur, customer_id)
 	
 	# Return the new order's order_id.
 	return order_id # type: ignore
 
-def list_orders(cur: Cursor, customer_id: int):
-	""" Returns a list of all orders associated with a customer. """
+@metrics.timed_action
+def list_orders(
+	cur: Cursor, customer_id: int,
+	limit: int | None = None, after: tuple[int] | None = None
+):
+	"""
+	Returns a list of all orders associated with a customer.
+	Sorted by order_id; pass `limit` to cap the number of orders,
+	and `after` to start after a given (order_id,).
+	"""
 	
-	cur.execute("""
+	(keyset, keyset_params) = paging.keyset_condition(['order_id'], after)
+	(limit_sql, limit_params) = paging.limit_clause(limit)
+	
+	cur.execute(f"""
 		SELECT
 			order_id, status,
 			total_price, total_weight,
 			order_date
 		FROM `order`
-		WHERE customer_id = ?;
-	""", (customer_id,))
+		WHERE customer_id = ?
+		AND {keyset}
+		ORDER BY order_id
+		{limit_sql};
+	""", [customer_id] + keyset_params + limit_params)
 	
 	return [{
 		'id': { 'customer': customer_id, 'order': order_id },
@@ -775,6 +969,7 @@ def list_orders(cur: Cursor, customer_id: int):
 		order_date
 	) in cur]
 
+@metrics.timed_action
 def get_order_info(cur: Cursor, order_id: int):
 	"""
 	Gets information about a specific order.
@@ -803,14 +998,28 @@ def get_order_info(cur: Cursor, order_id: int):
 		'timestamp': order_date
 	}
 
-def list_order_items(cur: Cursor, order_id: int):
-	""" List the items ordered in an order. """
+@metrics.timed_action
+def list_order_items(
+	cur: Cursor, order_id: int,
+	limit: int | None = None, after: tuple[int, int] | None = None
+):
+	"""
+	List the items ordered in an order.
+	Sorted by (item_id, variant_id). Pass `limit` to cap the number of rows, and
+	`after` to start after a given (item_id, variant_id).
+	"""
 	
-	cur.execute("""
+	(keyset, keyset_params) = paging.keyset_condition(['item_id', 'variant_id'], after)
+	(limit_sql, limit_params) = paging.limit_clause(limit)
+	
+	cur.execute(f"""
 		WITH this_order (item_id, variant_id, quantity) AS (
 			SELECT item_id, variant_id, quantity
 			FROM order_item
-			WHERE order_id = ? )
+			WHERE order_id = ?
+			AND {keyset}
+			ORDER BY item_id, variant_id
+			{limit_sql} )
 		SELECT
 			item_id, variant_id,
 			item_name,
@@ -821,8 +1030,9 @@ def list_order_items(cur: Cursor, order_id: int):
 			COALESCE(variant_image, item_image) AS image_id
 		FROM this_order JOIN (
 			variant_catalog JOIN item_catalog USING (item_id)
-		) USING (item_id, variant_id);
-	""", (order_id,))
+		) USING (item_id, variant_id)
+		ORDER BY item_id, variant_id;
+	""", [order_id] + keyset_params + limit_params)
 	
 	return [{
 		'id': { 'order': order_id, 'item': item_id, 'variant': variant_id },
@@ -0,0 +1,38 @@
+import re
+import hashlib
+
+# Address fingerprints.
+#
+# Every address row has an `address_key`: the SHA-256 of the address after
+# tidying it up (extra spaces dropped, street and city lowercased, state
+# uppercased), with a unique index on it. "12  Main St" and "12 main st" in the
+# same city are one address, and finding it is one index lookup.
+#
+# migrations/0004_address_key.sql computes the same thing in SQL for the rows
+# that were already there. Change one, change the other (and recompute).
+
+# Between the parts, so "1 Main St" + "Kent" can't collide with "1 Main" + "St Kent".
+_separator = '\x1f'
+
+# What `[[:space:]]` matches in the migration's REGEXP_REPLACE: ASCII
+# whitespace only. Python's str.split() and str.strip() would also take
+# Unicode spaces (like a no-break space), and the keys would stop matching.
+_spaces = re.compile('[ \t\n\v\f\r]+')
+
+def _tidy(text: str) -> str:
+	""" REGEXP_REPLACE(text, '[[:space:]]+', ' '), then TRIM (which only trims ' '). """
+	return _spaces.sub(' ', text).strip(' ')
+
+def normalize_address(street: str, city: str, state: str, zip: int) -> tuple[str, str, str, int]:
+	""" The address the way it's compared (not stored: rows keep what the customer typed). """
+	return (
+		_tidy(street).lower(),
+		_tidy(city).lower(),
+		state.strip(' ').upper(),
+		int(zip)
+	)
+
+def address_key(street: str, city: str, state: str, zip: int) -> bytes:
+	""" The 32 byte fingerprint that goes in `address.address_key`. """
+	text = _separator.join(map(str, normalize_address(street, city, state, zip)))
+	return hashlib.sha256(text.encode('utf-8')).digest()
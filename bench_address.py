@@ -0,0 +1,162 @@
+"""
+Benchmark for editing a customer's address as the `order` table grows.
+
+update_customer_address has to know whether anyone else uses the old address
+once the customer's moved off it. It used to count every customer and order
+pointing at it; now it reads address.ref_count (migrations/0003). This fills
+`order` up in steps, and at each size times:
+
+- editing an address only its customer uses (the old one gets deleted),
+- editing an address lots of orders use (the old one stays), and
+- the old COUNT(*) check on both, for comparison.
+
+Runs against the real database in db.py (KSTORES_DB_* settings), with the
+migrations applied, so point it at a scratch copy -- it adds customers,
+addresses and a lot of orders.
+
+Run with `python bench_address.py --help` to see the options.
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+from mariadb import mariadb, Cursor
+
+import actions
+from db import db_config
+
+def legacy_check(cur: Cursor, customer_id: int, address_type: str) -> bool:
+	""" Whether the address would be cloned, worked out the way it was before ref_count. """
+	other_addr_type = 'shipping' if address_type == 'billing' else 'billing'
+	cur.execute(f"""
+		SELECT {address_type}_address
+		FROM customer
+		WHERE customer_id = ?;
+		""", (customer_id,))
+	(address_id,) = cur.fetchone()
+	cur.execute(f"""
+		SELECT COUNT(*)
+		FROM customer
+		WHERE {other_addr_type}_address = ?
+		OR (customer_id <> ?
+		AND {address_type}_address = ?);
+		""", (address_id, customer_id, address_id))
+	if cur.fetchone()[0] > 0:
+		return True
+	cur.execute("""
+		SELECT COUNT(*)
+		FROM `order`
+		WHERE shipping_address = ?
+		OR billing_address = ?;
+		""", (address_id, address_id))
+	return cur.fetchone()[0] > 0
+
+def add_orders(conn, cur: Cursor, customer_id: int, addresses: list[int], count: int, chunk: int = 10000):
+	""" Adds `count` empty orders for `customer_id`, shipped to `addresses` in turn. """
+	for start in range(0, count, chunk):
+		rows = [
+			(customer_id, addresses[i % len(addresses)], addresses[i % len(addresses)])
+			for i in range(start, min(start + chunk, count))
+		]
+		cur.executemany("""
+			INSERT INTO `order` (
+				customer_id, order_date,
+				shipping_address, billing_address,
+				total_price, total_weight, status
+			) VALUES (?, NOW(), ?, ?, 0, 0, 'delivered');
+		""", rows)
+		conn.commit()
+
+def time_ms(conn, fn, repeat: int, before=None) -> float:
+	""" Median milliseconds for `fn()` (and a commit), calling `before()` first each time, untimed. """
+	times = []
+	for _ in range(repeat):
+		if before is not None:
+			before()
+			conn.commit()
+		start = time.perf_counter()
+		fn()
+		conn.commit()
+		times.append((time.perf_counter() - start) * 1000)
+	return statistics.median(times)
+
+def run(sizes: list[int], repeat: int, popular_share: float) -> list[dict]:
+	conn = mariadb.connect(**db_config)
+	cur = conn.cursor()
+	run_id = f"{int(time.time())}-{os.getpid()}"
+	
+	def new_customer(name: str, shipping: int, billing: int | None) -> int:
+		return actions.create_customer(cur,
+			'bench', None, name,
+			f"bench-address-{run_id}-{name}@test.tld", 'hunter2',
+			'3300000000',
+			shipping, billing
+		)
+	
+	# Everyone's orders go to one of these; `popular` gets `popular_share` of them
+	# (think of a pickup point), the rest are spread out.
+	popular = actions.create_address(cur, f"{run_id} pickup point", 'Kent', 'OH', 44240)
+	spread = [ actions.create_address(cur, f"{run_id} {i} filler st", 'Kent', 'OH', 44240) for i in range(100) ]
+	filler_customer = new_customer('filler', spread[0], spread[0])
+	
+	# Nothing else points at its shipping address (not even its own billing
+	# address), so every edit deletes the old one.
+	solo_customer = new_customer('solo', actions.create_address(cur, f"{run_id} solo st", 'Kent', 'OH', 44240), None)
+	# Lives at the popular address, which stays. Moved back before each edit.
+	shared_customer = new_customer('shared', popular, popular)
+	conn.commit()
+	
+	def move_back():
+		cur.execute("UPDATE customer SET shipping_address = ? WHERE customer_id = ?;", (popular, shared_customer))
+	
+	edits = 0
+	def edit(customer_id: int):
+		nonlocal edits
+		edits += 1
+		actions.update_customer_address(cur, customer_id, 'shipping', street=f"{run_id} {edits} moved st")
+	
+	results = []
+	added = 0
+	for size in sizes:
+		if size > added:
+			popular_count = int((size - added) * popular_share)
+			add_orders(conn, cur, filler_customer, [popular], popular_count)
+			add_orders(conn, cur, filler_customer, spread, size - added - popular_count)
+			added = size
+		cur.execute("SELECT COUNT(*) FROM `order`;")
+		(orders,) = cur.fetchone()
+		
+		result = {
+			'orders': orders,
+			'edit_unshared': time_ms(conn, lambda: edit(solo_customer), repeat),
+			'edit_shared': time_ms(conn, lambda: edit(shared_customer), repeat, before=move_back),
+			'legacy_check_unshared': time_ms(conn, lambda: legacy_check(cur, solo_customer, 'shipping'), repeat),
+			'legacy_check_shared': time_ms(conn, lambda: legacy_check(cur, shared_customer, 'shipping'), repeat, before=move_back),
+		}
+		results.append(result)
+		print(
+			f"{orders:>10,} orders: edit {result['edit_unshared']:7.2f} ms unshared, {result['edit_shared']:7.2f} ms shared"
+			f" | old check {result['legacy_check_unshared']:7.2f} ms, {result['legacy_check_shared']:7.2f} ms",
+			file=sys.stderr
+		)
+	
+	cur.close()
+	conn.close()
+	return results
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Times address edits as the order table grows.")
+	parser.add_argument('--sizes', type=lambda s: [ int(n) for n in s.split(',') ], default=[ 0, 10_000, 100_000, 1_000_000 ],
+		help="orders to add up to before each round of timing, like 0,10000,100000 (counting only this run's orders)")
+	parser.add_argument('--repeat', type=int, default=50, help="edits to time at each size")
+	parser.add_argument('--popular-share', type=float, default=0.1, help="share of the added orders that go to the one shared address")
+	args = parser.parse_args()
+	
+	try:
+		run(sorted(args.sizes), args.repeat, args.popular_share)
+	except mariadb.Error as e:
+		print(f"Database Error:\n{e}")
+		sys.exit(1)
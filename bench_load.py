@@ -0,0 +1,385 @@
+"""
+Load benchmark for the whole backend: seeds a dataset, then hammers the routes
+with a mix of what shoppers do (browse, search, fill carts, check out, look at
+their orders) from several threads at once, and reports requests per second
+and p50/p95/p99 latency per route.
+
+Runs against the real database in db.py (KSTORES_DB_* settings), so point it at
+a scratch copy -- it adds customers, items and orders. (There's no in-memory
+stand-in for MariaDB: the actions use MariaDB-only SQL like ON DUPLICATE KEY
+UPDATE and SELECT ... FOR UPDATE, so anything else wouldn't measure much.)
+
+By default requests go through Flask's test client, in this process. With
+--url, they go over HTTP to a server that's already running instead (say,
+gunicorn), which measures the whole stack. Shoppers send sign-in tokens made
+here, so that server needs the same KSTORES_SECRET.
+
+Results are saved as JSON. Pass an earlier result to --compare to see what got
+faster or slower; it exits with status 1 if any route's p95 got worse by more
+than --tolerance.
+
+Run with `python bench_load.py --help` to see the options.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+import http.client
+from collections.abc import Callable
+from urllib.parse import urlencode, urlsplit
+
+from mariadb import mariadb
+
+import actions
+import session
+from db import db_config
+
+categories = [ 'shirt', 'pants', 'hat', 'shoes', 'jacket', 'bag' ]
+colors = [ 'Red', 'Blue', 'Green', 'Black', 'White', 'Navy', 'Grey' ]
+sizes = [ 'XS', 'S', 'M', 'L', 'XL' ]
+words = [ 'kent', 'golden', 'flash', 'classic', 'vintage', 'sport', 'campus', 'cozy', 'team', 'retro' ]
+
+# How often each kind of visit happens, relative to the others.
+default_mix = {
+	'browse': 30,
+	'search': 25,
+	'cart_info': 15,
+	'add_to_cart': 12,
+	'cart_list': 5,
+	'checkout': 3,
+	'order_list': 7,
+	'order_get': 3,
+}
+
+def seed(customers: int, items: int, orders_per_customer: int, chunk: int = 500) -> dict:
+	"""
+	Adds `items` catalog items (a few variants each, with plenty of stock) and
+	`customers` customers, each with `orders_per_customer` orders already placed.
+	Returns the ids the benchmark needs, and a sign-in token for each customer
+	(made directly, so signing in doesn't count towards the results).
+	"""
+	conn = mariadb.connect(**db_config)
+	cur = conn.cursor()
+	run = f"{int(time.time())}-{os.getpid()}"
+	rng = random.Random(run)
+	
+	item_ids: list[int] = []
+	variant_counts: dict[int, int] = {}
+	for i in range(items):
+		name = f"{rng.choice(words).title()} {rng.choice(words).title()} {rng.choice(categories).title()}"
+		variants = [
+			(size, color, round(rng.uniform(5, 80), 2), round(rng.uniform(0.2, 3), 2), 1_000_000)
+			for size in rng.sample(sizes, rng.randint(1, 4))
+			for color in rng.sample(colors, rng.randint(1, 2))
+		]
+		item_id = actions.create_catalog_item(cur, name, f"Benchmark item {i}.", rng.choice(categories), variants)
+		item_ids.append(item_id)
+		variant_counts[item_id] = len(variants)
+		if (i + 1) % chunk == 0:
+			conn.commit()
+	conn.commit()
+	
+	customer_ids: list[int] = []
+	order_ids: dict[int, list[int]] = {}
+	for c in range(customers):
+		address = actions.create_address(cur, f"{c} bench st", 'Kent', 'OH', 44240)
+		customer_id = actions.create_customer(cur,
+			'bench', None, f"shopper {c}",
+			f"bench-{run}-{c}@test.tld", 'hunter2',
+			'3300000000',
+			address, address
+		)
+		customer_ids.append(customer_id)
+		order_ids[customer_id] = []
+		for _ in range(orders_per_customer):
+			item_id = rng.choice(item_ids)
+			actions.add_to_cart(cur, customer_id, item_id, rng.randrange(variant_counts[item_id]), rng.randint(1, 3))
+			order_ids[customer_id].append(actions.place_order(cur, customer_id))
+		if (c + 1) % chunk == 0:
+			conn.commit()
+	conn.commit()
+	
+	cur.close()
+	conn.close()
+	tokens = { customer_id: session.create_token(customer_id) for customer_id in customer_ids }
+	return { 'items': variant_counts, 'customers': customer_ids, 'orders': order_ids, 'tokens': tokens }
+
+class TestClientDriver:
+	""" Sends requests through Flask's test client, in this process. """
+	
+	def __init__(self):
+		import main
+		self.client = main.app.test_client()
+	
+	def request(self, method: str, path: str, params: dict, token: str | None = None) -> tuple[int, dict | None]:
+		headers = { 'Authorization': f"Bearer {token}" } if token else {}
+		if method == 'GET':
+			response = self.client.get(path, query_string=params, headers=headers)
+		else:
+			response = self.client.post(path, data=params, headers=headers)
+		return (response.status_code, response.get_json(silent=True))
+
+class HTTPDriver:
+	""" Sends requests to a running server, over one keep-alive connection. """
+	
+	def __init__(self, url: str):
+		parts = urlsplit(url)
+		self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+	
+	def request(self, method: str, path: str, params: dict, token: str | None = None) -> tuple[int, dict | None]:
+		body = None
+		headers = { 'Authorization': f"Bearer {token}" } if token else {}
+		if method == 'GET':
+			path += '?' + urlencode(params, doseq=True)
+		else:
+			body = urlencode(params, doseq=True)
+			headers['Content-Type'] = 'application/x-www-form-urlencoded'
+		try:
+			self.conn.request(method, path, body, headers)
+			response = self.conn.getresponse()
+			data = response.read()
+		except (OSError, http.client.HTTPException):
+			# The server dropped the connection; start a new one next time.
+			self.conn.close()
+			return (0, None)
+		try:
+			return (response.status, json.loads(data))
+		except ValueError:
+			return (response.status, None)
+
+class Shopper:
+	""" One simulated customer's visits. Each visit is one or two requests. """
+	
+	def __init__(self, driver, data: dict, rng: random.Random):
+		self.driver = driver
+		self.rng = rng
+		self.items = list(data['items'].items())
+		self.customer = rng.choice(data['customers'])
+		self.token = data['tokens'][self.customer]
+		self.orders = list(data['orders'][self.customer])
+		self.cart_items = 0
+	
+	def some_item(self) -> tuple[int, int]:
+		# A few items get most of the attention, like in a real store.
+		index = min(int(self.rng.paretovariate(1.2)) - 1, len(self.items) - 1)
+		return self.items[index]
+	
+	def browse(self, send):
+		send('GET', '/catalog/get', { 'item': self.some_item()[0] })
+	
+	def search(self, send):
+		params = {}
+		if self.rng.random() < 0.5:
+			params['category'] = self.rng.choice(categories)
+		if self.rng.random() < 0.3:
+			params['size'] = self.rng.sample(sizes, 2)
+		if self.rng.random() < 0.3:
+			params['color'] = self.rng.choice(colors)
+		if self.rng.random() < 0.3:
+			params['name'] = self.rng.choice(words)
+		if self.rng.random() < 0.2:
+			params['maxprice'] = self.rng.randint(10, 60)
+		params['limit'] = 20
+		send('GET', '/catalog/search', params)
+	
+	def cart_info(self, send):
+		send('GET', '/cart/info', { 'customer': self.customer }, self.token)
+	
+	def cart_list(self, send):
+		send('GET', '/cart/list', { 'customer': self.customer, 'limit': 50 }, self.token)
+	
+	def add_to_cart(self, send):
+		(item, variant_count) = self.some_item()
+		send('POST', '/cart/add', {
+			'customer': self.customer,
+			'item': item, 'variant': self.rng.randrange(variant_count),
+			'quantity': self.rng.randint(1, 3)
+		}, self.token)
+		self.cart_items += 1
+	
+	def checkout(self, send):
+		if self.cart_items == 0:
+			self.add_to_cart(send)
+		result = send('POST', '/cart/checkout', { 'customer': self.customer }, self.token)
+		if result and result.get('success'):
+			self.orders.append(result['order'])
+			self.cart_items = 0
+	
+	def order_list(self, send):
+		send('GET', '/order/list', { 'customer': self.customer, 'limit': 20 }, self.token)
+	
+	def order_get(self, send):
+		if not self.orders:
+			return self.order_list(send)
+		send('GET', '/order/get', { 'order': self.rng.choice(self.orders) })
+
+def percentile(ordered: list[float], p: float) -> float:
+	""" The nearest-rank percentile of an already sorted list. """
+	if not ordered:
+		return 0.0
+	return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def summarize(latencies: list[float], errors: int, seconds: float) -> dict:
+	ordered = sorted(latencies)
+	return {
+		'requests': len(ordered),
+		'errors': errors,
+		'rps': len(ordered) / seconds if seconds else 0.0,
+		'mean_ms': 1000 * sum(ordered) / len(ordered) if ordered else 0.0,
+		'p50_ms': 1000 * percentile(ordered, 50),
+		'p95_ms': 1000 * percentile(ordered, 95),
+		'p99_ms': 1000 * percentile(ordered, 99),
+		'max_ms': 1000 * ordered[-1] if ordered else 0.0,
+	}
+
+def run(
+	data: dict, make_driver: Callable[[], object],
+	mix: dict[str, int], threads: int,
+	duration: float, warmup: float
+) -> dict:
+	"""
+	Runs `threads` shoppers for `warmup` + `duration` seconds. Only requests
+	that start after the warmup count.
+	"""
+	visits = list(mix)
+	weights = [ mix[v] for v in visits ]
+	# route -> (latencies, error count), per thread, merged at the end.
+	per_thread: list[dict[str, tuple[list[float], list[int]]]] = []
+	start = time.perf_counter()
+	measure_from = start + warmup
+	stop_at = measure_from + duration
+	
+	def shopper(seed: int):
+		rng = random.Random(seed)
+		driver = make_driver()
+		results: dict[str, tuple[list[float], list[int]]] = {}
+		per_thread.append(results)
+		
+		def send(method: str, path: str, params: dict, token: str | None = None):
+			began = time.perf_counter()
+			(status, body) = driver.request(method, path, params, token) # type: ignore
+			ended = time.perf_counter()
+			if began >= measure_from:
+				(latencies, errors) = results.setdefault(path, ([], [0]))
+				latencies.append(ended - began)
+				if status != 200 or not (body and body.get('success')):
+					errors[0] += 1
+			return body
+		
+		while time.perf_counter() < stop_at:
+			# Every so often, a different customer shows up.
+			user = Shopper(driver, data, rng)
+			for _ in range(rng.randint(5, 30)):
+				if time.perf_counter() >= stop_at:
+					break
+				getattr(user, rng.choices(visits, weights)[0])(send)
+	
+	workers = [ threading.Thread(target=shopper, args=(i,)) for i in range(threads) ]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	
+	merged: dict[str, tuple[list[float], int]] = {}
+	for results in per_thread:
+		for (path, (latencies, errors)) in results.items():
+			(all_latencies, all_errors) = merged.get(path, ([], 0))
+			merged[path] = (all_latencies + latencies, all_errors + errors[0])
+	
+	routes = { path: summarize(latencies, errors, duration) for (path, (latencies, errors)) in sorted(merged.items()) }
+	return {
+		'routes': routes,
+		'total': summarize(
+			[ l for (latencies, _) in merged.values() for l in latencies ],
+			sum(errors for (_, errors) in merged.values()),
+			duration
+		)
+	}
+
+def print_report(results: dict):
+	print(f"{'route':<18} {'reqs':>7} {'errs':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+	for (path, r) in [ *results['routes'].items(), ('(all)', results['total']) ]:
+		print(f"{path:<18} {r['requests']:>7} {r['errors']:>5} {r['rps']:>8.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+	""" Prints how each route changed since `baseline`. Returns False if any p95 got worse by more than `tolerance`. """
+	ok = True
+	print(f"\n{'route':<18} {'rps':>18} {'p95 ms':>20}")
+	for (path, r) in [ *results['routes'].items(), ('(all)', results['total']) ]:
+		old = baseline['total'] if path == '(all)' else baseline['routes'].get(path)
+		if old is None:
+			continue
+		change = (r['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+		regressed = change > tolerance
+		ok = ok and not regressed
+		print(
+			f"{path:<18} {old['rps']:>8.1f} -> {r['rps']:>7.1f} "
+			f"{old['p95_ms']:>8.2f} -> {r['p95_ms']:>7.2f} ({change:+.0%})"
+			+ ("  SLOWER" if regressed else "")
+		)
+	return ok
+
+def parse_mix(text: str) -> dict[str, int]:
+	""" Reads a mix like "browse=50,search=50" on top of the default one. """
+	mix = dict(default_mix)
+	for part in filter(None, text.split(',')):
+		(visit, weight) = part.split('=')
+		if visit not in default_mix:
+			raise argparse.ArgumentTypeError(f"unknown visit {visit!r} (know {', '.join(default_mix)})")
+		mix[visit] = int(weight)
+	return mix
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Seeds the database, then load-tests every route and reports throughput and latency.")
+	parser.add_argument('--customers', type=int, default=200, help="customers to add")
+	parser.add_argument('--items', type=int, default=500, help="catalog items to add (each with a few variants)")
+	parser.add_argument('--orders', type=int, default=2, help="orders each new customer starts with")
+	parser.add_argument('--threads', type=int, default=8, help="shoppers at once")
+	parser.add_argument('--duration', type=float, default=30, help="seconds to measure for")
+	parser.add_argument('--warmup', type=float, default=5, help="seconds to run before measuring")
+	parser.add_argument('--mix', type=parse_mix, default=default_mix,
+		help=f"how often each visit happens, like browse=50,checkout=0 (default: {','.join(f'{k}={v}' for (k, v) in default_mix.items())})")
+	parser.add_argument('--url', help="send requests to a running server at this URL, instead of through the test client")
+	parser.add_argument('--out', help="where to save the results (default: bench-results/load-<time>.json)")
+	parser.add_argument('--compare', help="earlier results to compare against")
+	parser.add_argument('--tolerance', type=float, default=0.2, help="how much worse p95 may get before --compare fails (0.2 = 20%%)")
+	args = parser.parse_args()
+	
+	try:
+		print(f"seeding {args.customers} customers and {args.items} items...", file=sys.stderr)
+		start = time.perf_counter()
+		data = seed(args.customers, args.items, args.orders)
+		seed_seconds = time.perf_counter() - start
+		print(f"seeded in {seed_seconds:.1f}s", file=sys.stderr)
+	except mariadb.Error as e:
+		print(f"Database Error:\n{e}")
+		sys.exit(1)
+	
+	make_driver = (lambda: HTTPDriver(args.url)) if args.url else TestClientDriver
+	print(f"running {args.threads} shoppers for {args.warmup:g}s + {args.duration:g}s...", file=sys.stderr)
+	results = run(data, make_driver, args.mix, args.threads, args.duration, args.warmup)
+	results['config'] = {
+		'customers': args.customers, 'items': args.items, 'orders': args.orders,
+		'threads': args.threads, 'duration': args.duration, 'warmup': args.warmup,
+		'mix': args.mix, 'target': args.url or 'test client',
+		'seed_seconds': seed_seconds
+	}
+	results['finished_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+	print_report(results)
+	
+	out = args.out or os.path.join('bench-results', time.strftime('load-%Y%m%d-%H%M%S.json'))
+	os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+	with open(out, 'w') as f:
+		json.dump(results, f, indent='\t')
+	print(f"saved to {out}", file=sys.stderr)
+	
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		if not compare(results, baseline, args.tolerance):
+			sys.exit(1)
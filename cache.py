@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+class LRUCache:
+	"""
+	A small thread-safe cache. Holds at most `max_size` entries, throwing out
+	the least recently used one when it's full. If `ttl` is given, entries
+	older than that many seconds count as missing.
+	Keeps hit/miss counts, so you can tell if it's the right size.
+	"""
+	
+	def __init__(self, max_size: int = 1024, ttl: float | None = None):
+		self.max_size = max_size
+		self.ttl = ttl
+		self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def get(self, key: Hashable, default: Any = None) -> Any:
+		""" Returns the cached value for `key`, or `default` if there isn't one. """
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None \
+			and self.ttl is not None \
+			and time.monotonic() - entry[0] > self.ttl:
+				del self._entries[key]
+				entry = None
+			if entry is None:
+				self.misses += 1
+				return default
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return entry[1]
+	
+	def put(self, key: Hashable, value: Any):
+		""" Stores `value` under `key`, evicting the oldest entry if the cache is full. """
+		with self._lock:
+			self._entries[key] = (time.monotonic(), value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+	
+	def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+		""" Returns the cached value for `key`, calling `load()` to fill it in on a miss. """
+		missing = object()
+		value = self.get(key, missing)
+		if value is missing:
+			value = load()
+			self.put(key, value)
+		return value
+	
+	def pop(self, key: Hashable):
+		""" Forgets `key`, if it's cached. """
+		with self._lock:
+			self._entries.pop(key, None)
+	
+	def clear(self):
+		""" Forgets everything. """
+		with self._lock:
+			self._entries.clear()
+	
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				'size': len(self._entries),
+				'max_size': self.max_size,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions
+			}
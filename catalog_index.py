@@ -0,0 +1,492 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from heapq import heapify, heappop
+from itertools import islice
+
+from mariadb import Cursor
+
+import metrics
+from cache import LRUCache
+from textsearch import TextIndex
+
+# In-memory copy of the catalog, used to answer `/catalog/search` without
+# running a fresh `variant_catalog JOIN item_catalog` scan for every request.
+#
+# Every variant gets a position (its row number when sorted by item_id then
+# variant_id), and each filter turns into a bitmap over those positions,
+# stored in a plain Python int. Filters are ANDed together, values inside a
+# filter are ORed, and the surviving bits are read back out in key order.
+
+# Writes made through `actions` invalidate the index once they commit. Writes
+# made anywhere else (other workers, the mysql CLI, ...) bump the catalog's
+# `updated` columns (migrations/0008), which get checked every
+# `check_interval` seconds, so they show up within about that long.
+check_interval = 2.0
+
+# How long (in seconds) an index is trusted before it gets rebuilt anyway.
+# A backstop for the one thing the check above can miss: a transaction that
+# was still open when the index was built, committing with an older `updated`.
+max_age = 60.0
+
+# Relevance scores go in cursors as whole numbers of millionths, negated so
+# the best come first in key order.
+def relevance_key(score: float) -> int:
+	return -round(score * 1_000_000)
+
+# Name searches remembered per index, since a bitmap over a big catalog takes a
+# while to build. Each one is a bit per variant, so 256 of them at 300,000
+# variants come to about 10MB.
+name_mask_cache_size = 256
+
+# The order of variant_catalog.size's ENUM, which is how SQL sorts sizes.
+_size_order = { size: i for (i, size) in enumerate(['N/A', 'XS', 'S', 'M', 'L', 'XL']) }
+
+def _trigrams(s: str) -> set[str]:
+	return { s[i:i+3] for i in range(len(s) - 2) }
+
+def _bitmap(n: int, positions) -> int:
+	""" Turns a bunch of positions into a bitmap int, without shifting a huge int per position. """
+	bits = bytearray((n + 7) // 8)
+	for p in positions:
+		bits[p >> 3] |= 1 << (p & 7)
+	return int.from_bytes(bits, 'little')
+
+def _ranges_bitmap(n: int, ranges) -> int:
+	"""
+	Turns non-overlapping (start, end) ranges into a bitmap, touching each range
+	twice rather than each position: ranges covering the bits from `start` up to
+	`end` are (1 << end) - (1 << start), and adding those up is one subtraction.
+	"""
+	starts = bytearray(n // 8 + 1)
+	ends = bytearray(n // 8 + 1)
+	for (start, end) in ranges:
+		starts[start >> 3] |= 1 << (start & 7)
+		ends[end >> 3] |= 1 << (end & 7)
+	return int.from_bytes(ends, 'little') - int.from_bytes(starts, 'little')
+
+class CatalogIndex:
+	"""
+	A read-only snapshot of the catalog. Build a new one instead of editing it,
+	so searches running on other threads never see a half-updated index.
+	"""
+	
+	def __init__(
+		self, rows: list[tuple], texts: list[tuple] | None = None, text: TextIndex | None = None,
+		version: tuple | None = None
+	):
+		# rows: (item_id, variant_id, item_name, category, size, color, price, weight, image_id, stock)
+		# already sorted by (item_id, variant_id).
+		# texts: (item_id, item_name, description), for relevance search. Pass
+		# `text` to reuse an existing TextIndex that was built from the same texts.
+		# version: `catalog_version()` from just before the rows were read.
+		self.rows = rows
+		self.version = version
+		self.size = len(rows)
+		self.keys = [ (row[0], row[1]) for row in rows ]
+		self.everything = (1 << self.size) - 1
+		
+		# Low-cardinality facets: the positions with each value, turned into
+		# bitmaps once they're all collected (ORing in one bit at a time
+		# would copy the whole int for every row).
+		categories: dict[str, list[int]] = {}
+		sizes: dict[str, list[int]] = {}
+		colors: dict[str, list[int]] = {}
+		instock: list[int] = []
+		# item_id -> (first, last + 1) position of its variants
+		self.item_ranges: dict[int, tuple[int, int]] = {}
+		
+		# Item names: one entry per distinct (lowercased) name, with the ranges
+		# of positions its variants occupy, and a trigram index over the names.
+		name_ids: dict[str, int] = {}
+		self.names: list[str] = []
+		self.name_ranges: list[list[tuple[int, int]]] = []
+		self.trigrams: dict[str, set[int]] = {}
+		self.name_masks = LRUCache(max_size=name_mask_cache_size)
+		
+		for (pos, row) in enumerate(rows):
+			(item_id, variant_id, item_name, category, size, color, price, weight, image_id, stock) = row
+			
+			if category is not None:
+				categories.setdefault(category.lower(), []).append(pos)
+			if size is not None:
+				sizes.setdefault(size.lower(), []).append(pos)
+			if color is not None:
+				colors.setdefault(color.lower(), []).append(pos)
+			if stock > 0:
+				instock.append(pos)
+			(first, _) = self.item_ranges.get(item_id, (pos, pos))
+			self.item_ranges[item_id] = (first, pos + 1)
+			
+			name = (item_name or "").lower()
+			if name not in name_ids:
+				name_ids[name] = len(self.names)
+				self.names.append(name)
+				self.name_ranges.append([])
+				for gram in _trigrams(name):
+					self.trigrams.setdefault(gram, set()).add(name_ids[name])
+			ranges = self.name_ranges[name_ids[name]]
+			if ranges and ranges[-1][1] == pos:
+				# variants of one item are next to each other, so just extend the range
+				ranges[-1] = (ranges[-1][0], pos + 1)
+			else:
+				ranges.append((pos, pos + 1))
+		
+		self.categories = { key: _bitmap(self.size, found) for (key, found) in categories.items() }
+		self.sizes = { key: _bitmap(self.size, found) for (key, found) in sizes.items() }
+		self.colors = { key: _bitmap(self.size, found) for (key, found) in colors.items() }
+		self.instock = _bitmap(self.size, instock)
+		
+		# Price is a sorted array facet: binary search for the range,
+		# then turn the positions inside it into a bitmap.
+		by_price = sorted(range(self.size), key=lambda pos: rows[pos][6])
+		self.prices = [ rows[pos][6] for pos in by_price ]
+		self.price_positions = by_price
+		
+		self.texts = texts = texts or []
+		self.text_items = [ item_id for (item_id, _, _) in texts ]
+		self.text = text if text is not None else TextIndex([ (name, description) for (_, name, description) in texts ])
+	
+	@classmethod
+	def load(cls, cur: Cursor, previous: 'CatalogIndex | None' = None) -> 'CatalogIndex':
+		"""
+		Reads the whole catalog out of the database. Reuses `previous`'s text
+		index if no item's name or description changed (most rebuilds are for
+		stock or prices), since that's the slow part to build.
+		"""
+		# Before the rows, so anything written while they're read gets
+		# picked up by the next check.
+		version = catalog_version(cur)
+		cur.execute("""
+			SELECT
+				item_id, variant_id,
+				item_name, category,
+				size, color,
+				price, weight,
+				COALESCE(variant_image, item_image) AS image_id,
+				stock
+			FROM variant_catalog JOIN item_catalog USING (item_id)
+			ORDER BY item_id, variant_id;
+			""")
+		rows = list(cur)
+		cur.execute("""
+			SELECT item_id, item_name, description
+			FROM item_catalog
+			ORDER BY item_id;
+			""")
+		texts = list(cur)
+		text = previous.text if previous is not None and previous.texts == texts else None
+		return cls(rows, texts, text, version)
+	
+	def _name_mask(self, term: str) -> int:
+		""" Same as `item_name LIKE '%term%'`, but only looks at distinct names. """
+		term = term.lower()
+		return self.name_masks.get_or_load(term, lambda: self._find_name_mask(term))
+	
+	def _find_name_mask(self, term: str) -> int:
+		if len(term) >= 3:
+			# Only names containing every trigram of the term can contain the term.
+			candidates = None
+			for gram in sorted(_trigrams(term), key=lambda g: len(self.trigrams.get(g, ()))):
+				found = self.trigrams.get(gram)
+				if not found:
+					return 0
+				candidates = set(found) if candidates is None else candidates & found
+				if not candidates:
+					return 0
+		else:
+			candidates = range(len(self.names))
+		
+		found = []
+		for name_id in candidates: # type: ignore
+			if term in self.names[name_id]:
+				found.extend(self.name_ranges[name_id])
+		return _ranges_bitmap(self.size, found)
+	
+	def _price_mask(self, low=None, high=None) -> int:
+		start = 0 if low is None else bisect_left(self.prices, low)
+		end = self.size if high is None else bisect_right(self.prices, high)
+		if end <= start:
+			return 0
+		if (end - start) * 2 > self.size:
+			# cheaper to build the bitmap of what's outside the range
+			outside = self.price_positions[:start] + self.price_positions[end:]
+			return self.everything & ~_bitmap(self.size, outside)
+		return _bitmap(self.size, self.price_positions[start:end])
+	
+	def match(self, **filters) -> int:
+		"""
+		Returns the bitmap of variants matching the filters.
+		Filters are `name` (substring), `category`, `size` and `color` (any of
+		the given values, ignoring case), `minprice`, `maxprice` and `instock`.
+		"""
+		mask = self.everything
+		
+		def any_of(facet: dict[str, int], values, normalize) -> int:
+			found = 0
+			for value in values:
+				found |= facet.get(normalize(value), 0)
+			return found
+		
+		for (f, p) in filters.items():
+			if not p:
+				continue
+			values = p if isinstance(p, list) else [p]
+			
+			if f == 'name':
+				found = 0
+				for value in values:
+					found |= self._name_mask(str(value))
+				mask &= found
+			elif f == 'category':
+				mask &= any_of(self.categories, values, lambda v: str(v).lower())
+			elif f == 'size':
+				mask &= any_of(self.sizes, values, lambda v: str(v).lower())
+			elif f == 'color':
+				mask &= any_of(self.colors, values, lambda v: str(v).lower())
+			elif f == 'minprice':
+				mask &= self._price_mask(low=max(float(v) for v in values))
+			elif f == 'maxprice':
+				mask &= self._price_mask(high=min(float(v) for v in values))
+			elif f == 'instock':
+				mask &= self.instock
+			else:
+				raise KeyError(f)
+			
+			if not mask:
+				break
+		return mask
+	
+	def positions(self, mask: int, start: int = 0):
+		""" Yields the positions set in `mask` from `start` on, in (item_id, variant_id) order. """
+		data = mask.to_bytes((self.size + 7) // 8, 'little')
+		for byte_index in range(start >> 3, len(data)):
+			byte = data[byte_index]
+			if byte_index == start >> 3:
+				byte &= 0xff << (start & 7)
+			while byte:
+				low = byte & -byte
+				yield (byte_index << 3) + low.bit_length() - 1
+				byte ^= low
+	
+	def ranked(self, q: str, mask: int, after: tuple[int, ...] | None = None):
+		"""
+		Yields (relevance, position) for the positions set in `mask` whose item
+		matches the words in `q`, best first, then in key order. `after` is the
+		(relevance_key, item_id, variant_id) to start after.
+		"""
+		data = mask.to_bytes((self.size + 7) // 8, 'little')
+		heap = []
+		for (doc, score) in self.text.scores(q).items():
+			item_id = self.text_items[doc]
+			key = relevance_key(score)
+			if item_id in self.item_ranges \
+			and (after is None or (key, item_id) >= tuple(after[:2])):
+				heap.append((key, item_id))
+		# Heap rather than sort: a page usually only needs the first few.
+		heapify(heap)
+		while heap:
+			(key, item_id) = heappop(heap)
+			(first, end) = self.item_ranges[item_id]
+			for pos in range(first, end):
+				if not data[pos >> 3] & (1 << (pos & 7)):
+					continue
+				if after is not None and (key, item_id, self.keys[pos][1]) <= tuple(after):
+					continue
+				yield (-key / 1_000_000, pos)
+	
+	def search(
+		self,
+		limit: int | None = None, after: tuple[int, ...] | None = None,
+		q: str | None = None,
+		**filters
+	):
+		"""
+		The variants matching the filters (see `match`), sorted by (item_id,
+		variant_id). Pass `limit` to cap the number of rows, and `after` to start
+		after a given (item_id, variant_id).
+		With `q`, results are ordered by relevance to it (best first) instead,
+		and `after` is a (relevance_key, item_id, variant_id).
+		"""
+		mask = self.match(**filters)
+		if q:
+			found = list(islice(self.ranked(q, mask, after), limit))
+			return [
+				dict(self._variant(pos), score=score)
+				for (score, pos) in found
+			]
+		# Keyset pagination is just a binary search, since positions are in key order.
+		start = 0 if after is None else bisect_right(self.keys, tuple(after))
+		return [ self._variant(pos) for pos in islice(self.positions(mask, start), limit) ]
+	
+	def _variant(self, pos: int) -> dict:
+		(
+			item_id, variant_id,
+			item_name, category,
+			size, color,
+			price, weight,
+			image_id, stock
+		) = self.rows[pos]
+		return {
+			'id': { 'item': item_id, 'variant': variant_id },
+			'name': item_name,
+			'category': category,
+			'size': size, # warning: nullable!
+			'color': color, # warning: nullable!
+			'price': price,
+			'weight': weight,
+			'image': image_id,
+		}
+	
+	def search_items(
+		self,
+		limit: int | None = None, after: tuple[int, ...] | None = None,
+		q: str | None = None,
+		**filters
+	):
+		"""
+		The same search as `search`, with the matching variants grouped into
+		one entry per item: their ids, price range, and the sizes and colors
+		they come in. The image is the first matching variant's. Sorted by
+		item_id, and `after` is an (item_id,). With `q`, items are ordered by
+		relevance, like in `search`, and `after` is a (relevance_key, item_id).
+		"""
+		# Variants of an item are next to each other (in relevance order too),
+		# so it's one pass over the matches, finishing an item whenever the
+		# next one starts.
+		mask = self.match(**filters)
+		if q:
+			found = self.ranked(q, mask, None if after is None else (after[0], after[1], float('inf')))
+		else:
+			start = 0 if after is None else bisect_left(self.keys, (after[0] + 1,))
+			found = ((None, pos) for pos in self.positions(mask, start))
+		items = []
+		current = None
+		for (score, pos) in found:
+			(item_id, variant_id, item_name, category, size, color, price, weight, image_id, stock) = self.rows[pos]
+			if current is None or current['id'] != item_id:
+				if limit is not None and len(items) >= limit:
+					break
+				current = {
+					'id': item_id,
+					'name': item_name,
+					'category': category,
+					'image': image_id,
+					'variants': [],
+					'price': { 'min': price, 'max': price },
+					'sizes': set(),
+					'colors': set()
+				}
+				if score is not None:
+					current['score'] = score
+				items.append(current)
+			current['variants'].append(variant_id)
+			current['price']['min'] = min(current['price']['min'], price)
+			current['price']['max'] = max(current['price']['max'], price)
+			if current['image'] is None:
+				current['image'] = image_id
+			if size is not None:
+				current['sizes'].add(size)
+			if color is not None:
+				current['colors'].add(color)
+		
+		for item in items:
+			item['sizes'] = sorted(item['sizes'], key=lambda size: _size_order.get(size, len(_size_order)))
+			item['colors'] = sorted(item['colors'], key=str.lower)
+		return items
+
+_index: CatalogIndex | None = None
+_built_at = 0.0
+_checked_at = 0.0
+_stale = True
+_lock = threading.RLock()
+
+def catalog_version(cur: Cursor) -> tuple:
+	"""
+	When the catalog last changed. Adding or changing rows in item_catalog or
+	variant_catalog moves it on (and so does deleting variants, through the
+	triggers from migrations/0005). It's two index lookups, so it's cheap to ask.
+	"""
+	cur.execute("""
+		SELECT
+			(SELECT MAX(updated) FROM item_catalog),
+			(SELECT MAX(updated) FROM variant_catalog);
+		""")
+	return tuple(cur.fetchone())
+
+def invalidate():
+	""" Marks the index as out of date. The next search will rebuild it. """
+	global _stale
+	_stale = True
+
+def refresh(cur: Cursor) -> CatalogIndex:
+	""" Rebuilds the index from the database right now. """
+	global _index, _built_at, _checked_at, _stale
+	with _lock:
+		# Cleared before loading, so an invalidate() that lands
+		# while we're reading still triggers another rebuild.
+		_stale = False
+		with metrics.action('catalog_index.refresh'):
+			_index = CatalogIndex.load(cur, _index)
+		_built_at = _checked_at = time.monotonic()
+		return _index
+
+def _check(cur: Cursor, index: CatalogIndex):
+	""" Marks the index stale if the catalog changed since it was built. One caller at a time. """
+	global _checked_at
+	if index.version is None or not _lock.acquire(blocking=False):
+		return
+	try:
+		if time.monotonic() - _checked_at > check_interval:
+			_checked_at = time.monotonic()
+			if catalog_version(cur) != index.version:
+				invalidate()
+	finally:
+		_lock.release()
+
+def get(cur: Cursor) -> CatalogIndex:
+	"""
+	Returns the current index. If it's stale, one caller rebuilds it while
+	everyone else keeps getting the old one; only the very first build
+	makes searches wait. Every `check_interval` seconds, one caller asks the
+	database whether anything changed.
+	"""
+	index = _index
+	if index is None:
+		with _lock:
+			# Someone else might've built it while we waited for the lock.
+			if _index is not None:
+				return _index
+			return refresh(cur)
+	if not _stale and time.monotonic() - _checked_at > check_interval:
+		_check(cur, index)
+	if _stale or time.monotonic() - _built_at > max_age:
+		if _lock.acquire(blocking=False):
+			try:
+				# Unless someone finished rebuilding it just before us.
+				if _stale or time.monotonic() - _built_at > max_age:
+					index = refresh(cur)
+				else:
+					index = _index
+			finally:
+				_lock.release()
+	return index
+
+def search(
+	cur: Cursor,
+	limit: int | None = None, after: tuple[int, int] | None = None,
+	**filters
+):
+	"""
+	Searches the catalog (see `CatalogIndex.search`) out of the in-memory
+	index. Only touches the database if the index needs rebuilding.
+	"""
+	return get(cur).search(limit, after, **filters)
+
+def search_items(
+	cur: Cursor,
+	limit: int | None = None, after: tuple[int] | None = None,
+	**filters
+):
+	""" Like `search`, but one entry per item (see `CatalogIndex.search_items`). """
+	return get(cur).search_items(limit, after, **filters)
@@ -0,0 +1,336 @@
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from mariadb import mariadb, Cursor, Connection, ConnectionPool
+
+import metrics
+import querylog
+
+db_config = {
+	'host': os.environ.get('KSTORES_DB_HOST', 'localhost'),
+	'port': int(os.environ.get('KSTORES_DB_PORT', 3306)),
+	'user': os.environ.get('KSTORES_DB_USER', 'root'),
+	'database': os.environ.get('KSTORES_DB_NAME', 'kstores')
+}
+if 'KSTORES_DB_PASSWORD' in os.environ:
+	db_config['password'] = os.environ['KSTORES_DB_PASSWORD']
+
+# How many connections the pool holds, and how long (in seconds)
+# a request will wait for one before giving up.
+pool_size = int(os.environ.get('KSTORES_POOL_SIZE', 16))
+pool_timeout = float(os.environ.get('KSTORES_POOL_TIMEOUT', 5))
+
+class Pool:
+	"""
+	Wraps mariadb's ConnectionPool. Instead of failing as soon as every
+	connection is taken, callers queue up and wait (up to a timeout) for one
+	to be returned. Also keeps track of how long callers waited, and how busy
+	the pool has been.
+	
+	The underlying pool isn't created until the first connection is needed.
+	"""
+	
+	def __init__(self, name: str, size: int, timeout: float, **config):
+		self.name = name
+		self.size = size
+		self.timeout = timeout
+		self.config = config
+		
+		self._pool: ConnectionPool | None = None
+		self._pool_lock = threading.Lock()
+		self._cond = threading.Condition()
+		self._in_use = 0
+		self._checked_out: dict[int, float] = {}
+		
+		self._created_at = time.monotonic()
+		self._acquired = 0
+		self._waited = 0
+		self._wait_total = 0.0
+		self._wait_max = 0.0
+		self._timeouts = 0
+		self._peak_in_use = 0
+		self._busy_total = 0.0
+	
+	def _get_pool(self) -> ConnectionPool:
+		pool = self._pool
+		if pool is None:
+			# Callers get here outside `_cond`, so the first few requests
+			# in a new worker could all try to make it at once.
+			with self._pool_lock:
+				if self._pool is None:
+					# mariadb wants pool names to be unique, and a forked
+					# worker still remembers the pools its parent made.
+					self._pool = mariadb.ConnectionPool(
+						pool_name = f"{self.name}_{os.getpid()}", pool_size = self.size,
+						**self.config
+					)
+				pool = self._pool
+		return pool
+	
+	def reset_after_fork(self):
+		"""
+		Forgets the parent process's connections, without closing them (that'd
+		close them for the parent too). Call this first thing in a forked worker.
+		"""
+		self._pool = None
+		self._pool_lock = threading.Lock()
+		self._cond = threading.Condition()
+		self._in_use = 0
+		self._checked_out = {}
+	
+	def close(self):
+		""" Closes every connection. Call this when the process is shutting down. """
+		with self._pool_lock:
+			if self._pool is not None:
+				self._pool.close()
+				self._pool = None
+	
+	def acquire(self, timeout: float | None = None) -> Connection:
+		""" Takes a connection out of the pool, waiting up to `timeout` seconds for one. """
+		timeout = self.timeout if timeout is None else timeout
+		start = time.monotonic()
+		deadline = start + timeout
+		
+		# First a slot, under the lock...
+		with self._cond:
+			while self._in_use >= self.size:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					self._timeouts += 1
+					metrics.count('kstores_pool_timeouts_total')
+					raise Exception(f"timed out after {timeout}s waiting for a database connection")
+				self._cond.wait(remaining)
+			self._in_use += 1
+			self._peak_in_use = max(self._peak_in_use, self._in_use)
+		
+		# ...then the connection itself, outside it (it may have to connect).
+		# Having a slot means one's free, but mariadb's pool can still come up
+		# empty for a moment, so try again until the deadline.
+		conn = None
+		try:
+			while True:
+				try:
+					conn = self._get_pool().get_connection()
+				except mariadb.PoolError:
+					conn = None
+				if conn is not None:
+					break
+				if time.monotonic() >= deadline:
+					self._timeouts += 1
+					metrics.count('kstores_pool_timeouts_total')
+					raise Exception("out of connections")
+				time.sleep(0.001)
+		finally:
+			if conn is None:
+				with self._cond:
+					self._in_use -= 1
+					self._cond.notify()
+		
+		waited = time.monotonic() - start
+		with self._cond:
+			self._checked_out[id(conn)] = time.monotonic()
+			self._acquired += 1
+			if waited > 0.001:
+				self._waited += 1
+			self._wait_total += waited
+			self._wait_max = max(self._wait_max, waited)
+		metrics.observe('kstores_pool_wait_seconds', (), waited)
+		return conn
+	
+	def release(self, conn: Connection):
+		""" Hands a connection from `acquire` back to the pool. """
+		# Back in mariadb's pool first, so whoever's woken up can have it.
+		try:
+			conn.close()
+		finally:
+			with self._cond:
+				taken_at = self._checked_out.pop(id(conn), None)
+				if taken_at is not None:
+					self._busy_total += time.monotonic() - taken_at
+				self._in_use -= 1
+				self._cond.notify()
+	
+	def gauges(self):
+		""" The pool's gauges for /metrics. """
+		return [
+			('kstores_pool_connections_in_use', (), self._in_use),
+			('kstores_pool_connections', (), self.size)
+		]
+	
+	def stats(self) -> dict:
+		""" How the pool's been doing since it was created. """
+		with self._cond:
+			now = time.monotonic()
+			busy = self._busy_total + sum(now - t for t in self._checked_out.values())
+			uptime = now - self._created_at
+			return {
+				'size': self.size,
+				'in_use': self._in_use,
+				'peak_in_use': self._peak_in_use,
+				'acquired': self._acquired,
+				'waited': self._waited,
+				'timeouts': self._timeouts,
+				'wait_seconds': {
+					'total': self._wait_total,
+					'max': self._wait_max,
+					'mean': self._wait_total / self._acquired if self._acquired else 0.0
+				},
+				# fraction of the pool's connection-seconds spent checked out
+				'utilization': busy / (uptime * self.size) if uptime > 0 else 0.0
+			}
+
+# Set up a connection pool
+pool = Pool('kstores_pool', pool_size, pool_timeout, **db_config)
+metrics.add_collector(pool.gauges)
+
+class RequestCursor:
+	"""
+	Stands in for a Cursor for the length of one request. It doesn't take a
+	connection out of the pool until something actually uses the cursor, so
+	requests that never touch the database never wait on the pool.
+	"""
+	
+	def __init__(self, pool: Pool, readonly: bool = False):
+		self.pool = pool
+		self.readonly = readonly
+		self._conn: Connection | None = None
+		self._cursor: Cursor | None = None
+		self._after_transaction: list = []
+		# statement -> how many times this request ran it
+		self._statements: Counter[str] = Counter()
+		# Whether everything run on the current connection was a plain
+		# SELECT, so there's nothing to lose by letting go of it.
+		self._only_read = True
+	
+	def _open(self) -> Cursor:
+		if self._cursor is None:
+			self._conn = self.pool.acquire()
+			self._cursor = self._conn.cursor()
+		return self._cursor
+	
+	def __getattr__(self, name: str):
+		# Only called for attributes RequestCursor doesn't have itself,
+		# i.e. the actual cursor stuff: execute, fetchone, rowcount...
+		return getattr(self._open(), name)
+	
+	def __iter__(self):
+		return iter(self._open())
+	
+	# Statements are timed for /metrics, and slow ones are logged (see querylog).
+	# (Cursors are buffered, so `rowcount` is already known once execute
+	# returns, even for SELECTs.)
+	
+	def execute(self, statement: str, data=(), **kwargs):
+		cur = self._open()
+		start = time.perf_counter()
+		try:
+			return cur.execute(statement, data, **kwargs)
+		finally:
+			self._executed(cur, statement, data, time.perf_counter() - start, many=False)
+	
+	def executemany(self, statement: str, data, **kwargs):
+		cur = self._open()
+		start = time.perf_counter()
+		try:
+			return cur.executemany(statement, data, **kwargs)
+		finally:
+			self._executed(cur, statement, data, time.perf_counter() - start, many=True)
+	
+	def _executed(self, cur: Cursor, statement: str, data, seconds: float, many: bool):
+		self._statements[statement] += 1
+		if self._only_read:
+			sql = statement.lstrip().upper()
+			self._only_read = sql.startswith('SELECT') and 'FOR UPDATE' not in sql
+		metrics.record_query(seconds, cur.rowcount)
+		if seconds >= querylog.slow_threshold:
+			querylog.record_slow(self._conn, statement, data, seconds, many)
+	
+	def release_if_unused(self) -> bool:
+		"""
+		Hands the connection back early if this request hasn't changed (or
+		locked) anything on it yet, so slow work in the middle of a request
+		doesn't keep it from everyone else. Anything run afterwards takes a
+		new connection. Returns whether it let go.
+		"""
+		if self._conn is None or not self._only_read:
+			return False
+		(conn, cur) = (self._conn, self._cursor)
+		self._conn = self._cursor = None
+		try:
+			cur.close() # type: ignore
+			conn.rollback()
+		finally:
+			self.pool.release(conn)
+		self._only_read = True
+		return True
+	
+	def after_transaction(self, fn, committed_only: bool = False):
+		"""
+		Runs `fn()` once this request's transaction is over, committed or
+		not (or only if it's committed, with `committed_only`).
+		"""
+		self._after_transaction.append((fn, committed_only))
+	
+	def finish(self, success: bool):
+		"""
+		Ends the request's transaction and hands the connection back.
+		Commits only if the request succeeded and could've written anything;
+		otherwise rolls back.
+		"""
+		(conn, cur) = (self._conn, self._cursor)
+		self._conn = self._cursor = None
+		if self._statements:
+			querylog.check_statement_count(self._statements)
+		committed = False
+		try:
+			if conn is not None:
+				try:
+					cur.close() # type: ignore
+					if success and not self.readonly:
+						conn.commit()
+						committed = True
+					else:
+						conn.rollback()
+				finally:
+					self.pool.release(conn)
+		finally:
+			(callbacks, self._after_transaction) = (self._after_transaction, [])
+			for (fn, committed_only) in callbacks:
+				if committed or not committed_only:
+					fn()
+
+def after_transaction(cur, fn, committed_only: bool = False):
+	"""
+	Runs `fn()` once `cur`'s transaction is over. Handy for cache invalidation:
+	doing it again at the end means nobody can re-cache the old data in between.
+	With `committed_only`, a rolled back transaction skips it.
+	Plain cursors (scripts managing their own transactions) just run it right away.
+	"""
+	if isinstance(cur, RequestCursor):
+		cur.after_transaction(fn, committed_only)
+	else:
+		fn()
+
+def release_if_unused(cur):
+	"""
+	Lets go of `cur`'s connection until it's next used, if nothing's been
+	written on it yet (see `RequestCursor.release_if_unused`). Plain cursors
+	are left alone.
+	"""
+	if isinstance(cur, RequestCursor):
+		cur.release_if_unused()
+
+@contextmanager
+def request_cursor(readonly: bool = False):
+	""" Gives out a RequestCursor, then commits (or rolls back) and cleans up after it. """
+	cur = RequestCursor(pool, readonly)
+	try:
+		yield cur
+	except BaseException:
+		cur.finish(False)
+		raise
+	else:
+		cur.finish(True)
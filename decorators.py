@@ -3,21 +3,17 @@ import inspect
 from typing import Any
 from types import GenericAlias, NoneType
 
-from flask import request
+from flask import request, Response
+from werkzeug.datastructures import CombinedMultiDict
 from mariadb import mariadb, Cursor, Connection, ConnectionPool
 
-db_config = {
-	'host': 'localhost',
-	'port': 3306,
-	'user': 'root',
-	'database': 'kstores'
-}
+import metrics
+import session
+from db import db_config, pool, request_cursor
 
-# Set up a connection pool
-pool = mariadb.ConnectionPool(
-	pool_name = 'kstores_pool', pool_size = 16,
-	**db_config
-)
+# Requests with these methods shouldn't change anything,
+# so there's nothing for them to commit.
+readonly_methods = ('GET', 'HEAD')
 
 def db_connect(pool: ConnectionPool):
 	def inner_decorator(fn):
@@ -33,96 +29,142 @@ def catch_exception(fn):
 	def inner():
 		try:
 			r = fn()
-			if isinstance(r, dict):
+			if isinstance(r, Response):
+				# already a finished response (like a file, or a 304), leave its status alone
+				return r
+			elif isinstance(r, dict):
 				return { 'success': True, **r }, 200
 			else:
 				return r, 200
 		except Exception as e:
 			print(type(e).__name__, str(e))
+			metrics.record_error(type(e).__name__)
 			return { 'success': False, 'error': type(e).__name__, 'message': str(e) }, 500
 	return inner
 
+# Everything the client sent: the query string, plus the form body if there is one.
+# (Browsers can't send a body with GET, so things like <img src> need the query string.)
+def request_params():
+	return CombinedMultiDict([request.args, request.form])
+
+# Reads a form value as a bool. bool("false") would be True, and bool("") False
+# instead of "not given", so spell it out. Anything else counts as not given.
+def parse_bool(text: str) -> bool:
+	lowered = text.strip().lower()
+	if lowered in ('1', 'true', 'yes', 'on'):
+		return True
+	if lowered in ('0', 'false', 'no', 'off'):
+		return False
+	raise ValueError(f"not a bool: {text!r}")
+
+# Builds a function that pulls `param` out of a form, converted to `ty`.
+# All the type inspection happens here, once, instead of on every request.
+def compile_field(param: str, ty: Any):
+	if ty == bool:
+		return lambda form: form.get(param, type=parse_bool)
+	elif ty == list:
+		# special case: return a list of strings
+		return lambda form: form.getlist(param)
+	elif isinstance(ty, GenericAlias):
+		# special case: return a list of [generic type]
+		if ty.__origin__ == list:
+			item_ty = ty.__args__[0]
+			return lambda form: form.getlist(param, type=item_ty)
+		else:
+			raise Exception("unknown generic")
+	else:
+		return lambda form: form.get(param, type=ty)
+
+# Compiles a `types` dict (like the one given to `fill_dict_from_form`) into
+# a parser that turns a request form into a dict of converted values.
+# Empty values ("", [""], []) come out as None.
+def compile_form_parser(types: dict[str, Any]):
+	fields = tuple( (param, compile_field(param, ty)) for param, ty in types.items() )
+	
+	def parse(form) -> dict[str, Any]:
+		parsed = {}
+		for (param, get) in fields:
+			value = get(form)
+			if value == "" \
+			or value == [""] \
+			or value == []:
+				value = None
+			parsed[param] = value
+		return parsed
+	return parse
+
+# Reads the parameter types off a function's signature, skipping the cursor.
+# Parameters without a type hint are treated as strings.
+def signature_types(fn) -> dict[str, Any]:
+	types = {}
+	for param, info in inspect.signature(fn).parameters.items():
+		if param == 'cur':
+			continue
+		types[param] = str if info.annotation == inspect.Parameter.empty else info.annotation
+	return types
+
 # Provides the function with a "form" dictionary containing all the
 # keys specified in `types`, converted to their corresponding type value.
 def fill_dict_from_form(types: dict[str, type]):
 	def inner_decorator(fn):
+		parse = compile_form_parser(types)
+		for_customer = 'customer' in types
+		
+		def call_with(cur, params):
+			form = parse(params)
+			if for_customer:
+				session.authorize(form['customer'])
+			return fn(cur, form)
+		
 		@wraps(fn)
 		def inner():
-			form = {}
-			conn = pool.get_connection()
-			if conn is None:
-				raise Exception("out of connections")
-			cur = conn.cursor()
-			for param, ty in types.items():
-				if ty == list:
-					# special case: return a list of strings
-					form[param] = request.form.getlist(param)
-				elif isinstance(ty, GenericAlias):
-					# special case: return a list of [generic type]
-					if ty.__origin__ == list:
-						form[param] = request.form.getlist(param, type=ty.__args__[0])
-					else:
-						raise Exception("unknown generic")
-				else:
-					form[param] = request.form.get(param, type=ty)
-				if form[param] == "" \
-				or form[param] == [""] \
-				or form[param] == []:
-					form[param] = None
-			try:
-				r = fn(cur, form)
-				cur.close()
-				conn.commit()
-				conn.close()
-				return r
-			except Exception as e:
-				cur.close()
-				conn.commit()
-				conn.close()
-				raise e
+			params = request_params()
+			with request_cursor(readonly=request.method in readonly_methods) as cur:
+				return call_with(cur, params)
+		# Lets /batch run this route on its own cursor, with its own parameters.
+		inner.call_with = call_with
 		return inner
 	return inner_decorator
 
 # Looks at the function's type hints to fill in the corresponding arguments
-# from the request.form object, converting the strings to the types specified.
+# from the request's form (or query string), converting the strings to the types specified.
 def fill_params_from_form(fn):
+	types = signature_types(fn)
+	parse = compile_form_parser(types)
+	for_customer = 'customer' in types
+	
+	def call_with(cur, params):
+		args = parse(params)
+		if for_customer:
+			session.authorize(args['customer'])
+		return fn(cur, **args)
+	
 	@wraps(fn)
 	def inner():
-		args = {}
-		conn = pool.get_connection()
-		if conn is None:
-			raise Exception("out of connections")
-		cur = conn.cursor()
-		for param, info in inspect.signature(fn).parameters.items():
-			ty = str if info.annotation == inspect.Parameter.empty else info.annotation
-			if ty == list:
-				# special case: return a list of strings
-				args[param] = request.form.getlist(param)
-			elif isinstance(ty, GenericAlias):
-				# special case: return a list of [generic type]
-				if ty.__origin__ == list:
-					args[param] = request.form.getlist(param, type=ty.__args__[0])
-				else:
-					raise Exception("unknown generic")
-			elif param == 'cur':
-				continue
-			else:
-				args[param] = request.form.get(param, type=ty)
-			if args[param] == "" \
-			or args[param] == [] \
-			or args[param] == [""]:
-				args[param] = None
-		try:
-			r = fn(cur, **args)
-			cur.close()
-			conn.commit()
-			conn.close()
-			return r
-		except Exception as e:
-			cur.close()
-			conn.commit()
-			conn.close()
-			raise e
+		params = request_params()
+		with request_cursor(readonly=request.method in readonly_methods) as cur:
+			return call_with(cur, params)
+	# Lets /batch run this route on its own cursor, with its own parameters.
+	inner.call_with = call_with
+	return inner
+
+# For the monitoring routes, which show SQL, cache contents and the like:
+# only requests with the admin token (see session.py) get through.
+# Goes above catch_exception, so a refusal is a 403 rather than a 500.
+def admin_only(fn):
+	@wraps(fn)
+	def inner():
+		if not session.is_admin():
+			return { 'success': False, 'error': 'Forbidden', 'message': "needs the admin token" }, 403
+		return fn()
+	return inner
+
+# Just provides the function with a cursor, for routes that read the request themselves.
+def with_cursor(fn):
+	@wraps(fn)
+	def inner():
+		with request_cursor(readonly=request.method in readonly_methods) as cur:
+			return fn(cur)
 	return inner
 
 # TODO: it'd be nice if these handled optionals and raised an error if they were absent.
@@ -0,0 +1,68 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Iterable
+
+try:
+	from PIL import Image
+except ImportError:
+	# Without Pillow, no derivatives get made and every size serves the original.
+	Image = None
+
+# Image files and their resized copies. Kept apart from images.py, which
+# serves them and needs the database, so generate.py can make them offline.
+
+# Where uploaded images live. Each one's file is named after its image_id.
+image_dir = "./images"
+
+# Resized copies made of every image, by name, and the longest edge (in pixels)
+# each one gets. Images that are already small enough are copied as they are.
+derivative_sizes = {
+	'thumbnail': 160,
+	'card': 480,
+	'full': 1600,
+}
+
+# How many threads make derivatives at once.
+derivative_workers = int(os.environ.get('KSTORES_IMAGE_WORKERS', 2))
+
+def image_path(image_id: int, size: str | None = None) -> str:
+	""" Where the original image (or one of its derivatives) is stored. """
+	if size is None:
+		return os.path.join(image_dir, str(image_id))
+	return os.path.join(image_dir, f"{image_id}.{size}")
+
+def make_derivatives(image_id: int):
+	"""
+	Makes every size in `derivative_sizes` from the original image, right now.
+	Keeps the original's file format, so the MIME type in the database still fits.
+	"""
+	if Image is None:
+		return
+	
+	source = image_path(image_id)
+	with Image.open(source) as original:
+		image_format = original.format
+		for (size, longest_edge) in derivative_sizes.items():
+			dest = image_path(image_id, size)
+			# Written to a temporary file and renamed into place,
+			# so nobody ever gets served half an image.
+			temp = dest + ".tmp"
+			if max(original.size) <= longest_edge:
+				shutil.copyfile(source, temp)
+			else:
+				resized = original.copy()
+				resized.thumbnail((longest_edge, longest_edge))
+				if image_format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+					resized = resized.convert('RGB')
+				resized.save(temp, format=image_format, quality=85, optimize=True)
+			os.replace(temp, dest)
+
+def make_all_derivatives(image_ids: Iterable[int]):
+	""" Makes derivatives for a bunch of images on `derivative_workers` threads, and waits until they're done. """
+	if Image is None:
+		print("warning! Pillow isn't installed, so no resized images will be made")
+		return
+	with ThreadPoolExecutor(max_workers=derivative_workers) as executor:
+		for _ in executor.map(make_derivatives, image_ids):
+			pass
@@ -0,0 +1,114 @@
+import gzip
+import hashlib
+import os
+
+from flask import Flask, request, Response
+from flask.json.provider import DefaultJSONProvider
+
+from cache import LRUCache
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# How the dicts routes return turn into response bodies.
+#
+# Route results are full of Decimal prices and datetime order dates. Flask's
+# own encoder already knows those (Decimal -> "12.99", datetime -> HTTP date
+# string), so the fast encoder hands them to the same function, and clients
+# see exactly the same JSON either way -- just produced a lot quicker.
+
+# Set KSTORES_JSON=stdlib to use Flask's encoder even if orjson is installed.
+use_orjson = orjson is not None and os.environ.get('KSTORES_JSON') != 'stdlib'
+
+class JSONProvider(DefaultJSONProvider):
+	"""
+	Flask's JSON provider, but encoding with orjson when it's installed.
+	Falls back to Flask's pure-Python encoder otherwise.
+	"""
+	
+	if use_orjson:
+		# Sorted keys, like Flask does. Datetimes go through `default`, so
+		# they keep Flask's format instead of orjson's ISO 8601 one.
+		options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+		
+		def dumps(self, obj, **kwargs) -> str:
+			if kwargs:
+				return super().dumps(obj, **kwargs)
+			return orjson.dumps(obj, default=self.default, option=self.options).decode()
+		
+		def response(self, *args, **kwargs) -> Response:
+			obj = self._prepare_response_obj(args, kwargs)
+			if self._app.debug:
+				# Flask pretty-prints in debug mode, so let it.
+				return super().response(obj)
+			body = orjson.dumps(obj, default=self.default, option=self.options)
+			return self._app.response_class(body, mimetype=self.mimetype)
+
+# Responses smaller than this (in bytes) aren't worth compressing.
+compress_min_size = int(os.environ.get('KSTORES_COMPRESS_MIN_SIZE', 1024))
+
+compressible_types = ( 'application/json', 'text/' )
+
+# (encoding, hash of the body) -> compressed body. Lots of responses (the
+# catalog, especially) come out the same every time, so they only get
+# compressed once.
+_compressed = LRUCache(max_size=int(os.environ.get('KSTORES_COMPRESS_CACHE_SIZE', 256)))
+
+def compress(body: bytes, encoding: str) -> bytes:
+	key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+	cached = _compressed.get(key)
+	if cached is not None:
+		return cached
+	
+	if encoding == 'br':
+		# Quality 5 is about as fast as gzip, and still smaller.
+		compressed = brotli.compress(body, quality=5)
+	else:
+		compressed = gzip.compress(body, compresslevel=6)
+	_compressed.put(key, compressed)
+	return compressed
+
+def compress_response(response: Response) -> Response:
+	"""
+	Compresses big enough text/JSON responses with Brotli or gzip, depending
+	on what the client accepts. Register it with `app.after_request`.
+	"""
+	if response.direct_passthrough \
+	or response.is_streamed \
+	or response.status_code != 200 \
+	or 'Content-Encoding' in response.headers \
+	or not (response.mimetype or '').startswith(compressible_types):
+		return response
+	
+	response.vary.add('Accept-Encoding')
+	
+	accepted = request.accept_encodings
+	if brotli is not None and accepted['br']:
+		encoding = 'br'
+	elif accepted['gzip']:
+		encoding = 'gzip'
+	else:
+		return response
+	
+	body = response.get_data()
+	if len(body) < compress_min_size:
+		return response
+	
+	response.set_data(compress(body, encoding))
+	response.headers['Content-Encoding'] = encoding
+	return response
+
+def cache_stats() -> dict:
+	return _compressed.stats()
+
+def init_app(app: Flask):
+	""" Sets up the JSON encoder and response compression on `app`. """
+	app.json = JSONProvider(app)
+	app.after_request(compress_response)
@@ -1,9 +1,15 @@
 import os
+import sys
 import csv
+import json
+import time
+import hashlib
+import argparse
 import mimetypes
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
 
-if not os.path.exists("./images"):
-	os.mkdir("./images")
+import derivatives
 
 replace_types = {
 	'Weight': float,
@@ -35,46 +41,114 @@ def priceFromSize(basePrice: str, size: str | None) -> str:
 	size_index = (sizes.index(size) - 2) / 2
 	return str(round(float(basePrice) + size_index, 2))
 
-images: list[str] = []
+def file_hash(path: str) -> str:
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while chunk := f.read(1 << 20):
+			digest.update(chunk)
+	return digest.hexdigest()
 
-with open('dml.sql', 'w') as dml_sql:
-	items: dict[int, dict] = {}
+class ImageRegistry:
+	"""
+	Hands out image ids for source image filenames, one id per distinct file.
+	Remembers what it copied last time (in a manifest next to the images),
+	so files whose contents haven't changed don't get copied again.
+	"""
 	
-	print("-- Generated file. Run generate.py to update this.", file=dml_sql)
-	print("START TRANSACTION;", file=dml_sql)
-	print("USE kstores;", file=dml_sql)
+	def __init__(self, source_dir: str = './sourceImages', dest_dir: str = derivatives.image_dir):
+		self.source_dir = source_dir
+		self.dest_dir = dest_dir
+		self.ids: dict[str, int | None] = {}
+		# (image_id, filename, mime_type), in id order
+		self.rows: list[tuple[int, str, str | None]] = []
+		self.manifest_path = os.path.join(dest_dir, '.manifest.json')
+		try:
+			with open(self.manifest_path) as f:
+				self.manifest: dict[str, dict] = json.load(f)
+		except (OSError, ValueError):
+			self.manifest = {}
 	
-	for table in [ 'variant_catalog', 'item_catalog', 'catalog_images' ]:
-		print(f"DELETE FROM {table};", file=dml_sql)
+	def id_for(self, filename: str | None) -> int | None:
+		""" Returns the image id for a source file, or None if there's no such file. """
+		if filename is None:
+			return None
+		if filename in self.ids:
+			return self.ids[filename]
+		
+		if not os.path.isfile(os.path.join(self.source_dir, filename)):
+			print(f"warning! no such image {filename}")
+			self.ids[filename] = None
+			return None
+		
+		image_id = len(self.rows) + 1
+		self.ids[filename] = image_id
+		self.rows.append((image_id, filename, mimetypes.guess_type(filename)[0]))
+		return image_id
 	
-	with open("items.csv", newline=None) as items_csv:
+	def copy_one(self, image_id: int, filename: str) -> bool:
+		"""
+		Copies one image into the images folder, unless its contents match
+		what was copied there last time. Returns whether it copied anything.
+		Safe to call from several threads at once (for different images).
+		"""
+		source = os.path.join(self.source_dir, filename)
+		dest = os.path.join(self.dest_dir, str(image_id))
+		stat = os.stat(source)
+		previous = self.manifest.get(str(image_id), {})
+		
+		if os.path.exists(dest) and previous.get('source') == filename:
+			# Same size and mtime as last time? Then don't even bother hashing it.
+			if previous.get('size') == stat.st_size \
+			and previous.get('mtime_ns') == stat.st_mtime_ns:
+				return False
+			digest = file_hash(source)
+			if previous.get('sha256') == digest:
+				previous.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+				return False
+		else:
+			digest = file_hash(source)
+		
+		with open(source, 'rb') as image:
+			with open(dest, 'wb') as dest_file:
+				while chunk := image.read(1 << 20):
+					dest_file.write(chunk)
+		self.manifest[str(image_id)] = {
+			'source': filename,
+			'sha256': digest,
+			'size': stat.st_size,
+			'mtime_ns': stat.st_mtime_ns
+		}
+		return True
+	
+	def save_manifest(self):
+		with open(self.manifest_path, 'w') as f:
+			json.dump(self.manifest, f, indent='\t')
+	
+	def copy_changed(self) -> list[int]:
+		"""
+		Copies every registered image into the images folder, skipping the ones
+		whose contents match what's already there. Returns the ids it copied.
+		"""
+		copied = [
+			image_id for (image_id, filename, _) in self.rows
+			if self.copy_one(image_id, filename)
+		]
+		self.save_manifest()
+		return copied
+
+def read_items(path: str, registry: ImageRegistry) -> Iterator[tuple]:
+	""" Yields (item_id, item_name, description, category, item_image) rows from items.csv. """
+	with open(path, newline=None) as items_csv:
 		for row in csv.DictReader(items_csv):
 			(i, row) = indexed_typed_dict(row)
-			
-			# row['variants'] = []
-			
-			image_index = 0
-			try:
-				image_index = images.index(row['Image']) + 1
-			except:
-				images.append(row['Image'])
-				image_index = len(images)
-				try:
-					with open('./sourceImages/' + row['Image'], 'rb') as image:
-						with open('./images/' + str(image_index), 'wb') as dest:
-							dest.write(image.read())
-					mime = bad(mimetypes.guess_type(row['Image'])[0])
-					print(f"INSERT INTO catalog_images ( image_id, mime_type, alt_text ) VALUES ( {image_index}, {mime}, '' );", file=dml_sql)
-				except:
-					print(f"warning! no such image {row['Image']}")
-					images.pop()
-					image_index = "NULL"
-			
-			print(f"INSERT INTO item_catalog ( item_id, item_name, description, category, item_image ) VALUES ( {i}, {bad(row['Name'])}, {bad(row['Description'])}, {bad(row['Category'])}, {image_index} );", file=dml_sql)
-			
-			# items[i] = row
-	
-	with open("variants.csv", newline=None) as variants_csv:
+			yield (i, row['Name'], row['Description'], row['Category'], registry.id_for(row['Image']))
+
+def read_variants(path: str, registry: ImageRegistry) -> Iterator[tuple]:
+	"""
+	Yields (item_id, variant_id, size, color, price, stock, weight, variant_image)
+	rows from variants.csv. Each CSV row turns into one variant per listed size.
+	"""
+	with open(path, newline=None) as variants_csv:
 		(last_index, variant_id) = (0, 0)
 		for row in csv.DictReader(variants_csv):
 			(i, row) = indexed_typed_dict(row)
@@ -83,21 +157,7 @@ with open('dml.sql', 'w') as dml_sql:
 				variant_id = 0
 				last_index = i
 			
-			image_index = 0
-			try:
-				image_index = images.index(row['Image']) + 1
-			except:
-				images.append(row['Image'])
-				image_index = len(images)
-				mime = bad(mimetypes.guess_type(row['Image'])[0])
-				try:
-					with open('./sourceImages/' + row['Image'], 'rb') as image:
-						with open('./images/' + str(image_index), 'wb') as dest:
-							dest.write(image.read())
-					print(f"INSERT INTO catalog_images ( image_id, mime_type, alt_text ) VALUES ( {image_index}, {mime}, '' );", file=dml_sql)
-				except:
-					print(f"warning! no such image {row['Image']}")
-					image_index = "NULL"
+			image_index = registry.id_for(row['Image'])
 			
 			if row['Size'] is None:
 				row['Size'] = [ None ]
@@ -105,9 +165,192 @@ with open('dml.sql', 'w') as dml_sql:
 				row['Size'] = [ i.strip() for i in row['Size'].split(',') ]
 			
 			for size in row['Size']:
-				print(f"INSERT INTO variant_catalog ( item_id, variant_id, size, color, price, stock, weight, variant_image ) VALUES ( {i}, {variant_id}, {bad(size)}, {bad(row['Color'])}, {bad(priceFromSize(row['Price'], size))}, {row['Stock']}, {round(row['Weight'], 2)}, {image_index} );", file=dml_sql)
+				yield (
+					i, variant_id,
+					size, row['Color'],
+					priceFromSize(row['Price'], size), row['Stock'], round(row['Weight'], 2),
+					image_index
+				)
 				variant_id += 1
+
+# table name, columns, and which of those are strings (and need quoting)
+tables = {
+	'catalog_images': (( 'image_id', 'mime_type', 'alt_text' ), { 'mime_type', 'alt_text' }),
+	'item_catalog': (( 'item_id', 'item_name', 'description', 'category', 'item_image' ), { 'item_name', 'description', 'category' }),
+	'variant_catalog': (( 'item_id', 'variant_id', 'size', 'color', 'price', 'stock', 'weight', 'variant_image' ), { 'size', 'color', 'price' }),
+	# only made up by synthetic.py
+	'address': (( 'address_id', 'street', 'city', 'state', 'zip', 'address_key' ), { 'street', 'city', 'state' }),
+	'customer': (( 'customer_id', 'first_name', 'middle_name', 'last_name', 'shipping_address', 'billing_address', 'email', 'password', 'phone_number' ),
+		{ 'first_name', 'middle_name', 'last_name', 'email', 'password', 'phone_number' }),
+	'shopping_cart': (( 'customer_id', 'item_id', 'variant_id', 'quantity' ), set()),
+	'order': (( 'order_id', 'customer_id', 'order_date', 'shipping_address', 'billing_address', 'total_price', 'total_weight', 'status' ),
+		{ 'order_date', 'total_price', 'status' }),
+	'order_item': (( 'order_id', 'item_id', 'variant_id', 'quantity' ), set()),
+}
+
+# columns holding raw bytes, which go in TSV files as hex
+binary_columns = { 'address_key' }
+
+def sql_value(value, quoted: bool) -> str:
+	if value is None:
+		return "NULL"
+	if isinstance(value, bytes):
+		return f"X'{value.hex()}'"
+	return bad(str(value)) if quoted else str(value)
+
+def tsv_value(value) -> str:
+	""" Escapes a value the way LOAD DATA expects by default. """
+	if value is None:
+		return "\\N"
+	if isinstance(value, bytes):
+		return value.hex()
+	return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def write_sql(out, table: str, rows: Iterable[tuple], batch_size: int):
+	""" Writes rows as multi-row INSERT statements, `batch_size` rows per statement. """
+	(columns, quoted) = tables[table]
+	quote = [ column in quoted for column in columns ]
+	header = f"INSERT INTO `{table}` ( {', '.join(columns)} ) VALUES\n"
+	
+	batch: list[str] = []
+	def flush():
+		if batch:
+			out.write(header + ",\n".join(batch) + ";\n")
+			batch.clear()
+	
+	for row in rows:
+		batch.append("\t( " + ", ".join(sql_value(v, q) for (v, q) in zip(row, quote)) + " )")
+		if len(batch) >= batch_size:
+			flush()
+	flush()
+
+def tsv_file(path: str, rows: Iterable[tuple]) -> int:
+	""" Writes rows to a TSV file at `path`, one at a time. Returns how many there were. """
+	count = 0
+	with open(path, 'w', newline='\n', buffering=1 << 20) as tsv:
+		for row in rows:
+			tsv.write("\t".join(tsv_value(v) for v in row) + "\n")
+			count += 1
+	return count
+
+def load_statement(table: str, path: str) -> str:
+	""" The LOAD DATA statement that loads a TSV file from `tsv_file` into `table`. """
+	(columns, _) = tables[table]
+	# forward slashes work on Windows too, and don't need escaping
+	load_path = os.path.abspath(path).replace('\\', '/')
+	fields = [ f"@{column}" if column in binary_columns else column for column in columns ]
+	unhex = [ f"{column} = UNHEX(@{column})" for column in columns if column in binary_columns ]
+	set_clause = f" SET {', '.join(unhex)}" if unhex else ""
+	return f"LOAD DATA LOCAL INFILE {bad(load_path)} INTO TABLE `{table}` ( {', '.join(fields)} ){set_clause};"
+
+def write_tsv(out, table: str, tsv_dir: str, rows: Iterable[tuple]):
+	""" Writes rows to `<tsv_dir>/<table>.tsv`, plus the LOAD DATA statement that loads it. """
+	path = os.path.join(tsv_dir, f"{table}.tsv")
+	tsv_file(path, rows)
+	print(load_statement(table, path), file=out)
+
+@contextmanager
+def phase(timings: dict[str, float], name: str):
+	start = time.perf_counter()
+	yield
+	timings[name] = time.perf_counter() - start
+
+def generate(
+	items_path: str = 'items.csv', variants_path: str = 'variants.csv',
+	out_path: str = 'dml.sql', tsv_dir: str | None = None,
+	batch_size: int = 500, make_derivatives: bool = True
+) -> dict[str, float]:
+	"""
+	Writes the catalog creation script and copies images into place.
+	If `tsv_dir` is given, the table data goes into TSV files there and the
+	script loads them with LOAD DATA; otherwise it's multi-row INSERTs.
+	Returns how long each phase took, in seconds.
+	"""
+	timings: dict[str, float] = {}
+	registry = ImageRegistry()
+	
+	with phase(timings, 'read'):
+		item_rows = list(read_items(items_path, registry))
+		variant_rows = list(read_variants(variants_path, registry))
+		image_rows = [ (image_id, mime_type, '') for (image_id, _, mime_type) in registry.rows ]
+	
+	with phase(timings, 'write'):
+		with open(out_path, 'w') as dml_sql:
+			print("-- Generated file. Run generate.py to update this.", file=dml_sql)
+			print("START TRANSACTION;", file=dml_sql)
+			print("USE kstores;", file=dml_sql)
 			
-			# items[i]['variants'].append(row)
+			for table in [ 'variant_catalog', 'item_catalog', 'catalog_images' ]:
+				print(f"DELETE FROM {table};", file=dml_sql)
+			
+			for (table, rows) in [
+				('catalog_images', image_rows),
+				('item_catalog', item_rows),
+				('variant_catalog', variant_rows)
+			]:
+				if tsv_dir is None:
+					write_sql(dml_sql, table, rows, batch_size)
+				else:
+					write_tsv(dml_sql, table, tsv_dir, rows)
+			
+			print("COMMIT WORK;", file=dml_sql)
+	
+	with phase(timings, 'copy images'):
+		copied = registry.copy_changed()
+	
+	with phase(timings, 'derivatives'):
+		if make_derivatives:
+			# Make the thumbnail/card/full copies that /image/get?size=... serves,
+			# for images that changed or never got them.
+			missing = [
+				image_id for (image_id, _, _) in registry.rows
+				if image_id in copied or not all(
+					os.path.exists(derivatives.image_path(image_id, size))
+					for size in derivatives.derivative_sizes
+				)
+			]
+			derivatives.make_all_derivatives(missing)
+	
+	print(f"{len(image_rows)} images ({len(copied)} copied), {len(item_rows)} items, {len(variant_rows)} variants")
+	return timings
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Generates the store catalog creation script (dml.sql) from items.csv and variants.csv.")
+	parser.add_argument('--items', default='items.csv')
+	parser.add_argument('--variants', default='variants.csv')
+	parser.add_argument('--out', default='dml.sql', help="where to write the SQL script")
+	parser.add_argument('--format', choices=['sql', 'tsv'], default='sql',
+		help="sql: multi-row INSERTs in the script. tsv: TSV files loaded with LOAD DATA LOCAL INFILE (needs local_infile on).")
+	parser.add_argument('--tsv-dir', default='load', help="where to put the TSV files, for --format tsv")
+	parser.add_argument('--batch', type=int, default=500, help="rows per INSERT statement, for --format sql")
+	parser.add_argument('--no-derivatives', action='store_true', help="don't make resized image copies")
+	parser.add_argument('--scale', type=float,
+		help="instead of the CSVs, make up a store this big (1 = 2,000 items and 20,000 customers, with carts and orders), as --format tsv")
+	parser.add_argument('--processes', type=int, help="processes making up data, for --scale (default: one per core)")
+	parser.add_argument('--seed', type=int, default=1, help="random seed, for --scale")
+	args = parser.parse_args()
+	
+	if args.scale is not None:
+		import synthetic
+		os.makedirs(args.tsv_dir, exist_ok=True)
+		start = time.perf_counter()
+		counts = synthetic.generate_scaled(args.scale, args.out, args.tsv_dir, args.processes, args.seed)
+		for (table, rows) in counts.items():
+			print(f"{table:>16}: {rows:>12,} rows")
+		print(f"{time.perf_counter() - start:.1f}s", file=sys.stderr)
+		sys.exit(0)
+	
+	if not os.path.exists(derivatives.image_dir):
+		os.mkdir(derivatives.image_dir)
+	tsv_dir = None
+	if args.format == 'tsv':
+		tsv_dir = args.tsv_dir
+		os.makedirs(tsv_dir, exist_ok=True)
 	
-	print("COMMIT WORK;", file=dml_sql)
+	timings = generate(
+		args.items, args.variants,
+		args.out, tsv_dir,
+		args.batch, not args.no_derivatives
+	)
+	for (name, seconds) in timings.items():
+		print(f"{name:>12}: {seconds * 1000:8.1f} ms", file=sys.stderr)
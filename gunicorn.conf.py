@@ -0,0 +1,66 @@
+# Production server settings. Run the backend with:
+#
+#     gunicorn -c gunicorn.conf.py main:app
+#
+# Everything here can be tuned with environment variables, so the same file
+# works on a laptop and on a big box. (gunicorn doesn't run on Windows; use
+# `python main.py` there.)
+#
+# https://docs.gunicorn.org/en/stable/settings.html
+
+import os
+import glob
+import tempfile
+import multiprocessing
+
+bind = f"{os.environ.get('KSTORES_HOST', '0.0.0.0')}:{os.environ.get('KSTORES_PORT', 3000)}"
+
+# One process per core by default, each with a handful of threads. Requests
+# mostly wait on the database, so threads help; processes get around the GIL.
+workers = int(os.environ.get('KSTORES_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('KSTORES_THREADS', 4))
+worker_class = 'gthread'
+
+# Keep connections from browsers open between requests.
+keepalive = int(os.environ.get('KSTORES_KEEPALIVE', 5))
+
+# On SIGTERM, workers stop taking new requests and get this long
+# to finish the ones they have before they're killed.
+graceful_timeout = int(os.environ.get('KSTORES_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('KSTORES_TIMEOUT', 60))
+
+# Load the app once in the parent, so the catalog index is built once and
+# shared with every worker (until they rebuild their own copies).
+preload_app = True
+
+# Each worker counts its own /metrics, and leaves them here for the others,
+# so whichever worker gets scraped can report for the whole server.
+metrics_dir = os.environ.setdefault('KSTORES_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'kstores-metrics'))
+
+def on_starting(server):
+	# Leftovers from the last run would get added in otherwise.
+	for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+		os.remove(path)
+
+def when_ready(server):
+	import main
+	try:
+		main.warm_up()
+	except Exception as e:
+		# Not fatal: each worker builds the index on its first search anyway.
+		server.log.warning(f"couldn't build the catalog index up front: {e!r}")
+
+def post_fork(server, worker):
+	# Every worker needs its own database connections; the ones
+	# inherited from the parent belong to the parent.
+	from db import pool
+	pool.reset_after_fork()
+	import metrics
+	metrics.reset_after_fork()
+
+def worker_exit(server, worker):
+	# Requests are done by now, so hand the connections back to MariaDB.
+	from db import pool
+	pool.close()
+	import metrics
+	metrics.remove_worker_file()
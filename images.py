@@ -0,0 +1,135 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mariadb import Cursor
+
+import actions
+from cache import LRUCache
+import derivatives
+from derivatives import Image, image_dir, image_path, derivative_sizes, derivative_workers
+
+# How long (in seconds) browsers may reuse an image without asking again.
+# Image files never change once uploaded (a new upload gets a new id),
+# and they're revalidated with an ETag after this anyway.
+max_age = int(os.environ.get('KSTORES_IMAGE_MAX_AGE', 86400))
+
+# Derivatives are made in the background by a few worker threads. If too many
+# are waiting, new ones are skipped rather than queued forever; they get made
+# later, the first time someone asks for them.
+derivative_queue_limit = int(os.environ.get('KSTORES_IMAGE_QUEUE', 64))
+
+_executor = ThreadPoolExecutor(max_workers=derivative_workers, thread_name_prefix='derivatives')
+_queue_slots = threading.BoundedSemaphore(derivative_queue_limit)
+_scheduled: set[int] = set()
+# Images whose derivatives couldn't be made (a broken or unsupported file),
+# so they aren't queued up again on every request. `forget` clears this.
+_failed: set[int] = set()
+_scheduled_lock = threading.Lock()
+
+# (image_id, size) -> everything needed to serve that image without asking the database.
+_info_cache = LRUCache(max_size=int(os.environ.get('KSTORES_IMAGE_CACHE_SIZE', 4096)))
+
+def hash_file(path: str) -> str:
+	""" SHA-256 of a file's contents, read in chunks so big files don't all land in memory. """
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while chunk := f.read(1 << 20):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def get_image_file_info(cur: Cursor, image_id: int, size: str | None = None):
+	"""
+	Returns a dict with the image's path, MIME type, alt text, size, last
+	modification time and content hash (for the ETag).
+	Pass a `size` from `derivative_sizes` to get a resized copy instead; if
+	that hasn't been made yet, this returns the original and queues it up,
+	with 'fallback' set so it isn't cached as the resized one.
+	
+	The database is only asked the first time an image is served; after that
+	it's just a stat() to make sure the file hasn't changed under us.
+	"""
+	fallback = False
+	if size is not None:
+		if size not in derivative_sizes:
+			raise Exception(f"unknown image size {size!r}")
+		if not os.path.exists(image_path(image_id, size)):
+			schedule_derivatives(image_id)
+			size = None
+			fallback = True
+	
+	path = image_path(image_id, size)
+	stat = os.stat(path)
+	
+	info = _info_cache.get((image_id, size))
+	if info is not None \
+	and info['size'] == stat.st_size \
+	and info['mtime_ns'] == stat.st_mtime_ns:
+		return dict(info, fallback=True) if fallback else info
+	
+	if info is None:
+		db_info = actions.get_image_info(cur, image_id)
+	else:
+		# only the file changed, the database row didn't
+		db_info = { 'mime_type': info['mime_type'], 'alt_text': info['alt_text'] }
+	
+	info = {
+		'path': path,
+		'mime_type': db_info['mime_type'],
+		'alt_text': db_info['alt_text'],
+		'size': stat.st_size,
+		'mtime': stat.st_mtime,
+		'mtime_ns': stat.st_mtime_ns,
+		'etag': hash_file(path),
+		'fallback': False
+	}
+	_info_cache.put((image_id, size), info)
+	return dict(info, fallback=True) if fallback else info
+
+def forget(image_id: int):
+	""" Drops an image (and its derivatives) from the cache, e.g. after its file gets replaced. """
+	_info_cache.pop((image_id, None))
+	for size in derivative_sizes:
+		_info_cache.pop((image_id, size))
+	with _scheduled_lock:
+		_failed.discard(image_id)
+
+def make_derivatives(image_id: int):
+	""" `derivatives.make_derivatives`, then drops the image from the cache so they get served. """
+	derivatives.make_derivatives(image_id)
+	forget(image_id)
+
+def _make_derivatives_task(image_id: int):
+	try:
+		make_derivatives(image_id)
+	except Exception as e:
+		print(f"couldn't make derivatives for image {image_id}:", type(e).__name__, str(e))
+		with _scheduled_lock:
+			_failed.add(image_id)
+	finally:
+		with _scheduled_lock:
+			_scheduled.discard(image_id)
+		_queue_slots.release()
+
+def schedule_derivatives(image_id: int) -> bool:
+	"""
+	Queues up `make_derivatives` on the worker pool, without waiting for it.
+	Returns False if it couldn't be queued (no Pillow, the queue's full, or
+	making them already failed once).
+	"""
+	if Image is None:
+		return False
+	with _scheduled_lock:
+		if image_id in _scheduled:
+			return True
+		if image_id in _failed:
+			return False
+		if not _queue_slots.acquire(blocking=False):
+			return False
+		_scheduled.add(image_id)
+	_executor.submit(_make_derivatives_task, image_id)
+	return True
+
+def cache_stats() -> dict:
+	return _info_cache.stats()
@@ -0,0 +1,185 @@
+"""
+Streams the catalog CSVs straight into the database, without going through
+dml.sql and the mysql command line.
+
+Rows are read a chunk at a time and written with the bulk `actions` functions
+(one executemany per table per chunk), and each chunk is its own transaction.
+Images are copied on a few threads while the database works.
+
+Images are added as new rows, and their files are named after the image ids
+the database gives them, so images already in the store are left alone.
+
+After every chunk commits, progress is saved to a checkpoint file. If the
+import dies halfway, running it again picks up after the last committed chunk.
+(Re-running a chunk is harmless anyway -- the bulk actions overwrite rows,
+and at worst its new images get added twice.)
+
+Run with `python import_catalog.py --help` to see the options.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from itertools import islice
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from mariadb import mariadb, Connection, Cursor
+
+import actions
+import derivatives
+from db import db_config
+from generate import ImageRegistry, read_items, read_variants
+
+def chunks(rows: Iterator[tuple], size: int) -> Iterator[list[tuple]]:
+	while chunk := list(islice(rows, size)):
+		yield chunk
+
+class Importer:
+	def __init__(
+		self, conn: Connection,
+		items_path: str, variants_path: str,
+		checkpoint_path: str,
+		chunk_size: int, threads: int
+	):
+		self.conn = conn
+		self.items_path = items_path
+		self.variants_path = variants_path
+		self.checkpoint_path = checkpoint_path
+		self.chunk_size = chunk_size
+		self.registry = ImageRegistry()
+		self.copier = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='image-copy')
+		self.progress = { 'items': 0, 'variants': 0, 'images': 0 }
+		# The registry's image ids just number the files in the CSVs; this is
+		# the image_id the database gave each one (registry id - 1 -> image_id).
+		self.image_ids: list[int] = []
+		self.copied = 0
+	
+	def load_checkpoint(self):
+		""" Picks up where the last run left off, if it was importing the same files. """
+		try:
+			with open(self.checkpoint_path) as f:
+				checkpoint = json.load(f)
+		except (OSError, ValueError):
+			return
+		if checkpoint.get('files') != self.files() or 'image_ids' not in checkpoint:
+			print("checkpoint is for different files, starting over", file=sys.stderr)
+			return
+		self.progress = checkpoint['progress']
+		self.image_ids = checkpoint['image_ids']
+		print(f"resuming after {self.progress}", file=sys.stderr)
+	
+	def save_checkpoint(self):
+		temp = self.checkpoint_path + ".tmp"
+		with open(temp, 'w') as f:
+			json.dump({ 'files': self.files(), 'progress': self.progress, 'image_ids': self.image_ids }, f)
+		os.replace(temp, self.checkpoint_path)
+	
+	def files(self) -> dict:
+		""" Identifies the input files, so a checkpoint isn't reused for different ones. """
+		return {
+			path: [ os.path.getsize(path), os.path.getmtime(path) ]
+			for path in (self.items_path, self.variants_path)
+		}
+	
+	def copy_image(self, image_id: int, filename: str) -> bool:
+		if not self.registry.copy_one(image_id, filename):
+			return False
+		derivatives.make_derivatives(image_id)
+		return True
+	
+	def import_table(self, name: str, rows: Iterator[tuple], insert):
+		"""
+		Writes `rows` in chunks with `insert(cur, chunk)`, one transaction each.
+		Rows before the checkpoint are read (so the registry's ids come out
+		the same) but not written.
+		"""
+		done = self.progress[name]
+		for _ in islice(rows, done):
+			pass
+		
+		for chunk in chunks(rows, self.chunk_size):
+			start = time.perf_counter()
+			cur = self.conn.cursor()
+			try:
+				# Any images this chunk introduced have to exist before the rows pointing at them.
+				new_images = self.registry.rows[self.progress['images']:]
+				new_ids = [
+					actions.create_image(cur, mime_type, '')
+					for (_, _, mime_type) in new_images
+				]
+				copies: list[Future] = [
+					self.copier.submit(self.copy_image, image_id, filename)
+					for (image_id, (_, filename, _)) in zip(new_ids, new_images)
+				]
+				
+				# Every row's image (its last column) is a registry id, to swap for the database's.
+				image_ids = self.image_ids + new_ids
+				insert(cur, [
+					row if row[-1] is None else row[:-1] + (image_ids[row[-1] - 1],)
+					for row in chunk
+				])
+				self.conn.commit()
+			except:
+				self.conn.rollback()
+				raise
+			finally:
+				cur.close()
+			
+			self.copied += sum(copy.result() for copy in copies)
+			self.progress[name] += len(chunk)
+			self.progress['images'] += len(new_images)
+			self.image_ids += new_ids
+			self.registry.save_manifest()
+			self.save_checkpoint()
+			
+			elapsed = time.perf_counter() - start
+			print(f"{name}: {self.progress[name]} rows ({len(chunk) / elapsed:.0f} rows/s)", file=sys.stderr)
+	
+	def run(self):
+		start = time.perf_counter()
+		self.import_table('items', read_items(self.items_path, self.registry), actions.create_catalog_items)
+		self.import_table('variants', read_variants(self.variants_path, self.registry), actions.create_catalog_item_variants)
+		self.copier.shutdown()
+		print(
+			f"imported {self.progress['items']} items, {self.progress['variants']} variants, "
+			f"{self.progress['images']} images ({self.copied} copied) "
+			f"in {time.perf_counter() - start:.1f}s",
+			file=sys.stderr
+		)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Imports items.csv and variants.csv straight into the database.")
+	parser.add_argument('--items', default='items.csv')
+	parser.add_argument('--variants', default='variants.csv')
+	parser.add_argument('--chunk', type=int, default=2000, help="rows per transaction")
+	parser.add_argument('--threads', type=int, default=4, help="threads copying images")
+	parser.add_argument('--checkpoint', default='.import_checkpoint.json', help="where progress is saved")
+	parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start from the top")
+	args = parser.parse_args()
+	
+	if not os.path.exists(derivatives.image_dir):
+		os.mkdir(derivatives.image_dir)
+	
+	try:
+		conn = mariadb.connect(**db_config)
+		importer = Importer(
+			conn,
+			args.items, args.variants,
+			args.checkpoint,
+			args.chunk, args.threads
+		)
+		if not args.restart:
+			importer.load_checkpoint()
+		importer.run()
+		
+		# Finished, so there's nothing left to resume.
+		if os.path.exists(args.checkpoint):
+			os.remove(args.checkpoint)
+		conn.close()
+	
+	except mariadb.Error as e:
+		print(f"Database Error:\n{e}")
+		sys.exit(1)
@@ -1,30 +1,59 @@
 import sys, os
 
 from mariadb import mariadb, Cursor, Connection, ConnectionPool
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
+from werkzeug.datastructures import MultiDict
 
 import actions
-from decorators import catch_exception, db_connect, fill_dict_from_form, fill_params_from_form
+import catalog_index
+import encoding
+import images
+import metrics
+import paging
+import querylog
+import session
+from db import db_config, pool, request_cursor
+from decorators import admin_only, catch_exception, db_connect, fill_dict_from_form, fill_params_from_form, with_cursor, readonly_methods
 
 app = Flask(__name__)
 CORS(app)
+# Times every request for /metrics. (First, so the other hooks' time counts too.)
+metrics.init_app(app)
+# Fast JSON (with orjson, if it's installed) and gzip/Brotli for big responses.
+encoding.init_app(app)
 
-if not os.path.exists("./images"):
-	os.mkdir("./images")
+if not os.path.exists(images.image_dir):
+	os.mkdir(images.image_dir)
 
-app.config["DEBUG"] = True
+# Only for development! It's slow, and lets anyone who can see an error page run code.
+app.config["DEBUG"] = os.environ.get('KSTORES_DEBUG') == '1'
+
+# Let a reverse proxy in front of us send image files, if there is one.
+app.config["USE_X_SENDFILE"] = os.environ.get('KSTORES_X_SENDFILE') == '1'
 
 # ROUTES
 
 # - customer modify
 
-@app.route("/customer/signin", methods=['GET'])
+# POST only, so passwords don't end up in URLs and logs (and so an old
+# password's fresh hash gets committed).
+@app.route("/customer/signin", methods=['POST'])
 @catch_exception
 @fill_params_from_form
 def signin(cur: Cursor, email: str, password: str):
 	(valid, customer) = actions.check_login(cur, email, password)
-	return { 'valid': valid, 'customer': customer }
+	# Send the token back in an "Authorization: Bearer ..." header from now on.
+	token = session.create_token(customer) if valid else None
+	return { 'valid': valid, 'customer': customer, 'token': token, 'expires_in': session.session_ttl }
+
+@app.route("/customer/signout", methods=['POST'])
+@catch_exception
+def signout():
+	token = session.request_token()
+	if token is None:
+		raise Exception("no session to sign out of")
+	return { 'signed_out': session.revoke_token(token) }
 
 @app.route("/customer/signup", methods=['POST'])
 @catch_exception
@@ -40,6 +69,8 @@ def signin(cur: Cursor, email: str, password: str):
 	'billing_city': str, 'billing_state': str, 'billing_zip': int
 })
 def create_customer(cur: Cursor, form):
+	# Hashing takes a while; before any SQL, it doesn't hold up a connection.
+	password = session.hash_password(form['password'])
 	shipping_id = actions.create_address( cur,
 		form['shipping_street'],
 		form['shipping_city'], form['shipping_state'], form['shipping_zip']
@@ -50,7 +81,7 @@ def create_customer(cur: Cursor, form):
 	)
 	customer_id = actions.create_customer( cur,
 		form['first_name'], form['middle_name'], form['last_name'],
-		form['email'], form['password'],
+		form['email'], password,
 		form['phone_number'],
 		shipping_id, billing_id
 	)
@@ -79,6 +110,9 @@ def get_customer(cur: Cursor, customer: int):
 })
 def edit_customer(cur: Cursor, form):
 	customer = form['customer']
+	if form['password'] is not None:
+		# Before any SQL, like in signup.
+		form['password'] = session.hash_password(form['password'])
 	actions.edit_customer( cur, customer, **form )
 	return {}
 
@@ -103,21 +137,35 @@ def edit_customer_address(cur: Cursor, form):
 
 @app.route("/image/create", methods=['POST'])
 @catch_exception
+@with_cursor
 def create_image(cur: Cursor):
 	image_req = request.files['image']
 	image_id = actions.create_image(cur, image_req.mimetype, request.form.get('alt_text'))
-	image_req.save(f"./images/{image_id}")
+	image_req.save(images.image_path(image_id))
+	images.forget(image_id)
+	# Resized copies get made in the background; until then, /image/get serves the original.
+	images.schedule_derivatives(image_id)
 	return { 'image': image_id }
 
 @app.route("/image/get", methods=['GET'])
 @catch_exception
 @fill_params_from_form
-def get_image(cur: Cursor, image: int):
+def get_image(cur: Cursor, image: int, size: str):
 	if image is None:
 		raise Exception("no image with that id")
-	x = actions.get_image_info(cur, image)
-	mime_type = x['mime_type']
-	return send_file(f"./images/{image}", mimetype=mime_type)
+	# Cached after the first request, so this usually doesn't touch the database.
+	# (`size` is one of images.derivative_sizes, like 'thumbnail'; none means the original.)
+	info = images.get_image_file_info(cur, image, size)
+	# conditional=True answers If-None-Match / If-Modified-Since with a 304,
+	# and Range requests with a 206. The file itself goes through the server's
+	# wsgi.file_wrapper, which uses sendfile() where the server supports it.
+	# The original standing in for a size that isn't made yet goes out as
+	# no-cache, so nobody keeps it as that size once the real one exists.
+	return send_file(
+		info['path'], mimetype=info['mime_type'],
+		etag=info['etag'], last_modified=info['mtime'],
+		max_age=0 if info['fallback'] else images.max_age, conditional=True
+	)
 
 @app.route("/catalog/search", methods=['GET'])
 @catch_exception
@@ -129,9 +177,57 @@ def get_image(cur: Cursor, image: int):
 	'minprice': int,
 	'maxprice': int,
 	'instock': bool,
+	'q': str,
+	'group': str,
+	'limit': int,
+	'after': str,
 })
 def catalog_list(cur: Cursor, form):
-	return { 'items': actions.search_catalog( cur, **form ) }
+	limit = form.pop('limit')
+	cursor = form.pop('after')
+	group = form.pop('group')
+	# With `q`, results come best match first, and each has a relevance `score`.
+	ranked = bool(form['q'])
+	# Served out of the in-memory index; only hits the database to rebuild it.
+	if group == 'item':
+		# One entry per item, with the variants that matched.
+		(items, next_cursor) = paging.paginate(
+			lambda **page: catalog_index.search_items( cur, **page, **form ),
+			limit, cursor,
+			key=lambda row: (catalog_index.relevance_key(row['score']), row['id']) if ranked
+				else (row['id'],)
+		)
+	elif group is None or group == 'variant':
+		(items, next_cursor) = paging.paginate(
+			lambda **page: catalog_index.search( cur, **page, **form ),
+			limit, cursor,
+			key=lambda row: (catalog_index.relevance_key(row['score']), row['id']['item'], row['id']['variant']) if ranked
+				else (row['id']['item'], row['id']['variant'])
+		)
+	else:
+		raise Exception("group must be either 'item' or 'variant'")
+	return { 'items': items, 'next': next_cursor }
+
+@app.route("/catalog/items", methods=['GET'])
+@catch_exception
+@fill_dict_from_form({
+	'category': list[str],
+	'minprice': int,
+	'maxprice': int,
+	'instock': bool,
+	'limit': int,
+	'after': str,
+})
+def catalog_items(cur: Cursor, form):
+	limit = form.pop('limit')
+	cursor = form.pop('after')
+	# One row per item, with its price range, stock, sizes and colors.
+	(items, next_cursor) = paging.paginate(
+		lambda **page: actions.get_item_summaries( cur, **page, **form ),
+		limit, cursor,
+		key=lambda row: (row['id'],)
+	)
+	return { 'items': items, 'next': next_cursor }
 
 @app.route("/catalog/get", methods=['GET'])
 @catch_exception
@@ -148,8 +244,13 @@ def cart_count(cur: Cursor, customer: int):
 @app.route("/cart/list", methods=['GET'])
 @catch_exception
 @fill_params_from_form
-def cart_list(cur: Cursor, customer: int):
-	return { 'items': actions.get_cart_items(cur, customer) }
+def cart_list(cur: Cursor, customer: int, limit: int, after: str):
+	(items, next_cursor) = paging.paginate(
+		lambda **page: actions.get_cart_items(cur, customer, **page),
+		limit, after,
+		key=lambda row: (row['id']['item'], row['id']['variant'])
+	)
+	return { 'items': items, 'next': next_cursor }
 
 @app.route("/cart/add", methods=['POST'])
 @catch_exception
@@ -174,8 +275,13 @@ def checkout(cur: Cursor, customer: int):
 @app.route("/order/list", methods=['GET'])
 @catch_exception
 @fill_params_from_form
-def list_orders(cur: Cursor, customer: int):
-	return { 'orders': actions.list_orders(cur, customer) }
+def list_orders(cur: Cursor, customer: int, limit: int, after: str):
+	(orders, next_cursor) = paging.paginate(
+		lambda **page: actions.list_orders(cur, customer, **page),
+		limit, after,
+		key=lambda row: (row['id']['order'],)
+	)
+	return { 'orders': orders, 'next': next_cursor }
 
 @app.route("/order/get", methods=['GET'])
 @catch_exception
@@ -186,6 +292,104 @@ def list_order(cur: Cursor, order: int):
 		'items': actions.list_order_items(cur, order)
 	}
 
+# - batch
+
+# Most operations one request can ask for.
+batch_limit = 50
+
+@app.route("/batch", methods=['POST'])
+@catch_exception
+def batch():
+	"""
+	Runs several routes in one request, on one database connection.
+	Takes a JSON body like:
+		
+		{ "transaction": false, "operations": [
+			{ "path": "/catalog/get", "args": { "item": 3 } },
+			{ "path": "/cart/add", "method": "POST", "args": { "customer": 1, "item": 3, "variant": 0, "quantity": 2 } }
+		] }
+	
+	(or just the list of operations). Returns each route's result, in order.
+	With "transaction": true, it's all or nothing: the first failure undoes
+	everything and fails the whole batch. Otherwise each operation succeeds or
+	fails on its own.
+	"""
+	body = request.get_json(force=True)
+	if isinstance(body, list):
+		body = { 'operations': body }
+	operations = body.get('operations') or []
+	atomic = bool(body.get('transaction'))
+	
+	if len(operations) > batch_limit:
+		raise Exception(f"too many operations (at most {batch_limit})")
+	
+	# Look up every route first, so a typo fails before anything runs.
+	urls = app.url_map.bind('localhost')
+	calls = []
+	for op in operations:
+		method = op.get('method', 'GET').upper()
+		(endpoint, _) = urls.match(op['path'], method=method)
+		call_with = getattr(app.view_functions[endpoint], 'call_with', None)
+		if call_with is None:
+			raise Exception(f"{op['path']} can't be batched")
+		calls.append((op['path'], method, call_with, MultiDict(op.get('args') or {})))
+	
+	readonly = all(method in readonly_methods for (_, method, _, _) in calls)
+	results = []
+	with request_cursor(readonly=readonly) as cur:
+		for (i, (path, method, call_with, args)) in enumerate(calls):
+			# Lets a failed operation be undone without losing the ones before it.
+			savepoint = not atomic and not readonly
+			if savepoint:
+				cur.execute("SAVEPOINT batch_operation;")
+			try:
+				r = call_with(cur, args)
+				if not isinstance(r, dict):
+					raise Exception(f"{path} can't be batched")
+				results.append({ 'success': True, **r })
+			except Exception as e:
+				if atomic:
+					raise Exception(f"operation {i} ({path}) failed: {type(e).__name__}: {e}")
+				if savepoint:
+					cur.execute("ROLLBACK TO SAVEPOINT batch_operation;")
+				results.append({ 'success': False, 'error': type(e).__name__, 'message': str(e) })
+	
+	return { 'results': results }
+
+# - status
+
+@app.route("/pool/stats", methods=['GET'])
+@admin_only
+@catch_exception
+def pool_stats():
+	return pool.stats()
+
+@app.route("/metrics", methods=['GET'])
+@admin_only
+@catch_exception
+def prometheus_metrics():
+	# Request counts and latencies, the pool, and SQL time per action, for Prometheus to scrape.
+	return Response(metrics.render(), content_type=metrics.content_type)
+
+@app.route("/queries/slow", methods=['GET'])
+@admin_only
+@catch_exception
+def slow_queries():
+	# Recent statements over KSTORES_SLOW_QUERY_SECONDS (with their EXPLAIN plans),
+	# and requests that ran more than KSTORES_MAX_STATEMENTS statements.
+	return querylog.recent()
+
+@app.route("/cache/stats", methods=['GET'])
+@admin_only
+@catch_exception
+def cache_stats():
+	return {
+		'images': images.cache_stats(),
+		'cart_info': actions.cart_info_cache.stats(),
+		'customer_info': actions.customer_info_cache.stats(),
+		'compressed_responses': encoding.cache_stats()
+	}
+
 # Secret zone where you can ???
 @app.route("/echo", methods=['GET', 'POST'])
 def aaa():
@@ -222,17 +426,35 @@ def aaa():
 
 # https://mariadb.com/docs/connect/programming-languages/python/
 
-try:
-	
-	# Connect to the database.
-	# conn = mariadb.connect(**db_config) # type: ignore
-	
-	# Run the server
-	app.run(port=3000)
+def warm_up():
+	"""
+	Builds the catalog search index up front, so the first search doesn't
+	have to wait for it. Uses its own connection rather than the pool, since
+	under gunicorn this runs before the workers are forked off.
+	"""
+	conn = mariadb.connect(**db_config)
+	cur = conn.cursor()
+	catalog_index.refresh(cur)
+	cur.close()
+	conn.rollback()
+	conn.close()
+
+# `python main.py` runs the development server. In production, use gunicorn
+# instead (see gunicorn.conf.py), which imports `app` from here.
+if __name__ == '__main__':
+	try:
+		
+		warm_up()
+		
+		# Run the server
+		app.run(
+			host=os.environ.get('KSTORES_HOST', '127.0.0.1'),
+			port=int(os.environ.get('KSTORES_PORT', 3000))
+		)
 	
-except mariadb.Error as e:
-	print(f"Database Error ({e.__name__}):\n{e}")
-	sys.exit(1)
+	except mariadb.Error as e:
+		print(f"Database Error ({type(e).__name__}):\n{e}")
+		sys.exit(1)
 	
-except Exception as e:
-	print(repr(e))
+	except Exception as e:
+		print(repr(e))
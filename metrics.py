@@ -0,0 +1,335 @@
+"""
+Counts and times requests, database connections and SQL, and serves the
+numbers at /metrics in Prometheus' text format.
+
+Recording is meant to be cheap enough to leave on: every thread writes to its
+own set of counters (no locks, since nothing else writes to them), and they're
+only added up when someone scrapes /metrics. Once a thread's finished, its
+counters are added into one set of totals and dropped, so servers that start
+a thread per request don't pile them up.
+
+Under gunicorn, every worker process has its own counters. If
+KSTORES_METRICS_DIR is set (gunicorn.conf.py sets it), each worker also writes
+its counters to a file there every few seconds, and whichever worker answers
+the scrape adds up everyone's files, so /metrics describes the whole server.
+"""
+
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Flask, Response, request, g
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+# Goes low enough to tell apart SQL that takes a fraction of a millisecond.
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help text), for every metric that can show up.
+descriptions = {
+	'kstores_http_requests_total': ('counter', "Requests handled, by route, method and status."),
+	'kstores_http_errors_total': ('counter', "Requests that failed with an exception, by route and exception type."),
+	'kstores_http_request_duration_seconds': ('histogram', "How long requests took, by route."),
+	'kstores_pool_wait_seconds': ('histogram', "How long requests waited for a database connection."),
+	'kstores_pool_timeouts_total': ('counter', "Requests that gave up waiting for a database connection."),
+	'kstores_pool_connections_in_use': ('gauge', "Database connections checked out right now."),
+	'kstores_pool_connections': ('gauge', "Database connections the pools may hold."),
+	'kstores_sql_duration_seconds': ('histogram', "How long SQL statements took, by the actions function that ran them."),
+	'kstores_sql_rows_total': ('counter', "Rows SQL statements returned or changed, by the actions function that ran them."),
+}
+
+# Where workers leave their counters for each other. None outside gunicorn.
+metrics_dir = os.environ.get('KSTORES_METRICS_DIR') or None
+flush_interval = float(os.environ.get('KSTORES_METRICS_FLUSH_INTERVAL', 5))
+
+Labels = tuple[tuple[str, str], ...]
+
+class Shard:
+	""" One thread's counters. Only that thread ever writes to it. """
+	
+	def __init__(self):
+		# (name, labels) -> value
+		self.counters: dict[tuple[str, Labels], float] = {}
+		# (name, labels) -> [count per bucket..., count over the last bucket, sum]
+		self.histograms: dict[tuple[str, Labels], list[float]] = {}
+	
+	def add(self, other: 'Shard'):
+		""" Adds `other`'s numbers to this one's. """
+		for (key, value) in other.counters.copy().items():
+			self.counters[key] = self.counters.get(key, 0) + value
+		for (key, values) in other.histograms.copy().items():
+			merged = self.histograms.setdefault(key, [0] * len(values))
+			for (i, value) in enumerate(list(values)):
+				merged[i] += value
+
+_local = threading.local()
+# Live threads' shards, and what finished threads recorded, added up.
+_shards: list[tuple[threading.Thread, Shard]] = []
+_finished = Shard()
+_shards_lock = threading.Lock()
+
+# Functions returning gauges' values right now (like the pool's), called on every scrape.
+_collectors: list[Callable[[], Iterable[tuple[str, Labels, float]]]] = []
+
+def _fold_finished():
+	""" Adds finished threads' shards into `_finished` and forgets them. Call with `_shards_lock` held. """
+	global _shards
+	alive = []
+	for (thread, shard) in _shards:
+		if thread.is_alive():
+			alive.append((thread, shard))
+		else:
+			# Nobody's writing to it anymore.
+			_finished.add(shard)
+	_shards = alive
+
+def _shard() -> Shard:
+	try:
+		return _local.shard
+	except AttributeError:
+		# First time this thread records anything; the only time it takes a lock.
+		shard = _local.shard = Shard()
+		with _shards_lock:
+			_fold_finished()
+			_shards.append((threading.current_thread(), shard))
+		return shard
+
+def count(name: str, labels: Labels = (), amount: float = 1):
+	counters = _shard().counters
+	key = (name, labels)
+	counters[key] = counters.get(key, 0) + amount
+
+def observe(name: str, labels: Labels, seconds: float):
+	histograms = _shard().histograms
+	key = (name, labels)
+	histogram = histograms.get(key)
+	if histogram is None:
+		histogram = histograms[key] = [0] * (len(buckets) + 2)
+	histogram[bisect_left(buckets, seconds)] += 1
+	histogram[-1] += seconds
+
+def add_collector(collect: Callable[[], Iterable[tuple[str, Labels, float]]]):
+	""" Registers a function that returns (name, labels, value) gauges, called on every scrape. """
+	_collectors.append(collect)
+
+# - SQL, by actions function
+
+@contextmanager
+def action(name: str):
+	""" Counts SQL run inside this block towards `name`. """
+	previous = getattr(_local, 'action', '-')
+	_local.action = name
+	try:
+		yield
+	finally:
+		_local.action = previous
+
+def timed_action(fn):
+	""" Counts SQL run by `fn` towards its name. """
+	name = fn.__name__
+	@wraps(fn)
+	def inner(*args, **kwargs):
+		previous = getattr(_local, 'action', '-')
+		_local.action = name
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			_local.action = previous
+	return inner
+
+def current_action() -> str:
+	""" The actions function running on this thread right now, or '-'. """
+	return getattr(_local, 'action', '-')
+
+def record_query(seconds: float, rows: int):
+	""" Records one SQL statement, towards whichever action is running it. """
+	labels = (('action', current_action()),)
+	observe('kstores_sql_duration_seconds', labels, seconds)
+	if rows > 0:
+		count('kstores_sql_rows_total', labels, rows)
+
+# - requests
+
+def _route() -> str:
+	rule = request.url_rule
+	return rule.rule if rule is not None else 'unmatched'
+
+def _before_request():
+	g.metrics_start = time.perf_counter()
+
+def _after_request(response: Response) -> Response:
+	start = g.pop('metrics_start', None)
+	if start is not None:
+		route = _route()
+		observe('kstores_http_request_duration_seconds', (('route', route),), time.perf_counter() - start)
+		count('kstores_http_requests_total', (
+			('route', route), ('method', request.method), ('status', str(response.status_code))
+		))
+	return response
+
+def record_error(error: str):
+	""" Counts a request that failed with an `error` exception. Call from inside the request. """
+	count('kstores_http_errors_total', (('route', _route()), ('error', error)))
+
+# - putting it together
+
+def _snapshot() -> dict:
+	""" This process's numbers, added up across its threads. """
+	total = Shard()
+	with _shards_lock:
+		_fold_finished()
+		total.add(_finished)
+		shards = [ shard for (_, shard) in _shards ]
+	for shard in shards:
+		# dict.copy() is atomic under the GIL, so the owning thread can keep writing.
+		total.add(shard)
+	
+	gauges: dict[tuple[str, Labels], float] = {}
+	for collect in _collectors:
+		for (name, labels, value) in collect():
+			gauges[(name, labels)] = gauges.get((name, labels), 0) + value
+	return { 'counters': total.counters, 'histograms': total.histograms, 'gauges': gauges }
+
+def _to_json(snapshot: dict) -> dict:
+	return {
+		kind: [ [name, [list(pair) for pair in labels], value] for ((name, labels), value) in values.items() ]
+		for (kind, values) in snapshot.items()
+	}
+
+def _from_json(data: dict) -> dict:
+	return {
+		kind: { (name, tuple(tuple(pair) for pair in labels)): value for (name, labels, value) in values }
+		for (kind, values) in data.items()
+	}
+
+def _merge(into: dict, other: dict):
+	for (kind, values) in other.items():
+		for (key, value) in values.items():
+			if kind == 'histograms':
+				merged = into[kind].setdefault(key, [0] * len(value))
+				for (i, v) in enumerate(value):
+					merged[i] += v
+			else:
+				into[kind][key] = into[kind].get(key, 0) + value
+
+def _worker_file(pid: int) -> str:
+	return os.path.join(metrics_dir, f"{pid}.json") # type: ignore
+
+def flush():
+	""" Writes this process's numbers to its file in `metrics_dir`, for the other workers. """
+	if metrics_dir is None:
+		return
+	path = _worker_file(os.getpid())
+	temp = path + ".tmp"
+	with open(temp, 'w') as f:
+		json.dump(_to_json(_snapshot()), f)
+	os.replace(temp, path)
+
+def _other_workers() -> Iterable[dict]:
+	if metrics_dir is None:
+		return
+	me = os.getpid()
+	for filename in os.listdir(metrics_dir):
+		if not filename.endswith('.json'):
+			continue
+		pid = int(filename.removesuffix('.json'))
+		if pid == me:
+			continue
+		try:
+			os.kill(pid, 0)
+		except ProcessLookupError:
+			# Worker died without cleaning up after itself.
+			remove_worker_file(pid)
+			continue
+		except PermissionError:
+			pass
+		try:
+			with open(_worker_file(pid)) as f:
+				yield _from_json(json.load(f))
+		except (OSError, ValueError):
+			continue
+
+def remove_worker_file(pid: int | None = None):
+	""" Deletes a worker's file (by default, this process's). Call when the worker exits. """
+	if metrics_dir is None:
+		return
+	try:
+		os.remove(_worker_file(os.getpid() if pid is None else pid))
+	except FileNotFoundError:
+		pass
+
+def _flush_forever():
+	while True:
+		time.sleep(flush_interval)
+		try:
+			flush()
+		except OSError as e:
+			print("couldn't write metrics:", type(e).__name__, str(e))
+
+def start_flushing():
+	""" Starts writing this process's numbers to `metrics_dir` every `flush_interval` seconds. """
+	if metrics_dir is None:
+		return
+	os.makedirs(metrics_dir, exist_ok=True)
+	threading.Thread(target=_flush_forever, name='metrics-flush', daemon=True).start()
+
+def reset_after_fork():
+	""" Forgets the parent process's numbers and starts flushing this one's. Call first thing in a forked worker. """
+	global _local, _shards, _finished
+	_local = threading.local()
+	_shards = []
+	_finished = Shard()
+	start_flushing()
+
+def _escape(value: str) -> str:
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: Labels) -> str:
+	if not labels:
+		return ''
+	return '{' + ','.join(f'{k}="{_escape(v)}"' for (k, v) in labels) + '}'
+
+def render() -> str:
+	""" Everything, for every worker, in Prometheus' text format. """
+	snapshot = _snapshot()
+	for other in _other_workers():
+		_merge(snapshot, other)
+	
+	by_name: dict[str, list[tuple[Labels, object]]] = {}
+	# Histograms missing from `descriptions` still have to come out as histograms.
+	undescribed: dict[str, str] = {}
+	for (snapshot_kind, values) in snapshot.items():
+		for ((name, labels), value) in values.items():
+			by_name.setdefault(name, []).append((labels, value))
+			undescribed[name] = 'histogram' if snapshot_kind == 'histograms' else 'untyped'
+	
+	lines = []
+	for name in sorted(by_name):
+		(kind, help_text) = descriptions.get(name, (undescribed[name], ''))
+		lines.append(f"# HELP {name} {help_text}")
+		lines.append(f"# TYPE {name} {kind}")
+		for (labels, value) in sorted(by_name[name]):
+			if kind != 'histogram':
+				lines.append(f"{name}{_format_labels(labels)} {value}")
+				continue
+			cumulative = 0
+			for (bound, bucket_count) in zip((*buckets, '+Inf'), value): # type: ignore
+				cumulative += bucket_count
+				lines.append(f"{name}_bucket{_format_labels((*labels, ('le', str(bound))))} {cumulative}")
+			lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}") # type: ignore
+			lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+	return "\n".join(lines) + "\n"
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+def init_app(app: Flask):
+	"""
+	Times every request to `app`. Call this before setting up anything else
+	that changes responses (like compression), so that time counts too.
+	"""
+	app.before_request(_before_request)
+	app.after_request(_after_request)
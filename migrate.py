@@ -0,0 +1,194 @@
+"""
+Applies schema changes to an existing database, without starting it over
+like ddl.sql does.
+
+Each change is a file in migrations/ named like `0001_what_it_does.sql`. They
+run in number order, and each one that finishes is recorded in the
+`schema_migrations` table, so it's never run twice. Migrations should still be
+safe to run again (CREATE ... IF NOT EXISTS and friends): MariaDB commits DDL
+as it goes, so a migration that fails halfway can't be rolled back, and it'll
+be run from the top next time.
+
+Files can hold several statements, separated by `;`. Use `DELIMITER` (like in
+the mysql command line) around triggers and anything else with `;` inside.
+
+Run with `python migrate.py --help` to see the options.
+"""
+
+import os
+import re
+import sys
+import hashlib
+import argparse
+
+from mariadb import mariadb, Cursor
+
+from db import db_config
+
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+_filename = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+class Migration:
+	def __init__(self, version: int, name: str, path: str):
+		self.version = version
+		self.name = name
+		self.path = path
+		with open(path, 'rb') as f:
+			self.source = f.read().decode('utf-8')
+		self.checksum = hashlib.sha256(self.source.encode('utf-8')).hexdigest()
+	
+	def statements(self) -> list[str]:
+		return split_statements(self.source)
+
+def find_migrations(directory: str = migrations_dir) -> list[Migration]:
+	""" Every migration in `directory`, in version order. """
+	migrations = []
+	for filename in os.listdir(directory):
+		match = _filename.match(filename)
+		if match is None:
+			continue
+		migrations.append(Migration(int(match[1]), match[2], os.path.join(directory, filename)))
+	migrations.sort(key=lambda m: m.version)
+	for (a, b) in zip(migrations, migrations[1:]):
+		if a.version == b.version:
+			raise Exception(f"two migrations numbered {a.version}: {a.name} and {b.name}")
+	return migrations
+
+def split_statements(source: str) -> list[str]:
+	"""
+	Splits a script into statements. Understands `-- comments` and `DELIMITER`
+	lines, and doesn't split on delimiters inside quotes.
+	"""
+	statements = []
+	delimiter = ';'
+	current = []
+	quote = None
+	for line in source.splitlines():
+		if quote is None and not current and line.strip().upper().startswith('DELIMITER '):
+			delimiter = line.strip().split()[1]
+			continue
+		if quote is None and line.strip().startswith('--'):
+			continue
+		
+		i = 0
+		start = 0
+		while i < len(line):
+			char = line[i]
+			if quote is not None:
+				if char == '\\':
+					i += 1
+				elif char == quote:
+					quote = None
+			elif char in '\'"`':
+				quote = char
+			elif line.startswith('--', i):
+				break
+			elif line.startswith(delimiter, i):
+				current.append(line[start:i])
+				statement = '\n'.join(current).strip()
+				if statement:
+					statements.append(statement)
+				current = []
+				i += len(delimiter)
+				start = i
+				continue
+			i += 1
+		rest = line[start:] if quote is not None else line[start:i]
+		if rest.strip() or current:
+			current.append(rest)
+	
+	leftover = '\n'.join(current).strip()
+	if leftover:
+		statements.append(leftover)
+	return statements
+
+def ensure_table(cur: Cursor):
+	cur.execute("""
+		CREATE TABLE IF NOT EXISTS schema_migrations (
+			version INT NOT NULL,
+			name VARCHAR(255) NOT NULL,
+			checksum CHAR(64) NOT NULL,
+			applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			
+			PRIMARY KEY (version)
+		);
+	""")
+
+def applied_versions(cur: Cursor) -> dict[int, str]:
+	""" version -> checksum, for every migration that's been applied. """
+	ensure_table(cur)
+	cur.execute("SELECT version, checksum FROM schema_migrations;")
+	return { version: checksum for (version, checksum) in cur }
+
+def apply(cur: Cursor, migration: Migration):
+	for statement in migration.statements():
+		cur.execute(statement)
+	cur.execute("""
+		INSERT INTO schema_migrations (version, name, checksum)
+		VALUES (?, ?, ?);
+	""", (migration.version, migration.name, migration.checksum))
+
+def migrate(conn, target: int | None = None, dry_run: bool = False) -> list[Migration]:
+	"""
+	Applies every migration that hasn't been (up to `target`, if given).
+	Returns the ones it applied, or would have, with `dry_run`.
+	"""
+	cur = conn.cursor()
+	applied = applied_versions(cur)
+	conn.commit()
+	
+	pending = []
+	for migration in find_migrations():
+		if migration.version in applied:
+			if applied[migration.version] != migration.checksum:
+				print(f"warning! {os.path.basename(migration.path)} changed after it was applied", file=sys.stderr)
+			continue
+		if target is not None and migration.version > target:
+			break
+		pending.append(migration)
+	
+	for migration in pending:
+		print(f"applying {os.path.basename(migration.path)}", file=sys.stderr)
+		if dry_run:
+			for statement in migration.statements():
+				print(statement + ";\n")
+			continue
+		try:
+			apply(cur, migration)
+			conn.commit()
+		except mariadb.Error:
+			conn.rollback()
+			raise
+	cur.close()
+	return pending
+
+def status(conn):
+	cur = conn.cursor()
+	applied = applied_versions(cur)
+	conn.commit()
+	cur.close()
+	for migration in find_migrations():
+		state = 'applied' if migration.version in applied else 'pending'
+		if migration.version in applied and applied[migration.version] != migration.checksum:
+			state = 'applied, but changed since'
+		print(f"{migration.version:04d} {migration.name:<40} {state}")
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Applies the schema migrations in migrations/ that haven't been applied yet.")
+	parser.add_argument('--status', action='store_true', help="list migrations and whether they've been applied, without applying any")
+	parser.add_argument('--to', type=int, help="stop after this version")
+	parser.add_argument('--dry-run', action='store_true', help="print what would run, without running it")
+	args = parser.parse_args()
+	
+	try:
+		conn = mariadb.connect(**db_config)
+		if args.status:
+			status(conn)
+		else:
+			applied = migrate(conn, args.to, args.dry_run)
+			print(f"{len(applied)} migration(s) {'pending' if args.dry_run else 'applied'}", file=sys.stderr)
+		conn.close()
+	except mariadb.Error as e:
+		print(f"Database Error:\n{e}")
+		sys.exit(1)
@@ -0,0 +1,31 @@
+-- Indexes for the lookups the routes do all the time, which ddl.sql left out.
+-- Built online (ALGORITHM=INPLACE, LOCK=NONE), so the store keeps taking
+-- reads and writes while they build.
+
+-- check_login, and looking customers up by email
+CREATE INDEX IF NOT EXISTS idx_customer_email
+	ON customer (email)
+	ALGORITHM=INPLACE LOCK=NONE;
+
+-- list_orders: a customer's orders, in order_id order.
+-- (InnoDB already made an index on customer_id for the foreign key,
+--  but this one's explicit, and covers the keyset order too.)
+CREATE INDEX IF NOT EXISTS idx_order_customer
+	ON `order` (customer_id, order_id)
+	ALGORITHM=INPLACE LOCK=NONE;
+
+-- update_customer_address checks whether any order still uses an address.
+-- shipping_address has a foreign key (and so an index); billing_address doesn't.
+CREATE INDEX IF NOT EXISTS idx_order_billing_address
+	ON `order` (billing_address)
+	ALGORITHM=INPLACE LOCK=NONE;
+
+-- create_address looks for an identical address before making a new one
+CREATE INDEX IF NOT EXISTS idx_address_lookup
+	ON address (street, city, state, zip)
+	ALGORITHM=INPLACE LOCK=NONE;
+
+-- category filters in search_catalog and the catalog index rebuild
+CREATE INDEX IF NOT EXISTS idx_item_category
+	ON item_catalog (category)
+	ALGORITHM=INPLACE LOCK=NONE;
@@ -0,0 +1,7 @@
+-- Passwords are stored as scrypt hashes now (see session.py), which are
+-- longer than the plaintext ones were. Plaintext passwords still in here get
+-- hashed the next time their customer signs in.
+-- Widening a VARCHAR like this doesn't copy the table.
+ALTER TABLE customer
+	MODIFY password VARCHAR(255) NOT NULL,
+	ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,76 @@
+-- Keeps a count, on each address, of the customer and order columns that
+-- point at it, so update_customer_address can tell whether an address is
+-- shared by reading one row, instead of counting through `order`.
+-- A customer whose shipping and billing address are the same counts twice.
+
+ALTER TABLE address
+	ADD COLUMN IF NOT EXISTS ref_count INT NOT NULL DEFAULT 0,
+	ALGORITHM=INPLACE, LOCK=NONE;
+
+-- (x <=> y) is 1 if they're equal (NULLs included) and 0 if not, so each
+-- trigger is one UPDATE, however the columns overlap.
+
+DELIMITER //
+
+CREATE TRIGGER IF NOT EXISTS customer_address_refs_insert
+AFTER INSERT ON customer FOR EACH ROW
+	UPDATE address
+	SET ref_count = ref_count
+		+ (address_id <=> NEW.shipping_address) + (address_id <=> NEW.billing_address)
+	WHERE address_id IN (NEW.shipping_address, NEW.billing_address)//
+
+CREATE TRIGGER IF NOT EXISTS customer_address_refs_update
+AFTER UPDATE ON customer FOR EACH ROW
+	IF NOT (OLD.shipping_address <=> NEW.shipping_address)
+	OR NOT (OLD.billing_address <=> NEW.billing_address) THEN
+		UPDATE address
+		SET ref_count = ref_count
+			+ (address_id <=> NEW.shipping_address) + (address_id <=> NEW.billing_address)
+			- (address_id <=> OLD.shipping_address) - (address_id <=> OLD.billing_address)
+		WHERE address_id IN (NEW.shipping_address, NEW.billing_address, OLD.shipping_address, OLD.billing_address);
+	END IF//
+
+CREATE TRIGGER IF NOT EXISTS customer_address_refs_delete
+AFTER DELETE ON customer FOR EACH ROW
+	UPDATE address
+	SET ref_count = ref_count
+		- (address_id <=> OLD.shipping_address) - (address_id <=> OLD.billing_address)
+	WHERE address_id IN (OLD.shipping_address, OLD.billing_address)//
+
+CREATE TRIGGER IF NOT EXISTS order_address_refs_insert
+AFTER INSERT ON `order` FOR EACH ROW
+	UPDATE address
+	SET ref_count = ref_count
+		+ (address_id <=> NEW.shipping_address) + (address_id <=> NEW.billing_address)
+	WHERE address_id IN (NEW.shipping_address, NEW.billing_address)//
+
+CREATE TRIGGER IF NOT EXISTS order_address_refs_update
+AFTER UPDATE ON `order` FOR EACH ROW
+	IF NOT (OLD.shipping_address <=> NEW.shipping_address)
+	OR NOT (OLD.billing_address <=> NEW.billing_address) THEN
+		UPDATE address
+		SET ref_count = ref_count
+			+ (address_id <=> NEW.shipping_address) + (address_id <=> NEW.billing_address)
+			- (address_id <=> OLD.shipping_address) - (address_id <=> OLD.billing_address)
+		WHERE address_id IN (NEW.shipping_address, NEW.billing_address, OLD.shipping_address, OLD.billing_address);
+	END IF//
+
+CREATE TRIGGER IF NOT EXISTS order_address_refs_delete
+AFTER DELETE ON `order` FOR EACH ROW
+	UPDATE address
+	SET ref_count = ref_count
+		- (address_id <=> OLD.shipping_address) - (address_id <=> OLD.billing_address)
+	WHERE address_id IN (OLD.shipping_address, OLD.billing_address)//
+
+DELIMITER ;
+
+-- Count up what's already there. The triggers exist by now, so nothing
+-- written from here on is missed; this sets the counts outright, so it's
+-- fine to run again. (Also the fix if the counts ever drift, say after
+-- TRUNCATE, which doesn't fire triggers.)
+UPDATE address a
+SET ref_count =
+	(SELECT COUNT(*) FROM customer c WHERE c.shipping_address = a.address_id)
+	+ (SELECT COUNT(*) FROM customer c WHERE c.billing_address = a.address_id)
+	+ (SELECT COUNT(*) FROM `order` o WHERE o.shipping_address = a.address_id)
+	+ (SELECT COUNT(*) FROM `order` o WHERE o.billing_address = a.address_id);
@@ -0,0 +1,59 @@
+-- Gives each address a fingerprint (address_key: SHA-256 of the tidied-up
+-- address, see addresses.py) with a unique index, so create_address finds or
+-- adds an address in one statement, and the same address can't be added twice.
+-- Addresses that turn out to be the same get merged into the oldest one.
+
+ALTER TABLE address
+	ADD COLUMN IF NOT EXISTS address_key BINARY(32) NULL,
+	ALGORITHM=INPLACE, LOCK=NONE;
+
+-- Has to match addresses.address_key exactly. Addresses that older code
+-- adds while this runs are left without a key: they still work, but won't be
+-- matched by create_address.
+UPDATE address
+SET address_key = UNHEX(SHA2(CONVERT(CONCAT_WS(CHAR(31 USING utf8mb4),
+	LOWER(TRIM(REGEXP_REPLACE(street, '[[:space:]]+', ' '))),
+	LOWER(TRIM(REGEXP_REPLACE(city, '[[:space:]]+', ' '))),
+	UPPER(TRIM(state)),
+	zip
+) USING utf8mb4), 256))
+WHERE address_key IS NULL;
+
+-- Every address that's a repeat of an older one -> that older one.
+-- (Its own table, since the ref_count triggers on customer and `order` write
+--  to address, and a statement can't read a table its triggers write to.)
+DROP TEMPORARY TABLE IF EXISTS address_merge;
+CREATE TEMPORARY TABLE address_merge (
+	address_id INT NOT NULL,
+	keep INT NOT NULL,
+	
+	PRIMARY KEY (address_id)
+)
+SELECT a.address_id, d.keep
+FROM address a
+JOIN (
+	SELECT address_key, MIN(address_id) AS keep
+	FROM address
+	GROUP BY address_key
+	HAVING COUNT(*) > 1
+) d USING (address_key)
+WHERE a.address_id <> d.keep;
+
+UPDATE customer c JOIN address_merge m ON m.address_id = c.shipping_address
+SET c.shipping_address = m.keep;
+UPDATE customer c JOIN address_merge m ON m.address_id = c.billing_address
+SET c.billing_address = m.keep;
+UPDATE `order` o JOIN address_merge m ON m.address_id = o.shipping_address
+SET o.shipping_address = m.keep;
+UPDATE `order` o JOIN address_merge m ON m.address_id = o.billing_address
+SET o.billing_address = m.keep;
+
+DELETE a FROM address a JOIN address_merge m USING (address_id);
+DROP TEMPORARY TABLE address_merge;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_address_key
+	ON address (address_key)
+	ALGORITHM=INPLACE LOCK=NONE;
+
+-- create_address doesn't look addresses up by their columns anymore.
+DROP INDEX IF EXISTS idx_address_lookup ON address;
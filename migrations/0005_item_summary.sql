@@ -0,0 +1,98 @@
+-- A summary of each item's variants, kept on item_catalog (where ddl.sql
+-- always meant price_min and price_max to go), so listings read one row per
+-- item instead of adding up variant_catalog every time:
+--   price_min, price_max -- cheapest and dearest variant (NULL with no variants)
+--   stock_total          -- stock of all the variants together
+--   variant_count
+--   sizes, colors        -- every size and color it comes in
+-- Triggers on variant_catalog keep them up to date, whoever writes to it
+-- (create_catalog_item, the bulk imports, checkout taking stock...).
+
+ALTER TABLE item_catalog
+	ADD COLUMN IF NOT EXISTS price_min DECIMAL(6,2) NULL,
+	ADD COLUMN IF NOT EXISTS price_max DECIMAL(6,2) NULL,
+	ADD COLUMN IF NOT EXISTS stock_total INT NOT NULL DEFAULT 0,
+	ADD COLUMN IF NOT EXISTS variant_count INT NOT NULL DEFAULT 0,
+	ADD COLUMN IF NOT EXISTS sizes SET('N/A', 'XS', 'S', 'M', 'L', 'XL') NOT NULL DEFAULT '',
+	ADD COLUMN IF NOT EXISTS colors TEXT NULL,
+	ALGORITHM=INPLACE, LOCK=NONE;
+
+DELIMITER //
+
+-- Works out one item's summary from scratch. Items only have a handful of
+-- variants, so this is cheap.
+CREATE OR REPLACE PROCEDURE refresh_item_summary(IN p_item_id INT)
+BEGIN
+	DECLARE v_price_min, v_price_max DECIMAL(6,2);
+	DECLARE v_stock_total, v_variant_count INT;
+	DECLARE v_sizes, v_colors TEXT;
+	
+	SELECT
+		MIN(price), MAX(price),
+		COALESCE(SUM(stock), 0), COUNT(*),
+		COALESCE(GROUP_CONCAT(DISTINCT size), ''),
+		GROUP_CONCAT(DISTINCT color ORDER BY color)
+	INTO
+		v_price_min, v_price_max,
+		v_stock_total, v_variant_count,
+		v_sizes, v_colors
+	FROM variant_catalog
+	WHERE item_id = p_item_id;
+	
+	UPDATE item_catalog
+	SET
+		price_min = v_price_min, price_max = v_price_max,
+		stock_total = v_stock_total, variant_count = v_variant_count,
+		sizes = v_sizes, colors = v_colors
+	WHERE item_id = p_item_id;
+END//
+
+CREATE TRIGGER IF NOT EXISTS variant_summary_insert
+AFTER INSERT ON variant_catalog FOR EACH ROW
+	CALL refresh_item_summary(NEW.item_id)//
+
+-- Checkout only ever changes stock, so that's just added on.
+CREATE TRIGGER IF NOT EXISTS variant_summary_update
+AFTER UPDATE ON variant_catalog FOR EACH ROW
+BEGIN
+	IF NEW.item_id = OLD.item_id
+	AND NEW.price = OLD.price
+	AND NEW.size = OLD.size
+	AND NEW.color <=> OLD.color THEN
+		IF NEW.stock <> OLD.stock THEN
+			UPDATE item_catalog
+			SET stock_total = stock_total + CAST(NEW.stock AS SIGNED) - CAST(OLD.stock AS SIGNED)
+			WHERE item_id = NEW.item_id;
+		END IF;
+	ELSE
+		CALL refresh_item_summary(NEW.item_id);
+		IF NEW.item_id <> OLD.item_id THEN
+			CALL refresh_item_summary(OLD.item_id);
+		END IF;
+	END IF;
+END//
+
+CREATE TRIGGER IF NOT EXISTS variant_summary_delete
+AFTER DELETE ON variant_catalog FOR EACH ROW
+	CALL refresh_item_summary(OLD.item_id)//
+
+DELIMITER ;
+
+-- Fill in what's already there: all at once, not one CALL per item. Sets the
+-- summaries outright, so running it again (say, if they ever drift) is fine.
+UPDATE item_catalog i
+LEFT JOIN (
+	SELECT
+		item_id,
+		MIN(price) AS price_min, MAX(price) AS price_max,
+		SUM(stock) AS stock_total, COUNT(*) AS variant_count,
+		GROUP_CONCAT(DISTINCT size) AS sizes,
+		GROUP_CONCAT(DISTINCT color ORDER BY color) AS colors
+	FROM variant_catalog
+	GROUP BY item_id
+) s USING (item_id)
+SET
+	i.price_min = s.price_min, i.price_max = s.price_max,
+	i.stock_total = COALESCE(s.stock_total, 0), i.variant_count = COALESCE(s.variant_count, 0),
+	i.sizes = COALESCE(s.sizes, ''), i.colors = s.colors;
+
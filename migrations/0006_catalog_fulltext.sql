@@ -0,0 +1,8 @@
+-- A FULLTEXT index on item names and descriptions, for search_catalog's `q`
+-- when it runs in SQL. (/catalog/search normally answers `q` out of the
+-- in-memory index in catalog_index, which doesn't need this.)
+-- InnoDB can't build the first FULLTEXT index on a table without LOCK=SHARED:
+-- reads keep going, but catalog writes wait until it's done.
+CREATE FULLTEXT INDEX IF NOT EXISTS ft_item_text
+	ON item_catalog (item_name, description)
+	ALGORITHM=INPLACE LOCK=SHARED;
@@ -0,0 +1,49 @@
+-- item_catalog.colors becomes a JSON array. It was the colors joined with
+-- commas, which split "Black, White" style color names in two.
+
+DELIMITER //
+
+-- Same as in 0005, but for colors.
+CREATE OR REPLACE PROCEDURE refresh_item_summary(IN p_item_id INT)
+BEGIN
+	DECLARE v_price_min, v_price_max DECIMAL(6,2);
+	DECLARE v_stock_total, v_variant_count INT;
+	DECLARE v_sizes, v_colors TEXT;
+	
+	SELECT
+		MIN(price), MAX(price),
+		COALESCE(SUM(stock), 0), COUNT(*),
+		COALESCE(GROUP_CONCAT(DISTINCT size), '')
+	INTO
+		v_price_min, v_price_max,
+		v_stock_total, v_variant_count,
+		v_sizes
+	FROM variant_catalog
+	WHERE item_id = p_item_id;
+	
+	-- NULL if no variant has a color.
+	SELECT JSON_ARRAYAGG(DISTINCT color ORDER BY color)
+	INTO v_colors
+	FROM variant_catalog
+	WHERE item_id = p_item_id
+	AND color IS NOT NULL;
+	
+	UPDATE item_catalog
+	SET
+		price_min = v_price_min, price_max = v_price_max,
+		stock_total = v_stock_total, variant_count = v_variant_count,
+		sizes = v_sizes, colors = v_colors
+	WHERE item_id = p_item_id;
+END//
+
+DELIMITER ;
+
+-- Redo everyone's colors. Sets them outright, so running it again is fine.
+UPDATE item_catalog i
+LEFT JOIN (
+	SELECT item_id, JSON_ARRAYAGG(DISTINCT color ORDER BY color) AS colors
+	FROM variant_catalog
+	WHERE color IS NOT NULL
+	GROUP BY item_id
+) s USING (item_id)
+SET i.colors = s.colors;
@@ -0,0 +1,24 @@
+-- When each catalog row last changed, so every worker's in-memory catalog
+-- index (catalog_index.py) can notice writes made by other workers: it asks
+-- for MAX(updated) of both tables every couple of seconds, and rebuilds if
+-- that moved. The indexes make that two lookups instead of two scans.
+-- Checkout taking stock counts as a change too (the variant's stock, and the
+-- item's stock_total through the triggers from 0005).
+
+ALTER TABLE item_catalog
+	ADD COLUMN IF NOT EXISTS updated TIMESTAMP(6) NOT NULL
+		DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+	ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE variant_catalog
+	ADD COLUMN IF NOT EXISTS updated TIMESTAMP(6) NOT NULL
+		DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+	ALGORITHM=INPLACE, LOCK=NONE;
+
+CREATE INDEX IF NOT EXISTS idx_item_updated
+	ON item_catalog (updated)
+	ALGORITHM=INPLACE LOCK=NONE;
+
+CREATE INDEX IF NOT EXISTS idx_variant_updated
+	ON variant_catalog (updated)
+	ALGORITHM=INPLACE LOCK=NONE;
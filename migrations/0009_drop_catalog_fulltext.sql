@@ -0,0 +1,6 @@
+-- The FULLTEXT index from 0006 was only there for the SQL version of the
+-- catalog search's `q`, which is gone: /catalog/search answers it out of the
+-- in-memory index in catalog_index. Dropping it saves every catalog write
+-- from keeping it up to date.
+DROP INDEX IF EXISTS ft_item_text ON item_catalog
+	ALGORITHM=INPLACE LOCK=NONE;
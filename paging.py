@@ -0,0 +1,78 @@
+import base64
+from collections.abc import Callable
+from typing import Any
+
+# Keyset (a.k.a. seek) pagination helpers.
+#
+# Listings are always sorted by their key, and each page picks up right after
+# the last key of the previous one, so fetching page 500 costs the same as
+# fetching page 1 -- no OFFSET that has to skip over everything before it.
+# The key is handed to the client as an opaque cursor string.
+
+default_limit = 100
+max_limit = 500
+
+def clamp_limit(limit: int | None) -> int:
+	""" Turns the client's requested page size into one we're willing to serve. """
+	if limit is None or limit <= 0:
+		return default_limit
+	return min(limit, max_limit)
+
+def encode_cursor(key: tuple[int, ...]) -> str:
+	""" Packs a row's key into a cursor string for the client. """
+	raw = ','.join(str(int(k)) for k in key).encode()
+	return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def decode_cursor(cursor: str | None) -> tuple[int, ...] | None:
+	""" Unpacks a cursor from `encode_cursor`. No cursor means "start from the beginning". """
+	if not cursor:
+		return None
+	try:
+		raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+		return tuple(int(k) for k in raw.decode().split(','))
+	except ValueError:
+		raise Exception("invalid cursor")
+
+def keyset_condition(columns: list[str], after: tuple[int, ...] | None) -> tuple[str, list]:
+	"""
+	Builds the SQL condition for "key comes after `after`", for a key made of `columns`.
+	Written out as ORs instead of a row comparison so MariaDB can use the index range.
+	Returns an always-true condition if there's no `after`.
+	"""
+	if after is None:
+		return ("1=1", [])
+	if len(after) != len(columns):
+		raise Exception("invalid cursor")
+	
+	parts = []
+	params = []
+	for i in range(len(columns)):
+		# (a > ?) OR (a = ? AND b > ?) OR ...
+		part = [ f"{column} = ?" for column in columns[:i] ] + [ f"{columns[i]} > ?" ]
+		parts.append("(" + " AND ".join(part) + ")")
+		params += list(after[:i + 1])
+	return ("(" + " OR ".join(parts) + ")", params)
+
+def limit_clause(limit: int | None) -> tuple[str, list]:
+	""" Builds an SQL LIMIT clause, or nothing if `limit` is None. """
+	if limit is None:
+		return ("", [])
+	return ("LIMIT ?", [limit])
+
+def paginate(
+	fetch: Callable[..., list[dict[str, Any]]],
+	limit: int | None, cursor: str | None,
+	key: Callable[[dict[str, Any]], tuple[int, ...]]
+) -> tuple[list[dict[str, Any]], str | None]:
+	"""
+	Fetches one page. `fetch(limit=..., after=...)` should return rows sorted by
+	`key`, starting after the key `after`. Asks for one extra row to find out if
+	there's another page. Returns the page and the cursor for the next page,
+	which is None on the last one.
+	"""
+	limit = clamp_limit(limit)
+	rows = fetch(limit=limit + 1, after=decode_cursor(cursor))
+	if len(rows) > limit:
+		rows = rows[:limit]
+		return (rows, encode_cursor(key(rows[-1])))
+	return (rows, None)
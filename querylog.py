@@ -0,0 +1,171 @@
+"""
+Keeps an eye on the SQL that requests actually run. Lots of it is put together
+on the fly (get_item_summaries, edit_customer...), so this is the easiest place to
+see what reaches the database.
+
+- Statements slower than `slow_threshold` are logged, with their EXPLAIN plan.
+  Their parameters are customers' emails, addresses and such, so only their
+  types are shown unless `log_params` is on.
+- Requests that run more than `max_statements` statements are logged too,
+  with the statements they repeated most; usually that's a loop that should've
+  been one query.
+
+The latest of both are kept in memory, for /queries/slow.
+"""
+
+import os
+import re
+import time
+import threading
+from collections import Counter, deque
+
+from flask import has_request_context, request
+
+import metrics
+from cache import LRUCache
+
+# Statements that take at least this many seconds get logged.
+slow_threshold = float(os.environ.get('KSTORES_SLOW_QUERY_SECONDS', 0.5))
+
+# Requests that run more statements than this get logged. Most routes run
+# one or two; an address edit running five is the kind of thing to catch.
+max_statements = int(os.environ.get('KSTORES_MAX_STATEMENTS', 4))
+
+# Routes that run more on purpose, with their own limit (None: not checked).
+# Checkout is five statements whatever's in the cart; /batch is however many
+# operations it was sent.
+route_limits: dict[str, int | None] = {
+	'/cart/checkout': 5,
+	'/batch': None,
+}
+
+# Whether slow statements are logged with their actual parameters.
+log_params = os.environ.get('KSTORES_QUERY_LOG_PARAMS') == '1'
+
+# How many of each to remember.
+history_size = int(os.environ.get('KSTORES_QUERY_LOG_SIZE', 100))
+
+_slow: deque[dict] = deque(maxlen=history_size)
+_chatty: deque[dict] = deque(maxlen=history_size)
+_lock = threading.Lock()
+
+# normalized statement -> EXPLAIN rows. The same slow statement tends to come
+# back over and over, and its plan doesn't change that often.
+_plans = LRUCache(max_size=256, ttl=300)
+
+_whitespace = re.compile(r'\s+')
+
+# Only these can be EXPLAINed.
+_explainable = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE')
+
+def normalize_sql(statement: str) -> str:
+	""" The statement on one line, without the indentation. """
+	return _whitespace.sub(' ', statement).strip()
+
+def normalize_value(value):
+	""" Something short and JSON friendly to show for one parameter. """
+	if value is None or isinstance(value, (bool, int, float)):
+		return value
+	text = str(value)
+	if len(text) > 64:
+		return text[:61] + '...'
+	return text
+
+def redact_value(value) -> str | None:
+	""" What's shown for one parameter when `log_params` is off: just its type. """
+	return None if value is None else f"<{type(value).__name__}>"
+
+def normalize_params(statement: str, params, many: bool = False) -> list | None:
+	"""
+	The statement's parameters, shortened so they're readable (or, unless
+	`log_params` is on, just their types). Rows from an executemany are cut
+	down to the first few. Anything sent along with a password is left out
+	entirely either way.
+	"""
+	if params is None:
+		return None
+	if 'password' in statement.lower():
+		return ['(hidden)']
+	show = normalize_value if log_params else redact_value
+	params = list(params)
+	if many:
+		shown = [ [show(v) for v in row] for row in params[:3] ]
+		if len(params) > 3:
+			shown.append(f"... {len(params) - 3} more rows")
+		return shown
+	return [ show(v) for v in params ]
+
+def explain(conn, sql: str, params) -> list[dict] | str:
+	"""
+	EXPLAINs a statement on `conn` (on its own cursor, so the request's results
+	aren't touched). Returns the plan's rows, or why there isn't one.
+	"""
+	if not sql.upper().startswith(_explainable):
+		return "not explainable"
+	plan = _plans.get(sql)
+	if plan is not None:
+		return plan
+	cur = conn.cursor()
+	try:
+		cur.execute("EXPLAIN " + sql, params)
+		columns = [ d[0] for d in cur.description ]
+		plan = [ dict(zip(columns, map(normalize_value, row))) for row in cur ]
+	except Exception as e:
+		return f"couldn't explain: {type(e).__name__}: {e}"
+	finally:
+		cur.close()
+	_plans.put(sql, plan)
+	return plan
+
+def _where() -> str | None:
+	return f"{request.method} {request.path}" if has_request_context() else None
+
+def record_slow(conn, statement: str, params, seconds: float, many: bool = False):
+	""" Logs a slow statement that just ran on `conn`, with its plan. """
+	sql = normalize_sql(statement)
+	# For an executemany, the first row's as good as any to EXPLAIN with.
+	explain_params = (params[0] if many and params else params) or ()
+	plan = explain(conn, sql, explain_params)
+	entry = {
+		'at': time.time(),
+		'seconds': seconds,
+		'request': _where(),
+		'action': metrics.current_action(),
+		'sql': sql,
+		'params': normalize_params(statement, params, many),
+		'plan': plan
+	}
+	with _lock:
+		_slow.append(entry)
+	print(f"slow query ({seconds * 1000:.1f} ms) in {entry['action']}: {sql[:200]}")
+
+def check_statement_count(statements: Counter):
+	""" Logs the request if it ran too many statements. `statements` counts how often each one ran. """
+	limit = route_limits.get(request.path, max_statements) if has_request_context() else max_statements
+	total = sum(statements.values())
+	if limit is None or total <= limit:
+		return
+	entry = {
+		'at': time.time(),
+		'request': _where(),
+		'statements': total,
+		'repeated': [
+			{ 'sql': normalize_sql(statement)[:300], 'times': times }
+			for (statement, times) in statements.most_common(5)
+			if times > 1
+		]
+	}
+	with _lock:
+		_chatty.append(entry)
+	print(f"{entry['request']} ran {total} SQL statements")
+
+def recent() -> dict:
+	""" The latest slow statements and chatty requests, newest first. """
+	with _lock:
+		return {
+			'slow_threshold': slow_threshold,
+			'max_statements': max_statements,
+			'route_limits': route_limits,
+			'slow': list(reversed(_slow)),
+			'chatty': list(reversed(_chatty))
+		}
@@ -0,0 +1,199 @@
+"""
+Passwords and sign-in sessions.
+
+Passwords are stored as scrypt hashes, which are slow to check on purpose.
+The hashing runs on a small pool of threads (scrypt lets go of the GIL while it
+works), so a burst of sign-ins can only ever keep that many cores busy.
+
+Signing in hands out a token: the customer id and an expiry time, signed with
+KSTORES_SECRET. Any worker can check a token with one HMAC, without asking the
+database. Signing out puts the token on a revocation list, which is kept in
+memory -- per process, so under gunicorn a signed-out token keeps working on
+the other workers until it expires. Keep KSTORES_SESSION_TTL short-ish.
+
+Requests show their token in an `Authorization: Bearer <token>` header (only
+there: query strings end up in access logs). Routes with a `customer` parameter
+refuse requests without that customer's token, unless KSTORES_REQUIRE_SESSION=0
+lets requests without a token through, for frontends that don't send one yet.
+
+The monitoring routes (/metrics, /pool/stats, /cache/stats, /queries/slow) take
+KSTORES_ADMIN_TOKEN the same way instead, and are closed if it isn't set.
+"""
+
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+
+from flask import request
+
+# Signs the tokens. Every server process has to have the same one; if it's
+# not set, tokens only work until the server restarts.
+secret = os.environ.get('KSTORES_SECRET', '').encode() or secrets.token_bytes(32)
+if 'KSTORES_SECRET' not in os.environ:
+	print("warning! KSTORES_SECRET isn't set, so sessions won't survive a restart")
+
+# How many seconds a token is good for.
+session_ttl = int(os.environ.get('KSTORES_SESSION_TTL', 12 * 3600))
+
+# Routes that act for a customer won't do anything without that customer's
+# token. Turning it off lets anyone act for any customer by sending their id,
+# so it's only for frontends that don't send tokens yet.
+session_required = os.environ.get('KSTORES_REQUIRE_SESSION', '1') != '0'
+
+# Lets a request into the monitoring routes. Unset, nobody gets in.
+admin_token = os.environ.get('KSTORES_ADMIN_TOKEN', '').encode() or None
+
+# scrypt settings: about 50ms and 16MB per hash. Stored with each hash, so
+# they can be raised later without breaking existing passwords.
+scrypt_n = 2 ** 14
+scrypt_r = 8
+scrypt_p = 1
+
+_hasher = ThreadPoolExecutor(
+	max_workers=int(os.environ.get('KSTORES_HASH_WORKERS', 2)),
+	thread_name_prefix='password-hash'
+)
+
+# token id -> when it expires. Expired ones are dropped every so many sign-outs.
+_revoked: dict[str, float] = {}
+_revoked_lock = threading.Lock()
+_revocations = 0
+
+def _b64encode(data: bytes) -> str:
+	return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _b64decode(text: str) -> bytes:
+	return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+# - passwords
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+	return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32, maxmem=64 * 1024 * 1024)
+
+def _hash_password(password: str) -> str:
+	salt = secrets.token_bytes(16)
+	digest = _scrypt(password, salt, scrypt_n, scrypt_r, scrypt_p)
+	return f"scrypt${scrypt_n}${scrypt_r}${scrypt_p}${_b64encode(salt)}${_b64encode(digest)}"
+
+def _verify_password(stored: str, password: str) -> tuple[bool, bool]:
+	if not stored.startswith('scrypt$'):
+		# From before passwords were hashed. Still does a hash's worth of work,
+		# or how fast the answer comes back would tell these accounts apart.
+		_verify_password(dummy_hash(), password)
+		return (hmac.compare_digest(stored.encode(), password.encode()), True)
+	(_, n, r, p, salt, digest) = stored.split('$')
+	(n, r, p) = (int(n), int(r), int(p))
+	valid = hmac.compare_digest(_scrypt(password, _b64decode(salt), n, r, p), _b64decode(digest))
+	return (valid, (n, r, p) != (scrypt_n, scrypt_r, scrypt_p))
+
+class PasswordHash(str):
+	""" A password that's already been through `hash_password`, so it isn't hashed again. """
+
+def hash_password(password: str) -> PasswordHash:
+	"""
+	Hashes a password for storing (on the hashing threads). Routes do this
+	before running any SQL, so they aren't holding a connection meanwhile.
+	"""
+	if isinstance(password, PasswordHash):
+		return password
+	return PasswordHash(_hasher.submit(_hash_password, password).result())
+
+def verify_password(stored: str, password: str) -> tuple[bool, bool]:
+	"""
+	Checks a password against what's stored for it (on the hashing threads).
+	Returns whether it matched, and whether what's stored should be replaced
+	with a fresh `hash_password` -- because it's a plaintext password from
+	before hashing, or was hashed with older settings.
+	"""
+	return _hasher.submit(_verify_password, stored, password).result()
+
+@cache
+def dummy_hash() -> str:
+	"""
+	A hash to check passwords against when there's no such customer,
+	so that takes as long as a wrong password does.
+	"""
+	return _hash_password(secrets.token_urlsafe(16))
+
+# - tokens
+
+def _sign(payload: bytes) -> bytes:
+	return hmac.new(secret, payload, hashlib.sha256).digest()
+
+def create_token(customer_id: int) -> str:
+	""" A token that proves its holder signed in as `customer_id`, for `session_ttl` seconds. """
+	payload = json.dumps({
+		'customer': customer_id,
+		'expires': int(time.time()) + session_ttl,
+		'id': secrets.token_urlsafe(9)
+	}, separators=(',', ':')).encode()
+	return f"{_b64encode(payload)}.{_b64encode(_sign(payload))}"
+
+def read_token(token: str) -> dict | None:
+	""" The token's contents, if it's genuine, unexpired and not signed out. Otherwise None. """
+	try:
+		(payload_text, signature) = token.split('.')
+		payload = _b64decode(payload_text)
+		if not hmac.compare_digest(_sign(payload), _b64decode(signature)):
+			return None
+		session = json.loads(payload)
+	except ValueError:
+		return None
+	if session['expires'] < time.time() or session['id'] in _revoked:
+		return None
+	return session
+
+def revoke_token(token: str) -> bool:
+	""" Signs a token out. Returns False if it wasn't valid to begin with. """
+	session = read_token(token)
+	if session is None:
+		return False
+	global _revocations
+	now = time.time()
+	with _revoked_lock:
+		_revoked[session['id']] = session['expires']
+		_revocations += 1
+		if _revocations % 1024 == 0:
+			for (token_id, expires) in list(_revoked.items()):
+				if expires < now:
+					del _revoked[token_id]
+	return True
+
+# - requests
+
+def request_token() -> str | None:
+	""" The token the current request came with, if any. """
+	header = request.headers.get('Authorization', '')
+	if header.startswith('Bearer '):
+		return header[len('Bearer '):].strip() or None
+	return None
+
+def is_admin() -> bool:
+	""" Whether the current request came with the admin token. """
+	token = request_token()
+	return admin_token is not None and token is not None \
+		and hmac.compare_digest(token.encode(), admin_token)
+
+def authorize(customer_id: int | None):
+	"""
+	Makes sure the current request may act for `customer_id`: its token has to
+	be for that customer. Requests without a token get through unless
+	`session_required` is on.
+	"""
+	token = request_token()
+	if token is None:
+		if session_required:
+			raise Exception("sign in first")
+		return
+	session = read_token(token)
+	if session is None:
+		raise Exception("session expired or invalid; sign in again")
+	if customer_id is not None and session['customer'] != customer_id:
+		raise Exception("that's not your account")
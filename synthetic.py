@@ -0,0 +1,271 @@
+"""
+Makes up a store's worth of data -- catalog, customers, addresses, carts and
+orders -- at any size, for finding out what gets slow once there's a lot of it.
+Run through `python generate.py --scale N`.
+
+Scale factor 1 is about 2,000 items and 20,000 customers; everything grows in
+proportion. Some items are much more popular than others (Zipf's law), and
+some customers order over and over while most order once or never.
+
+Rows are streamed into TSV files (split into parts, made on several processes
+at once) and loaded with LOAD DATA, so memory stays flat however big it gets:
+the only thing held for the whole run is a few bytes per catalog item.
+Everything is derived from the seed, so the same arguments make the same data
+(except that order dates count back from when it runs).
+"""
+
+import os
+import sys
+import time
+import random
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+from multiprocessing import Pool
+
+from addresses import address_key
+from generate import tsv_file, tsv_value, load_statement, priceFromSize
+
+items_per_scale = 2_000
+customers_per_scale = 20_000
+
+# How hard popularity falls off: the n-th most popular item sells about 1/n^s as much.
+zipf_exponent = 1.1
+
+# Most orders any one customer gets (order ids are handed out in blocks of this size).
+max_orders_per_customer = 64
+
+categories = [ 'shirt', 'pants', 'hat', 'shoes', 'jacket', 'bag', 'mug', 'hoodie' ]
+# these come in one size
+one_size = { 'hat', 'bag', 'mug' }
+sizes = [ 'XS', 'S', 'M', 'L', 'XL' ]
+colors = [ 'Red', 'Blue', 'Green', 'Black', 'White', 'Navy', 'Grey', 'Gold' ]
+adjectives = [ 'Classic', 'Vintage', 'Golden', 'Campus', 'Cozy', 'Retro', 'Team', 'Sport', 'Flash', 'Heritage' ]
+first_names = [ 'Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn', 'Drew', 'Kai' ]
+last_names = [ 'Smith', 'Johnson', 'Lee', 'Brown', 'Garcia', 'Miller', 'Davis', 'Wilson', 'Moore', 'Clark', 'Lewis', 'Young' ]
+streets = [ 'Main St', 'Oak Ave', 'Maple Dr', 'Summit St', 'Lincoln Way', 'College Ave', 'Water St', 'Park Blvd' ]
+cities = [ ('Kent', 'OH', 44240), ('Akron', 'OH', 44304), ('Cleveland', 'OH', 44114), ('Columbus', 'OH', 43215), ('Pittsburgh', 'PA', 15213) ]
+statuses = [ 'ordered', 'paid', 'shipped', 'delivered' ]
+
+# Orders are spread over this many seconds before now.
+history_seconds = 2 * 365 * 86400
+
+class Catalog:
+	"""
+	The few facts about every item that customer rows need (how many variants,
+	what they cost, how popular the item is), kept in compact arrays.
+	"""
+	
+	def __init__(self, items: int, seed: int):
+		rng = random.Random(seed)
+		self.items = items
+		self.category = array('B')
+		self.base_price = array('d')
+		self.variant_count = array('B')
+		for _ in range(items):
+			category = rng.randrange(len(categories))
+			self.category.append(category)
+			self.base_price.append(round(rng.uniform(4, 60), 2))
+			if categories[category] in one_size:
+				self.variant_count.append(rng.randint(1, 4))
+			else:
+				# every size, in one to three colors
+				self.variant_count.append(len(sizes) * rng.randint(1, 3))
+		
+		# Popularity: item ids in order of how well they sell, and the running
+		# total of their weights, for picking one with bisect.
+		self.by_popularity = array('I', range(1, items + 1))
+		rng.shuffle(self.by_popularity) # type: ignore
+		self.cumulative_weight = array('d', accumulate(1 / rank ** zipf_exponent for rank in range(1, items + 1)))
+	
+	def variant(self, item_id: int, variant_id: int) -> tuple[str, str, float, float]:
+		""" (size, color, price, weight) of one variant. """
+		category = categories[self.category[item_id - 1]]
+		if category in one_size:
+			(size, color) = ('N/A', colors[(item_id + variant_id) % len(colors)])
+		else:
+			size = sizes[variant_id % len(sizes)]
+			color = colors[(item_id + variant_id // len(sizes)) % len(colors)]
+		price = float(priceFromSize(str(self.base_price[item_id - 1]), size))
+		weight = 0.2 + (item_id % 17) / 10
+		if size != 'N/A':
+			weight += sizes.index(size) * 0.05
+		return (size, color, price, round(weight, 2))
+	
+	def pick(self, rng: random.Random) -> tuple[int, int]:
+		""" A random (item_id, variant_id), popular items more often. """
+		rank = bisect_right(self.cumulative_weight, rng.random() * self.cumulative_weight[-1])
+		item_id = self.by_popularity[min(rank, self.items - 1)]
+		return (item_id, rng.randrange(self.variant_count[item_id - 1]))
+
+# Set in each worker process, so it isn't sent along with every task.
+_catalog: Catalog | None = None
+_seed = 0
+_now = 0
+
+def _init_worker(catalog: Catalog, seed: int, now: int):
+	global _catalog, _seed, _now
+	(_catalog, _seed, _now) = (catalog, seed, now)
+
+def _rng(*parts: int) -> random.Random:
+	""" A generator for one piece of the data, the same every run. """
+	return random.Random(hash((_seed, *parts)))
+
+def item_rows(first: int, last: int):
+	catalog: Catalog = _catalog # type: ignore
+	for item_id in range(first, last):
+		rng = _rng(1, item_id)
+		category = categories[catalog.category[item_id - 1]]
+		name = f"{rng.choice(adjectives)} {rng.choice(colors)} {category.title()}"
+		yield (item_id, name, f"A {name.lower()}. Item #{item_id}.", category, None)
+
+def variant_rows(first: int, last: int):
+	catalog: Catalog = _catalog # type: ignore
+	for item_id in range(first, last):
+		rng = _rng(2, item_id)
+		for variant_id in range(catalog.variant_count[item_id - 1]):
+			(size, color, price, weight) = catalog.variant(item_id, variant_id)
+			yield (item_id, variant_id, size, color, f"{price:.2f}", rng.randint(0, 500), weight, None)
+
+def address_of(customer_id: int, rng: random.Random) -> tuple[int, int]:
+	"""
+	Shipping and billing address ids for a customer. Customer c has their own
+	address 2c-1 (and 2c, if they bill somewhere else), but some ship to their
+	neighbor's (the previous customer's) instead. Most bill to where they ship.
+	"""
+	shipping = 2 * customer_id - 1
+	if customer_id > 1 and rng.random() < 0.05:
+		shipping = 2 * (customer_id - 1) - 1
+	billing = 2 * customer_id if rng.random() < 0.2 else shipping
+	return (shipping, billing)
+
+def customer_parts(first: int, last: int, tsv_dir: str, part: int) -> list[tuple[str, str, int]]:
+	"""
+	Writes customers `first` to `last - 1`, with their addresses, carts and
+	orders, to one part file per table. Returns (table, path, rows) for each.
+	"""
+	catalog: Catalog = _catalog # type: ignore
+	now = _now
+	paths = { table: os.path.join(tsv_dir, f"{table}.{part}.tsv") for table in ('address', 'customer', 'shopping_cart', 'order', 'order_item') }
+	files = { table: open(path, 'w', newline='\n', buffering=1 << 20) for (table, path) in paths.items() }
+	counts = dict.fromkeys(paths, 0)
+	
+	def write(table: str, row: tuple):
+		files[table].write("\t".join(tsv_value(v) for v in row) + "\n")
+		counts[table] += 1
+	
+	try:
+		for customer_id in range(first, last):
+			rng = _rng(3, customer_id)
+			(first_name, last_name) = (rng.choice(first_names), rng.choice(last_names))
+			(shipping, billing) = address_of(customer_id, rng)
+			
+			# Their own address always exists (a neighbor might ship to it),
+			# and the second one only if they bill to it.
+			for address_id in sorted({2 * customer_id - 1, billing} & {2 * customer_id - 1, 2 * customer_id}):
+				(city, state, zip_code) = rng.choice(cities)
+				# (the unit number keeps them all different, as address_key's unique)
+				street = f"{rng.randint(1, 9999)} {rng.choice(streets)} #{address_id}"
+				write('address', (address_id, street, city, state, zip_code, address_key(street, city, state, zip_code)))
+			write('customer', (
+				customer_id, first_name, None, last_name,
+				shipping, billing,
+				f"{first_name.lower()}.{last_name.lower()}{customer_id}@example.com", 'password',
+				f"330{customer_id % 10_000_000:07d}"
+			))
+			
+			# About a quarter of customers have something in their cart.
+			if rng.random() < 0.25:
+				for (item_id, variant_id) in { catalog.pick(rng) for _ in range(rng.randint(1, 5)) }:
+					write('shopping_cart', (customer_id, item_id, variant_id, rng.randint(1, 3)))
+			
+			# Most customers order once or not at all; a few keep coming back.
+			orders = min(int(rng.paretovariate(1.2)) - 1, max_orders_per_customer)
+			first_order = (customer_id - 1) * max_orders_per_customer + 1
+			dates = sorted(now - rng.randrange(history_seconds) for _ in range(orders))
+			for (n, date) in enumerate(dates):
+				order_id = first_order + n
+				(total_price, total_weight) = (0.0, 0.0)
+				for (item_id, variant_id) in { catalog.pick(rng) for _ in range(rng.randint(1, 4)) }:
+					quantity = rng.randint(1, 3)
+					(_, _, price, weight) = catalog.variant(item_id, variant_id)
+					total_price += price * quantity
+					total_weight += weight * quantity
+					write('order_item', (order_id, item_id, variant_id, quantity))
+				# Older orders have gotten further along; anything
+				# over a couple of months old has been delivered.
+				age = (now - date) / history_seconds
+				status = statuses[min(len(statuses) - 1, int(age * 40))]
+				write('order', (
+					order_id, customer_id,
+					time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(date)),
+					shipping, billing,
+					f"{total_price:.2f}", round(total_weight, 2),
+					status
+				))
+	finally:
+		for f in files.values():
+			f.close()
+	return [ (table, paths[table], counts[table]) for table in paths ]
+
+def catalog_parts(first: int, last: int, tsv_dir: str, part: int) -> list[tuple[str, str, int]]:
+	""" Writes items `first` to `last - 1` and their variants. Returns (table, path, rows) for each. """
+	results = []
+	for (table, rows) in (('item_catalog', item_rows), ('variant_catalog', variant_rows)):
+		path = os.path.join(tsv_dir, f"{table}.{part}.tsv")
+		results.append((table, path, tsv_file(path, rows(first, last))))
+	return results
+
+def _run_task(task: tuple) -> list[tuple[str, str, int]]:
+	(kind, first, last, tsv_dir, part) = task
+	return (catalog_parts if kind == 'catalog' else customer_parts)(first, last, tsv_dir, part)
+
+# Load order that keeps foreign keys happy.
+load_order = [ 'item_catalog', 'variant_catalog', 'address', 'customer', 'shopping_cart', 'order', 'order_item' ]
+
+def generate_scaled(
+	scale: float, out_path: str = 'dml.sql', tsv_dir: str = 'load',
+	processes: int | None = None, seed: int = 1,
+	chunk: int = 20_000
+) -> dict[str, int]:
+	"""
+	Writes a made-up store at `scale` into TSV files in `tsv_dir`, and a script
+	at `out_path` that replaces the catalog, customers and orders with them.
+	Returns how many rows each table got.
+	"""
+	items = max(1, int(items_per_scale * scale))
+	customers = max(1, int(customers_per_scale * scale))
+	os.makedirs(tsv_dir, exist_ok=True)
+	
+	catalog = Catalog(items, seed)
+	tasks = [
+		('catalog', first, min(first + chunk, items + 1), tsv_dir, part)
+		for (part, first) in enumerate(range(1, items + 1, chunk))
+	] + [
+		('customers', first, min(first + chunk, customers + 1), tsv_dir, part)
+		for (part, first) in enumerate(range(1, customers + 1, chunk))
+	]
+	
+	parts: dict[str, list[tuple[str, int]]] = { table: [] for table in load_order }
+	done = 0
+	with Pool(processes, initializer=_init_worker, initargs=(catalog, seed, int(time.time()))) as pool:
+		for results in pool.imap_unordered(_run_task, tasks):
+			for (table, path, rows) in results:
+				parts[table].append((path, rows))
+			done += 1
+			print(f"{done}/{len(tasks)} parts written", file=sys.stderr)
+	
+	with open(out_path, 'w') as dml_sql:
+		print(f"-- Generated file: made-up data at scale {scale:g}. Run generate.py to update this.", file=dml_sql)
+		print("USE kstores;", file=dml_sql)
+		# Nothing to check: the data's consistent by construction, and checking
+		# millions of rows one at a time is most of what makes loading slow.
+		print("SET foreign_key_checks = 0, unique_checks = 0;", file=dml_sql)
+		for table in reversed(load_order):
+			print(f"TRUNCATE TABLE `{table}`;", file=dml_sql)
+		for table in load_order:
+			for (path, _) in sorted(parts[table]):
+				print(load_statement(table, path), file=dml_sql)
+		print("SET foreign_key_checks = 1, unique_checks = 1;", file=dml_sql)
+	
+	return { table: sum(rows for (_, rows) in parts[table]) for table in load_order }
@@ -1,8 +1,39 @@
 import sys
+import gzip
+import hashlib
+import argparse
+import os
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import threading
+import traceback
+from decimal import Decimal
+from collections import Counter
 
+from flask import Flask
 from mariadb import Cursor, Connection, mariadb
+from werkzeug.datastructures import MultiDict
 
 import actions
+import addresses
+import bench_load
+import catalog_index
+import db
+import decorators
+import encoding
+import generate
+import images
+import main
+import metrics
+import migrate
+import paging
+import querylog
+import session
+import textsearch
+from db import db_config
 
 # def test_create_item_with_variants(cur: Cursor) -> int:
 # 	return actions.create_catalog_item(cur, "Kent Shirt", "A shirt with the KSU logo", 'shirt', [
@@ -62,7 +93,944 @@ def run_tests(cur: Cursor):
 	test_shop_two_items_and_order(cur, guy, [1, 2])
 	print("the guy bought two items and checked out.")
 
+def stress_checkout(threads: int = 8, customers_per_thread: int = 25, stock: int = 100):
+	"""
+	Lots of customers try to buy the same variant at once, each on their own
+	connection, until it runs out. Checks nobody got sold stock that wasn't
+	there and that every checkout either went through or was turned away
+	for being out of stock, and reports how many per second went through.
+	"""
+	conn = mariadb.connect(**db_config)
+	cur = conn.cursor()
+	
+	item_id = actions.create_catalog_item(cur, "Stress Test Shirt", "Very popular.", 'shirt', [
+		('M', 'Red', 9.99, 1.0, stock),
+		('L', 'Red', 10.99, 1.1, stock)
+	])
+	address = actions.create_address(cur, '1 stress st', 'Kent', 'OH', 44240)
+	customers = [[
+		actions.create_customer(cur,
+			'stress', None, f"tester {t}-{c}",
+			f"stress-{item_id}-{t}-{c}@test.tld", 'hunter2',
+			'3300000000',
+			address, address
+		) for c in range(customers_per_thread) ] for t in range(threads) ]
+	conn.commit()
+	
+	results = { 'ordered': 0, 'sold_out': 0, 'errors': 0 }
+	results_lock = threading.Lock()
+	
+	def shopper(my_customers: list[int]):
+		conn = mariadb.connect(**db_config)
+		cur = conn.cursor()
+		for customer in my_customers:
+			try:
+				# Two variants in opposite orders, to give deadlocks a chance to happen.
+				variants = [0, 1] if customer % 2 else [1, 0]
+				for variant in variants:
+					actions.add_to_cart(cur, customer, item_id, variant, 2)
+				actions.place_order(cur, customer)
+				conn.commit()
+				outcome = 'ordered'
+			except actions.OutOfStock:
+				conn.rollback()
+				outcome = 'sold_out'
+			except Exception as e:
+				# Anything else is a bug (or the database falling over), not a
+				# correct answer: count it, and fail the run below.
+				conn.rollback()
+				print(f"Error: {type(e).__name__}: {e}")
+				outcome = 'errors'
+			with results_lock:
+				results[outcome] += 1
+		cur.close()
+		conn.close()
+	
+	workers = [ threading.Thread(target=shopper, args=(c,)) for c in customers ]
+	start = time.perf_counter()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	elapsed = time.perf_counter() - start
+	
+	cur.execute("""
+		SELECT variant_id, stock, (
+			SELECT COALESCE(SUM(quantity), 0)
+			FROM order_item
+			WHERE order_item.item_id = variant_catalog.item_id
+			AND order_item.variant_id = variant_catalog.variant_id
+		)
+		FROM variant_catalog
+		WHERE item_id = ?;
+	""", (item_id,))
+	
+	print(f"{results['ordered']} orders in {elapsed:.2f}s ({results['ordered'] / elapsed:.1f}/s), "
+		f"{results['sold_out']} turned away, {results['errors']} errors")
+	oversold = False
+	for (variant_id, left, sold) in cur.fetchall():
+		print(f"variant {variant_id}: sold {sold}, {left} left, started with {stock}")
+		oversold = oversold or sold + left != stock
+	print("OVERSOLD!" if oversold else "no overselling.")
+	
+	cur.close()
+	conn.commit()
+	conn.close()
+	return not oversold and results['errors'] == 0
+
+# - checks that don't need the database (python tests.py unit)
+
+def test_paging_cursors():
+	key = (3, 0, 12)
+	assert paging.decode_cursor(paging.encode_cursor(key)) == key
+	assert paging.decode_cursor(None) is None
+	assert paging.decode_cursor('') is None
+	try:
+		paging.decode_cursor('not a cursor!')
+		assert False, "bad cursors should raise"
+	except Exception as e:
+		assert str(e) == "invalid cursor"
+	
+	assert paging.clamp_limit(None) == paging.default_limit
+	assert paging.clamp_limit(0) == paging.default_limit
+	assert paging.clamp_limit(10 ** 6) == paging.max_limit
+	
+	assert paging.keyset_condition(['a', 'b'], None) == ("1=1", [])
+	(sql, params) = paging.keyset_condition(['a', 'b'], (1, 2))
+	assert sql == "((a > ?) OR (a = ? AND b > ?))"
+	assert params == [1, 1, 2]
+	
+	# Walking every page sees every row once, and the last page has no cursor.
+	rows = [ { 'id': i } for i in range(7) ]
+	def fetch(limit, after):
+		start = 0 if after is None else after[0] + 1
+		return rows[start:start + limit]
+	(seen, cursor) = ([], None)
+	while True:
+		(page, cursor) = paging.paginate(fetch, 3, cursor, key=lambda row: (row['id'],))
+		seen += page
+		if cursor is None:
+			break
+	assert seen == rows
+
+# (item_id, variant_id, item_name, category, size, color, price, weight, image_id, stock),
+# sorted by (item_id, variant_id) like CatalogIndex.load reads them.
+sample_variants = [
+	(1, 0, "Kent Shirt", 'shirt', 'S', 'Blue', 19.95, 1.0, 1, 5),
+	(1, 1, "Kent Shirt", 'shirt', 'M', 'Blue', 20.95, 1.1, 1, 0),
+	(1, 2, "Kent Shirt", 'shirt', 'L', 'Gold', 21.95, 1.2, 2, 3),
+	(2, 0, "Flash Hoodie", 'hoodie', 'M', 'Navy', 44.50, 2.0, 3, 1),
+	(2, 1, "Flash Hoodie", 'hoodie', 'XL', 'Gold', 46.50, 2.2, None, 0),
+	(3, 0, "Campus Mug", 'mug', None, None, 9.99, 0.5, 4, 12),
+]
+sample_texts = [
+	(1, "Kent Shirt", "A cotton shirt with the university logo."),
+	(2, "Flash Hoodie", "Warm fleece hoodie, good for cold mornings."),
+	(3, "Campus Mug", "Holds coffee. Dishwasher safe."),
+]
+
+def variant_ids(results: list[dict]) -> list[tuple[int, int]]:
+	return [ (r['id']['item'], r['id']['variant']) for r in results ]
+
+def test_catalog_index_filters():
+	index = catalog_index.CatalogIndex(sample_variants, sample_texts)
+	assert variant_ids(index.search()) == [ row[:2] for row in sample_variants ]
+	# Case doesn't matter, values in one filter are ORed, filters are ANDed.
+	assert variant_ids(index.search(category=['SHIRT'])) == [(1, 0), (1, 1), (1, 2)]
+	assert variant_ids(index.search(color=['gold', 'navy'])) == [(1, 2), (2, 0), (2, 1)]
+	assert variant_ids(index.search(color=['gold'], size=['XL'])) == [(2, 1)]
+	assert variant_ids(index.search(size=['m', 'xl'])) == [(1, 1), (2, 0), (2, 1)]
+	assert variant_ids(index.search(name=['hood'])) == [(2, 0), (2, 1)]
+	# (Short terms skip the trigram index: "sh" is in "flaSH" too.)
+	assert variant_ids(index.search(name=['sh'])) == [(1, 0), (1, 1), (1, 2), (2, 0), (2, 1)]
+	assert variant_ids(index.search(minprice=20, maxprice=45)) == [(1, 1), (1, 2), (2, 0)]
+	assert variant_ids(index.search(instock=True)) == [(1, 0), (1, 2), (2, 0), (3, 0)]
+	assert index.search(category=['nothing like it']) == []
+	
+	# Keyset paging picks up right after the given key.
+	assert variant_ids(index.search(limit=2)) == [(1, 0), (1, 1)]
+	assert variant_ids(index.search(limit=2, after=(1, 1))) == [(1, 2), (2, 0)]
+	assert variant_ids(index.search(after=(3, 0))) == []
+	
+	# The variant's own image, falling back to nothing (load() does the item fallback).
+	assert index.search(color=['gold'])[1]['image'] is None
+	
+	# Name searches are remembered, and come out the same the second time.
+	assert variant_ids(index.search(name=['HOOD'])) == [(2, 0), (2, 1)]
+	assert index.name_masks.hits == 1
+
+def test_catalog_index_bitmaps():
+	# Every way of building a bitmap agrees with setting the bits one at a time.
+	ranges = [(0, 3), (3, 4), (9, 17), (30, 31)]
+	expected = 0
+	for (start, end) in ranges:
+		for pos in range(start, end):
+			expected |= 1 << pos
+	assert catalog_index._ranges_bitmap(31, ranges) == expected
+	assert catalog_index._ranges_bitmap(31, []) == 0
+	assert catalog_index._bitmap(31, [ pos for (start, end) in ranges for pos in range(start, end) ]) == expected
+	
+	index = catalog_index.CatalogIndex(sample_variants)
+	assert index.colors['gold'] == 0b010100
+	assert index.sizes['m'] == 0b001010
+	assert index.instock == 0b101101
+
+def test_catalog_index_notices_other_workers():
+	(real_load, real_index) = (catalog_index.CatalogIndex.load, catalog_index._index)
+	class VersionCursor:
+		""" Answers catalog_version's query, and counts how often it's asked. """
+		version = (1, 1)
+		asked = 0
+		def execute(self, sql, params=()):
+			VersionCursor.asked += 1
+		def fetchone(self):
+			return VersionCursor.version
+	def load(cur, previous=None):
+		return catalog_index.CatalogIndex(sample_variants, version=catalog_index.catalog_version(cur))
+	catalog_index.CatalogIndex.load = load
+	catalog_index._index = None
+	cur = VersionCursor()
+	try:
+		first = catalog_index.get(cur)
+		assert VersionCursor.asked == 1
+		# Not asked again until check_interval is up.
+		assert catalog_index.get(cur) is first
+		assert VersionCursor.asked == 1
+		
+		# Nothing changed: still the same index.
+		catalog_index._checked_at -= catalog_index.check_interval + 1
+		assert catalog_index.get(cur) is first
+		assert VersionCursor.asked == 2
+		
+		# Another worker wrote something: rebuilt.
+		VersionCursor.version = (1, 2)
+		catalog_index._checked_at -= catalog_index.check_interval + 1
+		second = catalog_index.get(cur)
+		assert second is not first and second.version == (1, 2)
+	finally:
+		catalog_index.CatalogIndex.load = real_load
+		catalog_index._index = real_index
+		catalog_index.invalidate()
+
+def test_catalog_index_serves_stale_while_rebuilding():
+	(real_load, real_index) = (catalog_index.CatalogIndex.load, catalog_index._index)
+	loads = []
+	started = threading.Event()
+	release = threading.Event()
+	def load(cur, previous=None):
+		loads.append(previous)
+		if len(loads) > 1:
+			started.set()
+			release.wait(5)
+		return catalog_index.CatalogIndex(sample_variants[:len(loads) + 1])
+	catalog_index.CatalogIndex.load = load
+	catalog_index._index = None
+	try:
+		first = catalog_index.get(None)
+		assert first.size == 2
+		assert catalog_index.get(None) is first
+		
+		# While one thread rebuilds, everyone else keeps getting the old index.
+		catalog_index.invalidate()
+		rebuilt = []
+		rebuilder = threading.Thread(target=lambda: rebuilt.append(catalog_index.get(None)))
+		rebuilder.start()
+		assert started.wait(5)
+		assert catalog_index.get(None) is first
+		release.set()
+		rebuilder.join()
+		assert rebuilt[0].size == 3
+		assert catalog_index.get(None) is rebuilt[0]
+		assert len(loads) == 2
+	finally:
+		release.set()
+		catalog_index.CatalogIndex.load = real_load
+		catalog_index._index = real_index
+		catalog_index.invalidate()
+
+# Stand-ins for mariadb's pool, for the Pool and RequestCursor checks.
+
+class FakeConnectionPool:
+	""" Hands out `pool_size` FakeConnections, and None once they're all taken (like mariadb's). """
+	created: list[str] = []
+	
+	def __init__(self, pool_name: str, pool_size: int, **config):
+		FakeConnectionPool.created.append(pool_name)
+		# Slow to make, like a real one, so racing callers would overlap.
+		time.sleep(0.01)
+		self.lock = threading.Lock()
+		self.free = [ FakeConnection(self) for _ in range(pool_size) ]
+	
+	def get_connection(self):
+		with self.lock:
+			return self.free.pop() if self.free else None
+	
+	def close(self):
+		pass
+
+class FakeConnection:
+	""" Remembers what was run on it: the first word of each statement, and commits/rollbacks. """
+	
+	def __init__(self, pool: FakeConnectionPool):
+		self.pool = pool
+		self.log: list[str] = []
+	
+	def cursor(self):
+		return FakeCursor(self)
+	
+	def commit(self):
+		self.log.append('commit')
+	
+	def rollback(self):
+		self.log.append('rollback')
+	
+	def close(self):
+		# Back into the pool, like a pooled mariadb connection.
+		with self.pool.lock:
+			self.pool.free.append(self)
+
+class FakeCursor:
+	rowcount = 0
+	
+	def __init__(self, conn: FakeConnection):
+		self.conn = conn
+	
+	def execute(self, statement: str, data=(), **kwargs):
+		self.conn.log.append(statement.split()[0].upper())
+	
+	def close(self):
+		pass
+
+def with_fake_mariadb_pool(check):
+	""" Runs `check()` with db.Pool making FakeConnectionPools. """
+	real = db.mariadb.ConnectionPool
+	db.mariadb.ConnectionPool = FakeConnectionPool
+	FakeConnectionPool.created.clear()
+	try:
+		check()
+	finally:
+		db.mariadb.ConnectionPool = real
+
+def test_pool_slots_and_timeouts():
+	def check():
+		pool = db.Pool('test', 2, 0.05)
+		
+		# Lots of callers at once in a fresh worker still make just one pool.
+		got = []
+		def take():
+			conn = pool.acquire()
+			got.append(conn)
+			pool.release(conn)
+		takers = [ threading.Thread(target=take) for _ in range(8) ]
+		for t in takers:
+			t.start()
+		for t in takers:
+			t.join()
+		assert len(got) == 8
+		assert len(FakeConnectionPool.created) == 1
+		assert pool.stats()['in_use'] == 0
+		
+		# Full up: the next caller waits, then times out, and the slot count is untouched.
+		(a, b) = (pool.acquire(), pool.acquire())
+		assert a is not b and pool.stats()['in_use'] == 2
+		start = time.monotonic()
+		try:
+			pool.acquire()
+			assert False, "should have timed out"
+		except Exception as e:
+			assert 'timed out' in str(e)
+		assert time.monotonic() - start >= 0.05
+		stats = pool.stats()
+		assert stats['timeouts'] == 1 and stats['in_use'] == 2
+		
+		# A connection handed back while someone's waiting goes to them.
+		threading.Timer(0.01, pool.release, (a,)).start()
+		c = pool.acquire(timeout=1)
+		assert c is a
+		pool.release(b)
+		pool.release(c)
+		stats = pool.stats()
+		assert stats['in_use'] == 0 and stats['acquired'] == 11 and stats['peak_in_use'] == 2
+		
+		# The slot's given back even when the connection can't be had.
+		pool._get_pool().free.clear()
+		try:
+			pool.acquire(timeout=0.01)
+			assert False, "should have run out"
+		except Exception as e:
+			assert 'out of connections' in str(e)
+		assert pool.stats()['in_use'] == 0
+	with_fake_mariadb_pool(check)
+
+def test_request_cursor():
+	def check():
+		pool = db.Pool('test', 2, 0.05)
+		ran = []
+		
+		# Never used: never takes a connection.
+		cur = db.RequestCursor(pool)
+		cur.finish(True)
+		assert pool.stats()['acquired'] == 0
+		
+		# Only read so far: can let go of its connection early, and take a new one after.
+		cur = db.RequestCursor(pool)
+		cur.execute("SELECT 1;")
+		first = cur._conn
+		assert pool.stats()['in_use'] == 1
+		assert cur.release_if_unused()
+		assert first.log == ['SELECT', 'rollback'] and pool.stats()['in_use'] == 0
+		cur.execute("SELECT 2;")
+		cur.execute("UPDATE customer SET email = ?;", ('a@test.tld',))
+		# Wrote something: has to keep it.
+		assert not cur.release_if_unused()
+		cur.after_transaction(lambda: ran.append('always'))
+		cur.after_transaction(lambda: ran.append('committed'), committed_only=True)
+		conn = cur._conn
+		cur.finish(True)
+		assert conn.log[-3:] == ['SELECT', 'UPDATE', 'commit']
+		assert ran == ['always', 'committed'] and pool.stats()['in_use'] == 0
+		
+		# Locking counts as writing.
+		cur = db.RequestCursor(pool)
+		cur.execute("SELECT stock FROM variant_catalog FOR UPDATE;")
+		assert not cur.release_if_unused()
+		cur.finish(True)
+		
+		# Rolled back (failed, or read-only): committed_only callbacks are skipped.
+		ran.clear()
+		for (readonly, success) in [(False, False), (True, True)]:
+			cur = db.RequestCursor(pool, readonly)
+			cur.execute("DELETE FROM shopping_cart;")
+			db.after_transaction(cur, lambda: ran.append('always'))
+			db.after_transaction(cur, lambda: ran.append('committed'), committed_only=True)
+			conn = cur._conn
+			cur.finish(success)
+			assert conn.log[-1] == 'rollback'
+		assert ran == ['always', 'always'] and pool.stats()['in_use'] == 0
+		
+		# Plain cursors run it straight away.
+		db.after_transaction(FakeCursor(conn), lambda: ran.append('now'), committed_only=True)
+		assert ran[-1] == 'now'
+	with_fake_mariadb_pool(check)
+
+def test_metrics():
+	labels = (('kind', 'test'),)
+	def record():
+		for _ in range(5):
+			metrics.count('kstores_test_total', labels)
+		metrics.observe('kstores_test_seconds', (), 0.003)
+	threads = [ threading.Thread(target=record) for _ in range(20) ]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	record()
+	
+	@metrics.timed_action
+	def some_action():
+		metrics.record_query(0.001, 3)
+	some_action()
+	assert metrics.current_action() == '-'
+	
+	# Everyone's numbers get added up, and finished threads' shards folded away.
+	snapshot = metrics._snapshot()
+	assert snapshot['counters'][('kstores_test_total', labels)] == 105
+	histogram = snapshot['histograms'][('kstores_test_seconds', ())]
+	assert histogram[metrics.buckets.index(0.005)] == 21 and sum(histogram[:-1]) == 21
+	assert round(histogram[-1], 6) == 0.063
+	assert snapshot['counters'][('kstores_sql_rows_total', (('action', 'some_action'),))] == 3
+	assert all(thread.is_alive() for (thread, _) in metrics._shards)
+	
+	metrics.count('kstores_test_total', (('kind', 'say "hi"\n'),))
+	text = metrics.render()
+	assert '# TYPE kstores_test_total untyped' in text
+	assert 'kstores_test_total{kind="test"} 105' in text
+	assert 'kstores_test_total{kind="say \\"hi\\"\\n"} 1' in text
+	# Histogram buckets count everything up to their bound.
+	assert 'kstores_test_seconds_bucket{le="0.0025"} 0' in text
+	assert 'kstores_test_seconds_bucket{le="0.005"} 21' in text
+	assert 'kstores_test_seconds_bucket{le="+Inf"} 21' in text
+	assert 'kstores_test_seconds_count 21' in text
+	assert '# TYPE kstores_sql_duration_seconds histogram' in text
+
+def test_admin_routes():
+	client = main.app.test_client()
+	real = session.admin_token
+	try:
+		# No admin token set: closed to everyone.
+		session.admin_token = None
+		for path in ['/metrics', '/pool/stats', '/cache/stats', '/queries/slow']:
+			assert client.get(path).status_code == 403
+			assert client.get(path, headers={ 'Authorization': 'Bearer ' }).status_code == 403
+		
+		session.admin_token = b'let me in'
+		assert client.get('/pool/stats').status_code == 403
+		assert client.get('/pool/stats', headers={ 'Authorization': 'Bearer nope' }).status_code == 403
+		r = client.get('/pool/stats', headers={ 'Authorization': 'Bearer let me in' })
+		assert r.status_code == 200 and r.get_json()['size'] == db.pool.size
+		r = client.get('/metrics', headers={ 'Authorization': 'Bearer let me in' })
+		assert r.status_code == 200 and r.content_type == metrics.content_type
+	finally:
+		session.admin_token = real
+
+def test_statement_limits():
+	def chatty(path: str, statements: int) -> bool:
+		""" Whether a request to `path` running that many statements gets logged. """
+		before = len(querylog.recent()['chatty'])
+		with Flask(__name__).test_request_context(path):
+			querylog.check_statement_count(Counter({ "SELECT 1;": statements }))
+		return len(querylog.recent()['chatty']) > before
+	
+	assert not chatty('/address/edit', querylog.max_statements)
+	assert chatty('/address/edit', querylog.max_statements + 1)
+	assert not chatty('/cart/checkout', 5)
+	assert chatty('/cart/checkout', 6)
+	assert not chatty('/batch', 500)
+
+def test_compiled_form_parser():
+	parse = decorators.compile_form_parser({
+		'item': int, 'name': str, 'color': list[str], 'tags': list, 'instock': bool,
+	})
+	assert parse(MultiDict([
+		('item', '12'), ('name', 'shirt'), ('color', 'Blue'), ('color', 'Gold'), ('tags', 'a'), ('instock', 'true')
+	])) == { 'item': 12, 'name': 'shirt', 'color': ['Blue', 'Gold'], 'tags': ['a'], 'instock': True }
+	# Missing and empty values come out as None, and so do ones that don't convert.
+	assert parse(MultiDict([('name', ''), ('color', ''), ('instock', '')])) \
+		== { 'item': None, 'name': None, 'color': None, 'tags': None, 'instock': None }
+	assert parse(MultiDict([('item', 'twelve')]))['item'] is None
+	for (text, value) in [ ('1', True), ('yes', True), ('0', False), ('false', False), ('Off', False) ]:
+		assert parse(MultiDict([('instock', text)]))['instock'] is value
+	
+	def route(cur: Cursor, item: int, size, quantity: int = 1):
+		return (cur, item, size, quantity)
+	# The cursor isn't a parameter, and unannotated ones are strings.
+	assert decorators.signature_types(route) == { 'item': int, 'size': str, 'quantity': int }
+	
+	# What /batch calls: parses the given parameters and passes the given cursor along.
+	inner = decorators.fill_params_from_form(route)
+	assert inner.call_with('the cursor', MultiDict([('item', '3'), ('size', 'M')])) == ('the cursor', 3, 'M', None)
+	inner = decorators.fill_dict_from_form({ 'item': int })(lambda cur, form: form)
+	assert inner.call_with(None, MultiDict([('item', '4')])) == { 'item': 4 }
+
+def test_encoding():
+	app = Flask(__name__)
+	encoding.init_app(app)
+	order = { 'price': Decimal('12.99'), 'date': datetime.datetime(2024, 1, 2, 3, 4, 5), 'items': [1, 2] }
+	@app.route('/small')
+	def small():
+		return order
+	@app.route('/big')
+	def big():
+		return { 'orders': [order] * 200 }
+	client = app.test_client()
+	
+	# Whichever encoder's in use, clients see what Flask's own would've made.
+	with app.app_context():
+		expected = json.loads(Flask(__name__).json.dumps(order))
+	response = client.get('/small', headers={ 'Accept-Encoding': 'gzip' })
+	assert 'Content-Encoding' not in response.headers
+	assert response.get_json() == expected == { 'price': '12.99', 'date': 'Tue, 02 Jan 2024 03:04:05 GMT', 'items': [1, 2] }
+	
+	# Big enough responses get compressed, if the client takes it.
+	response = client.get('/big', headers={ 'Accept-Encoding': 'gzip' })
+	assert response.headers['Content-Encoding'] == 'gzip'
+	assert 'Accept-Encoding' in response.headers['Vary']
+	assert json.loads(gzip.decompress(response.get_data())) == { 'orders': [expected] * 200 }
+	response = client.get('/big')
+	assert 'Content-Encoding' not in response.headers
+	assert response.get_json() == { 'orders': [expected] * 200 }
+
+def test_address_key():
+	key = addresses.address_key
+	# What migrations/0004 computes in SQL for '12 Main St', 'Kent', 'OH', 44240.
+	assert key("12 Main St", "Kent", "OH", 44240) == hashlib.sha256(b"12 main st\x1fkent\x1fOH\x1f44240").digest()
+	
+	# Case and ASCII whitespace don't matter, like REGEXP_REPLACE '[[:space:]]+' and TRIM.
+	assert key("  12\tMAIN   st\r\n", " kent ", " oh ", "44240") == key("12 Main St", "Kent", "OH", 44240)
+	# But other whitespace does, since the SQL leaves it alone: the keys
+	# computed here have to match the ones the migration computed.
+	assert key("12\u00a0Main St", "Kent", "OH", 44240) != key("12 Main St", "Kent", "OH", 44240)
+	assert key("12 Main St\u3000", "Kent", "OH", 44240) != key("12 Main St", "Kent", "OH", 44240)
+	# TRIM(state) only trims spaces.
+	assert key("12 Main St", "Kent", "\tOH", 44240) != key("12 Main St", "Kent", "OH", 44240)
+	# The parts stay apart.
+	assert key("1 Main", "St Kent", "OH", 44240) != key("1 Main St", "Kent", "OH", 44240)
+
+def test_session_tokens():
+	token = session.create_token(42)
+	found = session.read_token(token)
+	assert found is not None and found['customer'] == 42
+	
+	# Changing either half breaks the signature.
+	(payload, signature) = token.split('.')
+	other = session.create_token(43).split('.')[0]
+	assert session.read_token(f"{other}.{signature}") is None
+	flipped = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+	assert session.read_token(f"{payload}.{flipped}") is None
+	assert session.read_token("garbage") is None
+	
+	(real_ttl, session.session_ttl) = (session.session_ttl, -1)
+	try:
+		assert session.read_token(session.create_token(42)) is None
+	finally:
+		session.session_ttl = real_ttl
+	
+	assert session.revoke_token(token)
+	assert session.read_token(token) is None
+	assert not session.revoke_token(token)
+
+def test_password_hashes():
+	stored = session.hash_password("hunter2")
+	assert stored.startswith('scrypt$') and "hunter2" not in stored
+	assert session.verify_password(stored, "hunter2") == (True, False)
+	assert session.verify_password(stored, "hunter3") == (False, False)
+	# Plaintext from before hashing still works, but asks to be rehashed.
+	assert session.verify_password("hunter2", "hunter2") == (True, True)
+	assert session.verify_password("hunter2", "nope") == (False, True)
+	# Routes hash before running any SQL; actions don't hash that again.
+	assert session.hash_password(stored) is stored
+
+def test_session_required():
+	app = Flask(__name__)
+	def authorize(customer_id: int, path: str = '/cart/info', headers: dict = {}) -> str | None:
+		""" Why `authorize` turned the request down, or None if it didn't. """
+		with app.test_request_context(path, headers=headers):
+			try:
+				session.authorize(customer_id)
+				return None
+			except Exception as e:
+				return str(e)
+	def bearer(token: str) -> dict:
+		return { 'Authorization': f"Bearer {token}" }
+	
+	token = session.create_token(42)
+	assert authorize(42, headers=bearer(token)) is None
+	assert authorize(43, headers=bearer(token)) == "that's not your account"
+	assert authorize(42, headers=bearer("garbage")).startswith("session expired")
+	# No token: refused, unless that's been turned off. And tokens in the
+	# query string don't count (they'd end up in access logs).
+	assert authorize(42) == "sign in first"
+	assert authorize(42, path=f'/cart/info?token={token}') == "sign in first"
+	(real, session.session_required) = (session.session_required, False)
+	try:
+		assert authorize(42) is None
+	finally:
+		session.session_required = real
+	
+	# Signing in is POST only, so passwords stay out of URLs.
+	client = main.app.test_client()
+	assert client.get('/customer/signin?email=a@test.tld&password=hunter2').status_code == 405
+	assert client.get('/cart/info?customer=42').get_json()['message'] == "sign in first"
+
+def test_text_search_ranking():
+	text = textsearch.TextIndex([
+		("Gold Mug", "Holds coffee."),                        # 0
+		("Travel Cup", "Keeps coffee hot. Better than a mug."), # 1
+		("Gold Hoodie", "Fleece, with a gold zipper."),          # 2
+		("Notebook", None),                                      # 3
+	])
+	scores = text.scores("mug")
+	# In the name counts for more than in the description.
+	assert set(scores) == {0, 1} and scores[0] > scores[1]
+	# Matching more of the query beats matching one word of it well.
+	scores = text.scores("gold coffee")
+	assert max(scores, key=scores.get) == 0
+	assert text.scores("") == {} and text.scores("nothing here") == {}
+	
+	# Typos: a letter missing, swapped or wrong still finds the word, for less.
+	assert set(text.scores("hodie")) == {2}
+	assert set(text.scores("notbeook")) == {3}
+	assert text.scores("hodie")[2] < text.scores("hoodie")[2]
+	assert textsearch.edit_distance("hodie", "hoodie", 2) == 1
+	assert textsearch.edit_distance("ab", "ba", 1) == 1
+	assert textsearch.edit_distance("kent", "mug", 1) == 2
+	
+	# The last word is matched as the start of a word, since it might still be being typed...
+	assert set(text.scores("trav")) == {1}
+	assert set(text.scores("gold hood")) == {0, 2}
+	# ...but earlier ones aren't.
+	assert set(text.scores("hood gold")) == {0, 2} and text.scores("hood gold")[2] == text.scores("gold")[2]
+
+def test_catalog_index_ranked_search():
+	index = catalog_index.CatalogIndex(sample_variants, sample_texts)
+	
+	found = index.search_items(q="hodie")
+	assert [ item['id'] for item in found ] == [2] and found[0]['score'] > 0
+	assert [ item['id'] for item in index.search_items(q="cof") ] == [3]
+	assert index.search_items(q="coffee", category=['shirt']) == []
+	
+	# Best first, and keyset paging on (relevance_key, item_id, variant_id) goes on from there.
+	found = index.search(q="gold shirt hoodie")
+	keys = [ (catalog_index.relevance_key(r['score']), r['id']['item'], r['id']['variant']) for r in found ]
+	assert keys == sorted(keys) and { key[1] for key in keys } == {1, 2}
+	for i in range(len(keys)):
+		assert variant_ids(index.search(q="gold shirt hoodie", after=keys[i])) == [ key[1:] for key in keys[i + 1:] ]
+
+def test_catalog_index_grouped_search():
+	index = catalog_index.CatalogIndex(sample_variants, sample_texts)
+	items = index.search_items()
+	assert [ item['id'] for item in items ] == [1, 2, 3]
+	(shirt, hoodie, mug) = items
+	assert shirt['variants'] == [0, 1, 2] and shirt['price'] == { 'min': 19.95, 'max': 21.95 }
+	# Sizes in the ENUM's order, not alphabetical.
+	assert shirt['sizes'] == ['S', 'M', 'L'] and shirt['colors'] == ['Blue', 'Gold']
+	assert mug['sizes'] == [] and mug['colors'] == []
+	
+	# Only the variants that match, and their prices and image.
+	(shirt, hoodie) = index.search_items(color=['gold'])
+	assert shirt['variants'] == [2] and shirt['price'] == { 'min': 21.95, 'max': 21.95 } and shirt['image'] == 2
+	assert hoodie['variants'] == [1] and hoodie['image'] is None
+	
+	# Pages hold whole items.
+	assert [ item['id'] for item in index.search_items(limit=1) ] == [1]
+	assert [ item['id'] for item in index.search_items(limit=1, after=(1,)) ] == [2]
+	assert index.search_items(after=(3,)) == []
+
+def test_split_statements():
+	# How many statements each migration should come out as; a miscount means
+	# a trigger body cut up at its `;`s, or two statements sent as one.
+	expected = { 1: 5, 2: 1, 3: 8, 4: 12, 5: 6, 6: 1, 7: 2, 8: 4, 9: 1 }
+	migrations = { m.version: m for m in migrate.find_migrations() }
+	assert { version: len(migrations[version].statements()) for version in expected } == expected
+	
+	for migration in migrations.values():
+		for statement in migration.statements():
+			assert not statement.upper().startswith('DELIMITER') and not statement.endswith((';', '//'))
+	# (A trigger with `;`s of its own, between DELIMITER lines, stays whole.)
+	(trigger,) = [ s for s in migrations[3].statements() if 'customer_address_refs_update' in s ]
+	assert ';' in trigger and trigger.endswith('END IF')
+	
+	# Delimiters in quotes and comments don't count.
+	assert migrate.split_statements(
+		"-- one; two\nSELECT ';', \"it\\'s;\"; -- three;\nSELECT 2;\n"
+	) == [ "SELECT ';', \"it\\'s;\"", "SELECT 2" ]
+
+def test_bench_statistics():
+	ordered = [ i / 1000 for i in range(1, 101) ]
+	assert bench_load.percentile(ordered, 50) == 0.050
+	assert bench_load.percentile(ordered, 99) == 0.099
+	assert bench_load.percentile([0.2], 95) == 0.2
+	assert bench_load.percentile([], 95) == 0.0
+	
+	summary = bench_load.summarize(list(reversed(ordered)), errors=2, seconds=4)
+	assert summary['requests'] == 100 and summary['errors'] == 2 and summary['rps'] == 25
+	assert round(summary['p95_ms'], 6) == 95 and round(summary['max_ms'], 6) == 100
+	assert bench_load.summarize([], 0, 0)['rps'] == 0.0
+	
+	def results(p95: float) -> dict:
+		route = { 'rps': 100.0, 'p95_ms': p95 }
+		return { 'routes': { '/catalog/search': route }, 'total': route }
+	assert bench_load.compare(results(10.5), results(10), tolerance=0.1)
+	assert not bench_load.compare(results(12), results(10), tolerance=0.1)
+	
+	mix = bench_load.parse_mix("checkout=0,search=60")
+	assert mix['checkout'] == 0 and mix['search'] == 60 and mix['browse'] == bench_load.default_mix['browse']
+	try:
+		bench_load.parse_mix("teleport=5")
+		assert False, "unknown visits should be refused"
+	except argparse.ArgumentTypeError:
+		pass
+
+def test_generate_smoke():
+	# generate.py works relative to the current directory (sourceImages/ in,
+	# images/ and dml.sql out), so give it a scratch one.
+	here = os.getcwd()
+	with tempfile.TemporaryDirectory() as scratch:
+		os.mkdir(os.path.join(scratch, 'sourceImages'))
+		os.mkdir(os.path.join(scratch, 'images'))
+		shutil.copyfile('sourceImages/Black-Crew-Sock.jpg', os.path.join(scratch, 'sourceImages', 'sock.jpg'))
+		with open(os.path.join(scratch, 'items.csv'), 'w') as f:
+			f.write("ID,Category,Name,Description,Image\n1,Socks,Crew Sock,Comfy,sock.jpg\n")
+		with open(os.path.join(scratch, 'variants.csv'), 'w') as f:
+			f.write("ID,Size,Color,Price,Weight,Stock,Image\n1,\"S,M\",Black,4.99,0.1,10,sock.jpg\n")
+		
+		os.chdir(scratch)
+		try:
+			timings = generate.generate()
+			with open('dml.sql') as f:
+				script = f.read()
+			assert os.path.exists(os.path.join('images', '1'))
+			if generate.derivatives.Image is not None:
+				assert os.path.exists(os.path.join('images', '1.thumbnail'))
+			
+			# The second time around, nothing's changed, so nothing gets copied.
+			generate.generate(make_derivatives=False)
+		finally:
+			os.chdir(here)
+	
+	assert set(timings) == { 'read', 'write', 'copy images', 'derivatives' }
+	assert "INSERT INTO `item_catalog`" in script and "'Crew Sock'" in script
+	assert "INSERT INTO `variant_catalog`" in script
+	assert script.count("'Black'") == 2
+	assert "COMMIT WORK;" in script
+
+unit_tests = [
+	test_paging_cursors,
+	test_catalog_index_filters,
+	test_catalog_index_serves_stale_while_rebuilding,
+	test_catalog_index_bitmaps,
+	test_catalog_index_notices_other_workers,
+	test_pool_slots_and_timeouts,
+	test_request_cursor,
+	test_metrics,
+	test_admin_routes,
+	test_statement_limits,
+	test_compiled_form_parser,
+	test_encoding,
+	test_address_key,
+	test_session_tokens,
+	test_password_hashes,
+	test_session_required,
+	test_text_search_ranking,
+	test_catalog_index_ranked_search,
+	test_catalog_index_grouped_search,
+	test_split_statements,
+	test_bench_statistics,
+	test_generate_smoke,
+]
+
+# These need the database in db.py (KSTORES_DB_* settings), with the migrations
+# applied; they add their own items and customers, so use a scratch copy.
+
+def db_fixture(name: str) -> tuple[int, int]:
+	""" A new item with one variant (0) in stock, and a new customer. Returns (item_id, customer_id). """
+	conn = mariadb.connect(**db_config)
+	cur = conn.cursor()
+	item_id = actions.create_catalog_item(cur, f"{name} shirt", "For testing.", 'shirt', [
+		('M', 'Red', 9.99, 1.0, 10)
+	])
+	address = actions.create_address(cur, f"1 {name} st", 'Kent', 'OH', 44240)
+	customer_id = actions.create_customer(cur,
+		'test', None, name,
+		f"{name}-{item_id}@test.tld", 'hunter2',
+		'3300000000',
+		address, address
+	)
+	conn.commit()
+	cur.close()
+	conn.close()
+	return (item_id, customer_id)
+
+def cart_rows(customer_id: int) -> list[tuple[int, int, int]]:
+	""" (item_id, variant_id, quantity) in the customer's cart, straight from the table. """
+	conn = mariadb.connect(**db_config)
+	cur = conn.cursor()
+	cur.execute("""
+		SELECT item_id, variant_id, quantity
+		FROM shopping_cart
+		WHERE customer_id = ?
+		ORDER BY item_id, variant_id;
+		""", (customer_id,))
+	rows = [ tuple(row) for row in cur.fetchall() ]
+	cur.close()
+	conn.close()
+	return rows
+
+def test_batch_atomic_and_savepoints():
+	(item_id, customer_id) = db_fixture('batch')
+	client = main.app.test_client()
+	signed_in = { 'Authorization': f"Bearer {session.create_token(customer_id)}" }
+	
+	def batch(transaction: bool):
+		return client.post('/batch', headers=signed_in, json={ 'transaction': transaction, 'operations': [
+			{ 'path': '/cart/add', 'method': 'POST', 'args': { 'customer': customer_id, 'item': item_id, 'variant': 0, 'quantity': 2 } },
+			# There's no variant 7, so this one breaks the foreign key.
+			{ 'path': '/cart/add', 'method': 'POST', 'args': { 'customer': customer_id, 'item': item_id, 'variant': 7, 'quantity': 1 } }
+		] })
+	
+	# All or nothing: the second one failing undoes the first.
+	r = batch(True)
+	assert r.status_code == 500 and not r.get_json()['success']
+	assert 'operation 1' in r.get_json()['message']
+	assert cart_rows(customer_id) == []
+	
+	# Each on its own: the first one sticks, the second one is undone alone.
+	r = batch(False)
+	assert r.status_code == 200
+	results = r.get_json()['results']
+	assert [ result['success'] for result in results ] == [True, False]
+	assert cart_rows(customer_id) == [(item_id, 0, 2)]
+	
+	# Typos fail before anything runs.
+	r = client.post('/batch', json=[ { 'path': '/cart/nope', 'method': 'POST' } ])
+	assert r.status_code == 500
+
+def test_image_serving():
+	conn = mariadb.connect(**db_config)
+	cur = conn.cursor()
+	image_id = actions.create_image(cur, 'image/jpeg', "A test sock.")
+	conn.commit()
+	cur.close()
+	conn.close()
+	# Put in place by hand rather than through /image/create, so no
+	# derivatives get made until the first request for one.
+	shutil.copyfile('sourceImages/Black-Crew-Sock.jpg', images.image_path(image_id))
+	length = os.path.getsize(images.image_path(image_id))
+	client = main.app.test_client()
+	
+	r = client.get(f'/image/get?image={image_id}')
+	assert r.status_code == 200 and r.mimetype == 'image/jpeg'
+	assert len(r.data) == length
+	etag = r.headers['ETag']
+	assert 'public' in r.headers['Cache-Control']
+	
+	# Nothing changed, so nothing to send.
+	r = client.get(f'/image/get?image={image_id}', headers={ 'If-None-Match': etag })
+	assert r.status_code == 304 and r.data == b''
+	
+	r = client.get(f'/image/get?image={image_id}', headers={ 'Range': 'bytes=0-9' })
+	assert r.status_code == 206 and len(r.data) == 10
+	assert r.headers['Content-Range'] == f"bytes 0-9/{length}"
+	
+	# No thumbnail yet: the original stands in, and mustn't be kept as the thumbnail.
+	r = client.get(f'/image/get?image={image_id}&size=thumbnail')
+	assert r.status_code == 200 and len(r.data) == length
+	assert 'no-cache' in r.headers['Cache-Control']
+	
+	if images.Image is not None:
+		# That request queued the thumbnail up; once it's there, it's what gets served.
+		deadline = time.monotonic() + 10
+		while not os.path.exists(images.image_path(image_id, 'thumbnail')):
+			assert time.monotonic() < deadline, "the thumbnail never got made"
+			time.sleep(0.05)
+		r = client.get(f'/image/get?image={image_id}&size=thumbnail')
+		assert r.status_code == 200 and len(r.data) < length
+		assert 'public' in r.headers['Cache-Control']
+	
+	r = client.get(f'/image/get?image={image_id}&size=poster')
+	assert r.status_code == 500
+
+db_tests = [
+	test_batch_atomic_and_savepoints,
+	test_image_serving,
+]
+
+def run_checks(checks) -> bool:
+	""" Runs each check, printing which ones failed and why. Returns whether they all passed. """
+	failed = 0
+	for check in checks:
+		try:
+			check()
+			print(f"ok    {check.__name__}")
+		except Exception:
+			failed += 1
+			print(f"FAIL  {check.__name__}")
+			traceback.print_exc()
+	print(f"{len(checks) - failed} of {len(checks)} passed.")
+	return failed == 0
+
 if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == 'unit':
+		# python tests.py unit
+		sys.exit(0 if run_checks(unit_tests) else 1)
+	if len(sys.argv) > 1 and sys.argv[1] == 'db':
+		# python tests.py db
+		sys.exit(0 if run_checks(db_tests) else 1)
+	if len(sys.argv) > 1 and sys.argv[1] == 'stress':
+		# python tests.py stress [threads] [customers per thread] [stock]
+		ok = stress_checkout(*[int(arg) for arg in sys.argv[2:]])
+		sys.exit(0 if ok else 1)
+	
 	try:
 		# Connect to the database.
 		conn = mariadb.connect(
@@ -87,7 +1055,7 @@ if __name__ == '__main__':
 		cur.close()
 		conn.commit()
 		conn.close()
-		
+	
 	except mariadb.Error as e:
 		print(f"Database Error:\n{e}")
 		sys.exit(1)
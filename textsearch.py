@@ -0,0 +1,170 @@
+import math
+import re
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from heapq import nlargest
+
+# Relevance-ranked text search over the catalog's item names and descriptions,
+# for `/catalog/search?q=...`.
+#
+# It's an inverted index: every word points at the items that use it, and
+# items are scored with BM25 (words that are rare in the catalog, and common
+# in the item, count for more). Words in the name count `name_weight` times
+# as much as ones in the description.
+#
+# Words in the query that aren't in the catalog are matched to ones that are
+# at most a typo or two away, found through a trigram index over the words.
+# The last word of the query also matches words it's the start of, so
+# results show up while it's still being typed.
+
+# BM25's knobs: how fast repeating a word stops helping, and how much long
+# descriptions are held against an item.
+k1 = 1.2
+b = 0.75
+
+name_weight = 3
+
+# How much a looser match counts for, next to the word itself.
+prefix_weight = 0.8
+typo_weights = { 1: 0.6, 2: 0.3 }
+
+# Most words one query word can turn into.
+max_expansions = 30
+
+_word = re.compile(r'\w+')
+
+def tokenize(text: str | None) -> list[str]:
+	""" The words in `text`, lowercased. """
+	return _word.findall(text.lower()) if text else []
+
+def _grams(word: str) -> set[str]:
+	padded = f"^{word}$"
+	return { padded[i:i+3] for i in range(len(padded) - 2) }
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+	"""
+	Optimal string alignment distance: insertions, deletions, substitutions,
+	and swapping two letters next to each other, at one each. Gives up (and
+	returns `limit + 1`) once it's sure it'll be more than `limit`.
+	"""
+	if abs(len(a) - len(b)) > limit:
+		return limit + 1
+	previous = None
+	row = list(range(len(b) + 1))
+	for i in range(1, len(a) + 1):
+		(before, previous, row) = (previous, row, [i] + [0] * len(b))
+		for j in range(1, len(b) + 1):
+			cost = a[i - 1] != b[j - 1]
+			row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+			if i > 1 and j > 1 and before is not None \
+			and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+				row[j] = min(row[j], before[j - 2] + 1)
+		if min(row) > limit:
+			return limit + 1
+	return row[-1]
+
+class TextIndex:
+	"""
+	A read-only inverted index over (name, description) documents. Like
+	`catalog_index.CatalogIndex`, build a new one instead of changing it.
+	"""
+	
+	def __init__(self, docs: list[tuple[str | None, str | None]]):
+		self.size = len(docs)
+		# word -> the documents it's in (ascending), and how much it counts
+		# towards each of them (BM25's term frequency part, worked out ahead).
+		postings: dict[str, tuple[list[int], list[int]]] = {}
+		lengths = []
+		for (doc, (name, description)) in enumerate(docs):
+			counts = Counter(tokenize(description))
+			for word in tokenize(name):
+				counts[word] += name_weight
+			lengths.append(counts.total())
+			for (word, count) in counts.items():
+				found = postings.get(word)
+				if found is None:
+					found = postings[word] = ([], [])
+				found[0].append(doc)
+				found[1].append(count)
+		
+		average = (sum(lengths) / len(lengths)) if lengths else 1.0
+		norms = [ k1 * (1 - b + b * length / average) for length in lengths ]
+		self.docs: dict[str, array] = {}
+		self.impacts: dict[str, array] = {}
+		self.idf: dict[str, float] = {}
+		for (word, (found, tfs)) in postings.items():
+			self.docs[word] = array('I', found)
+			self.impacts[word] = array('f', [
+				tf * (k1 + 1) / (tf + norms[doc])
+				for (doc, tf) in zip(found, tfs)
+			])
+			self.idf[word] = math.log(1 + (self.size - len(found) + 0.5) / (len(found) + 0.5))
+		
+		# Sorted, for prefix matching, and trigrams of every word, for typos.
+		self.words = sorted(postings)
+		self.grams: dict[str, list[str]] = {}
+		for word in self.words:
+			for gram in _grams(word):
+				self.grams.setdefault(gram, []).append(word)
+	
+	def _prefixed(self, prefix: str) -> list[str]:
+		""" The most common words starting with `prefix` (besides `prefix` itself). """
+		found = []
+		for i in range(bisect_left(self.words, prefix), len(self.words)):
+			word = self.words[i]
+			if not word.startswith(prefix):
+				break
+			if word != prefix:
+				found.append(word)
+		return nlargest(max_expansions, found, key=lambda word: len(self.docs[word]))
+	
+	def _typos(self, word: str) -> list[tuple[str, int]]:
+		""" Words in the index a typo or two away from `word`, with how far. """
+		limit = 1 if len(word) <= 5 else 2
+		shared: dict[str, int] = {}
+		for gram in _grams(word):
+			for candidate in self.grams.get(gram, ()):
+				if abs(len(candidate) - len(word)) <= limit:
+					shared[candidate] = shared.get(candidate, 0) + 1
+		# Checking the ones with the most trigrams in common first.
+		found = []
+		for candidate in nlargest(max_expansions * 4, shared, key=shared.__getitem__):
+			distance = edit_distance(word, candidate, limit)
+			if distance <= limit:
+				found.append((candidate, distance))
+		found.sort(key=lambda match: (match[1], -len(self.docs[match[0]])))
+		return found[:max_expansions]
+	
+	def expand(self, word: str, prefix: bool = False) -> list[tuple[str, float]]:
+		""" The indexed words one query word matches, each with how much it counts. """
+		matches: dict[str, float] = {}
+		if word in self.docs:
+			matches[word] = 1.0
+		if prefix and len(word) >= 2:
+			for found in self._prefixed(word):
+				matches.setdefault(found, prefix_weight)
+		if not matches and len(word) >= 3:
+			for (found, distance) in self._typos(word):
+				matches.setdefault(found, typo_weights[distance])
+		return list(matches.items())
+	
+	def scores(self, query: str) -> dict[int, float]:
+		"""
+		Document -> relevance, for every document matching any word of `query`.
+		Each query word adds its best match's score, so documents matching more
+		of the query come first.
+		"""
+		words = tokenize(query)
+		total: dict[int, float] = {}
+		for (i, word) in enumerate(words):
+			best: dict[int, float] = {}
+			for (found, weight) in self.expand(word, prefix=(i == len(words) - 1)):
+				factor = weight * self.idf[found]
+				for (doc, impact) in zip(self.docs[found], self.impacts[found]):
+					score = factor * impact
+					if score > best.get(doc, 0.0):
+						best[doc] = score
+			for (doc, score) in best.items():
+				total[doc] = total.get(doc, 0.0) + score
+		return total